@@ -0,0 +1,153 @@
+# benchmarks/coalescing.py
+"""Benchmark: send calls per delivered message vs. the coalescing delay.
+
+Runs the server in-process on a loopback port, connects a number of
+receiving clients and one sender, and sends bursts of chat messages. For
+each coalescing delay it reports the server's send calls per delivered
+message (from queue_stats), the receivers' recv() calls per message, and
+the delay from sending a message to its arrival at a receiver.
+
+    python benchmarks/coalescing.py
+    python benchmarks/coalescing.py --engine asyncio --delays 0 1 2 5 --clients 200 --burst 50
+"""
+import argparse
+import logging
+import os
+import selectors
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+from protocol import (  # noqa: E402
+    MSG_COMPACT_EVENT, MSG_NAME, MSG_SAY, FrameDecoder, decode_compact_event, encode_frame,
+    encode_hello, parse_hello_ack, parse_name,
+)
+
+
+def connect(port, nickname):
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.recv(16)
+    sock.sendall(encode_hello(nickname))
+    version, rest = parse_hello_ack(sock.recv(16))
+    if version is None:
+        raise RuntimeError("server did not accept framing")
+    return sock, rest
+
+
+class Receivers(threading.Thread):
+    """Reads every receiving client with one selector and records when
+    each message stamped by the sender arrives."""
+
+    def __init__(self, socks):
+        super().__init__(daemon=True)
+        self.selector = selectors.DefaultSelector()
+        for sock, rest in socks:
+            state = {'decoder': FrameDecoder(), 'names': {}}
+            self.selector.register(sock, selectors.EVENT_READ, state)
+            self.feed(state, rest)
+        self.recv_calls = 0
+        self.latencies = []
+        self.running = True
+
+    def feed(self, state, data):
+        now = time.perf_counter()
+        for msg_type, payload in state['decoder'].feed(data):
+            if msg_type == MSG_NAME:
+                name_id, name = parse_name(payload)
+                state['names'][name_id] = name
+            elif msg_type == MSG_COMPACT_EVENT:
+                text = decode_compact_event(payload, state['names'])['text']
+                if text.startswith('t='):
+                    self.latencies.append(now - float(text[2:].split()[0]))
+
+    def run(self):
+        while self.running:
+            for key, _ in self.selector.select(0.1):
+                data = key.fileobj.recv(65536)
+                self.recv_calls += 1
+                if data:
+                    self.feed(key.data, data)
+                else:
+                    self.selector.unregister(key.fileobj)
+
+
+def run(engine, delay, clients, bursts, burst, interval, padding):
+    logging.disable(logging.WARNING)
+    directory = tempfile.mkdtemp()
+    chat_server = server.ChatServer(
+        '127.0.0.1', 0, engine=engine, coalesce_delay=delay,
+        log_dir=os.path.join(directory, 'logs'), blob_store_dir=os.path.join(directory, 'blobs'),
+        history_dir=os.path.join(directory, 'history'))
+    port = chat_server.server.getsockname()[1]
+    threading.Thread(target=chat_server.start, daemon=True).start()
+
+    socks = [connect(port, f"user{i}") for i in range(clients)]
+    sender, _ = connect(port, 'sender')
+    receivers = Receivers(socks)
+    receivers.start()
+    time.sleep(0.5)
+
+    before = chat_server.queue_stats()
+    receivers.recv_calls = 0
+    for _ in range(bursts):
+        for _ in range(burst):
+            sender.sendall(encode_frame(MSG_SAY, f"t={time.perf_counter()!r} {padding}".encode('utf-8')))
+        time.sleep(interval)
+    expected = bursts * burst * clients
+    deadline = time.time() + 10
+    while len(receivers.latencies) < expected and time.time() < deadline:
+        time.sleep(0.05)
+    after = chat_server.queue_stats()
+
+    receivers.running = False
+    receivers.join()
+    for sock, _ in socks:
+        sock.close()
+    sender.close()
+    chat_server.stop()
+
+    sent = after['sent_messages'] - before['sent_messages']
+    calls = after['send_calls'] - before['send_calls']
+    latencies = sorted(receivers.latencies)
+    delivered = len(latencies)
+    return {
+        'delivered': delivered,
+        'expected': expected,
+        'sends_per_message': calls / max(sent, 1),
+        'recvs_per_message': receivers.recv_calls / max(delivered, 1),
+        'p50_ms': statistics.median(latencies) * 1000 if latencies else 0,
+        'p99_ms': latencies[int(delivered * 0.99) - 1] * 1000 if latencies else 0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--engine', choices=server.ChatServer.ENGINES, default='threaded')
+    parser.add_argument('--delays', type=float, nargs='+', default=[0, 2],
+                        help="coalescing delays to compare, in ms")
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--bursts', type=int, default=20)
+    parser.add_argument('--burst', type=int, default=20, help="messages per burst")
+    parser.add_argument('--interval', type=float, default=0.05, help="seconds between bursts")
+    parser.add_argument('--message-size', type=int, default=60)
+    args = parser.parse_args()
+
+    padding = 'x' * max(0, args.message_size - 30)
+    print(f"{args.engine} engine, {args.clients} receivers, {args.bursts} bursts of {args.burst} messages")
+    print(f"{'delay ms':>8} {'delivered':>12} {'sends/msg':>10} {'recvs/msg':>10} {'p50 ms':>8} {'p99 ms':>8}")
+    for delay in args.delays:
+        result = run(args.engine, delay / 1000, args.clients, args.bursts, args.burst,
+                     args.interval, padding)
+        print(f"{delay:>8g} {result['delivered']:>6}/{result['expected']:<5} "
+              f"{result['sends_per_message']:>10.3f} {result['recvs_per_message']:>10.3f} "
+              f"{result['p50_ms']:>8.2f} {result['p99_ms']:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
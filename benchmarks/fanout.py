@@ -0,0 +1,85 @@
+# benchmarks/fanout.py
+"""Microbenchmark: CPU cost of one broadcast vs. room size.
+
+Compares the server's encode-once fan-out with the previous approach of
+formatting and encoding the message separately for every recipient.
+Clients are in-memory connections whose queue is drained immediately, so
+only the server-side CPU cost is measured, not the network.
+
+    python benchmarks/fanout.py
+    python benchmarks/fanout.py --sizes 10 1000 10000 --messages 200 --legacy-ratio 0.5
+"""
+import argparse
+import datetime
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+from protocol import EVENT_CHAT, MSG_TEXT, PROTOCOL_VERSION, make_event  # noqa: E402
+
+
+class NullConnection(server.BaseConnection):
+    """Connection whose writer 'sends' every queued item instantly."""
+
+    def enqueue(self, item, droppable=False):
+        result = self._push(item, droppable)
+        if result == 'queued':
+            self.queue.popleft()
+            self._sent(item)
+        return self._after_push(item, result)
+
+    def close(self):
+        self.closed = True
+
+
+def per_recipient_broadcast(chat_server, message, sender_client=None):
+    """The old fan-out: timestamp, format and encode inside the client loop."""
+    for client in chat_server.clients:
+        if client != sender_client:
+            timestamp = datetime.datetime.now().strftime('%H:%M:%S')
+            client.send_message(MSG_TEXT, f"[{timestamp}] {message}".encode('utf-8'), droppable=True)
+
+
+def measure(broadcast, message, messages):
+    """Return CPU microseconds spent per broadcast message."""
+    start = time.process_time()
+    for _ in range(messages):
+        broadcast(message)
+    return (time.process_time() - start) / messages * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 1000, 10000])
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--legacy-ratio', type=float, default=0.0,
+                        help="fraction of clients using the legacy text protocol")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    chat_server = server.ChatServer('127.0.0.1', 0)
+    message = "alice: " + "hello world " * 8
+
+    print(f"{'clients':>8} {'per-recipient us/msg':>22} {'encode-once us/msg':>20} {'speedup':>8}")
+    for size in args.sizes:
+        chat_server.clients = server.ClientRegistry()
+        for i in range(size):
+            client = NullConnection(high_watermark=1 << 30, low_watermark=1 << 29)
+            if i >= size * args.legacy_ratio:
+                client.enable_framing(PROTOCOL_VERSION)
+            chat_server.clients.add(client, f"user{i}")
+
+        old = measure(lambda m: per_recipient_broadcast(chat_server, m), message, args.messages)
+        new = measure(lambda m: chat_server.broadcast(make_event(EVENT_CHAT, m[7:], 'alice')),
+                      message, args.messages)
+        print(f"{size:>8} {old:>22.1f} {new:>20.1f} {old / new:>7.2f}x")
+
+    chat_server.server.close()
+
+
+if __name__ == "__main__":
+    main()
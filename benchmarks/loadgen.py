@@ -0,0 +1,547 @@
+# benchmarks/loadgen.py
+"""End-to-end load test: server.py on loopback against synthetic clients.
+
+Starts server.py as a separate process for each engine, then:
+
+1. connects --clients clients (a --legacy-ratio of them on the legacy text
+   protocol, the others framed) and measures handshake time, how many got
+   in, and the server's memory per connection;
+2. has --senders of them chat at --rate messages per second each for
+   --duration seconds, and measures the delivery latency of every copy
+   (p50/p99/p999) and messages delivered per second. A legacy client
+   reads one message per recv(), like client.py, so messages that reach
+   it in the same recv() are counted as merged, not delivered;
+3. uploads a --file-size MB file through the legacy "FILE:" path and
+   measures how fast it reaches everyone: legacy clients are sent the
+   file, and --downloaders framed clients download it after the
+   announcement.
+
+All clients run on one event loop in this process, which also takes the
+timestamps, so with many clients the numbers include this process's own
+delays. Results are printed and written as JSON; --compare prints the
+change against an earlier result file.
+
+    python benchmarks/loadgen.py
+    python benchmarks/loadgen.py --engines threaded asyncio --clients 1000 --senders 50 \\
+        --rate 2 --duration 20 --output after.json --compare before.json
+    python benchmarks/loadgen.py --server-args "--coalesce-ms 0"
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import re
+import shlex
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from protocol import (  # noqa: E402
+    HELLO_PREFIX, MSG_BLOB_REQUEST, MSG_COMPACT_EVENT, MSG_COMPRESSED, MSG_FILE_META, MSG_NAME,
+    MSG_SAY, MSG_TRANSFER_CHUNK, FrameDecoder, decode_compact_event, decode_json,
+    decompress_frame, encode_frame, encode_hello, encode_json, parse_chunk, parse_hello_ack,
+    parse_name,
+)
+from server import raise_open_file_limit  # noqa: E402
+
+# Chat messages carry the time they were sent: "t=<perf_counter>;"
+STAMP = re.compile(r't=(\d+\.\d+);')
+
+# Settings that change the load; results are only comparable if they match
+LOAD_SETTINGS = ('clients', 'legacy_ratio', 'senders', 'rate', 'duration', 'message_size',
+                 'file_size', 'downloaders', 'server_args')
+
+# Metrics shown by --compare, and whether a higher value is better
+SUMMARY = [
+    ('connections', 'connected', True),
+    ('connections', 'connects_per_sec', True),
+    ('connections', 'server_kb_per_connection', False),
+    ('messaging', 'delivered_per_sec', True),
+    ('messaging', 'merged', False),
+    ('messaging', 'p50_ms', False),
+    ('messaging', 'p99_ms', False),
+    ('messaging', 'p999_ms', False),
+    ('files', 'throughput_mb_s', True),
+]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def server_rss_kb(pid):
+    """Resident memory of a process in KB, or None where /proc is missing."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Stats:
+    """Measurements shared by all synthetic clients."""
+
+    def __init__(self):
+        self.recording = False
+        self.latencies = []
+        self.merged = 0
+        self.file_done = []
+
+
+class RecvReader(asyncio.StreamReader):
+    """StreamReader that hands each chunk read from the socket to `on_recv`
+    once it is set, instead of buffering it. The transport calls feed_data
+    once per recv(), so a legacy client sees the same message boundaries
+    as client.py does."""
+
+    on_recv = None
+
+    def feed_data(self, data):
+        if self.on_recv is None:
+            super().feed_data(data)
+        else:
+            self.on_recv(data)
+
+
+class SyntheticClient:
+    def __init__(self, nickname, legacy, stats):
+        self.nickname = nickname
+        self.legacy = legacy
+        self.stats = stats
+        self.reader = None
+        self.writer = None
+        self.task = None
+        self.decoder = FrameDecoder()
+        self.names = {}
+        # File phase: bytes expected and received, and whether to download
+        self.file_expected = None
+        self.file_received = 0
+        self.file_start = None
+        self.downloader = False
+
+    async def connect(self, port, timeout):
+        """Open the connection and do the NICK handshake."""
+        loop = asyncio.get_running_loop()
+        self.reader = RecvReader()
+        protocol = asyncio.StreamReaderProtocol(self.reader)
+        transport, _ = await asyncio.wait_for(
+            loop.create_connection(lambda: protocol, '127.0.0.1', port), timeout)
+        self.writer = asyncio.StreamWriter(transport, protocol, self.reader, loop)
+        prompt = await asyncio.wait_for(self.reader.readexactly(4), timeout)
+        if prompt != b'NICK':
+            raise ConnectionError(f"unexpected prompt {prompt!r}")
+        if self.legacy:
+            self.writer.write(self.nickname.encode('utf-8'))
+            self.reader.on_recv = self.feed_legacy
+        else:
+            self.writer.write(encode_hello(self.nickname))
+            ack = await asyncio.wait_for(self.reader.readexactly(len(HELLO_PREFIX) + 1), timeout)
+            if parse_hello_ack(ack)[0] is None:
+                raise ConnectionError("server did not accept framing")
+        await self.writer.drain()
+        self.task = asyncio.ensure_future(self.read_loop())
+
+    async def read_loop(self):
+        try:
+            while True:
+                data = await self.reader.read(256 * 1024)
+                if not data:
+                    return
+                if self.legacy:
+                    self.feed_legacy(data)
+                else:
+                    for msg_type, payload in self.decoder.feed(data):
+                        self.handle_frame(msg_type, payload)
+        except (ConnectionError, OSError, asyncio.CancelledError):
+            pass
+
+    def feed_legacy(self, data):
+        """Handle one recv() worth of the legacy text stream."""
+        if self.file_expected is not None:
+            # Quiet during the file phase: everything is the file
+            self.count_file_bytes(len(data))
+            return
+        if not self.stats.recording:
+            return
+        stamps = STAMP.findall(data.decode('utf-8', errors='replace'))
+        if stamps:
+            # client.py shows the whole recv() as the first message
+            self.stats.latencies.append(time.perf_counter() - float(stamps[0]))
+            self.stats.merged += len(stamps) - 1
+
+    def handle_frame(self, msg_type, payload):
+        if msg_type == MSG_COMPRESSED:
+            msg_type, payload = decompress_frame(payload)
+        if msg_type == MSG_NAME:
+            name_id, name = parse_name(payload)
+            self.names[name_id] = name
+        elif msg_type == MSG_COMPACT_EVENT:
+            event = decode_compact_event(payload, self.names)
+            if self.stats.recording:
+                match = STAMP.match(event['text'])
+                if match:
+                    self.stats.latencies.append(time.perf_counter() - float(match.group(1)))
+        elif msg_type == MSG_FILE_META and self.downloader:
+            meta = decode_json(payload)
+            self.send(MSG_BLOB_REQUEST, encode_json({'hash': meta['hash'], 'name': meta['name'],
+                                                     'offset': 0, 'length': meta['size'], 'id': 1}))
+        elif msg_type == MSG_TRANSFER_CHUNK and self.file_expected is not None:
+            _, _, data = parse_chunk(payload, checked=True)
+            self.count_file_bytes(len(data))
+
+    def count_file_bytes(self, count):
+        self.file_received += count
+        if self.file_received >= self.file_expected and self.file_start is not None:
+            self.stats.file_done.append(time.perf_counter() - self.file_start)
+            self.file_start = None
+
+    def send(self, msg_type, payload):
+        self.writer.write(encode_frame(msg_type, payload))
+
+    def say(self, text):
+        if self.legacy:
+            self.writer.write(f"{self.nickname}: {text}".encode('utf-8'))
+        else:
+            self.send(MSG_SAY, text.encode('utf-8'))
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+
+async def connect_clients(port, stats, args):
+    """Phase 1: connect every client, at most --connect-concurrency at a time."""
+    legacy_count = int(args.clients * args.legacy_ratio)
+    clients = [SyntheticClient(f"load{i}", i < legacy_count, stats) for i in range(args.clients)]
+    semaphore = asyncio.Semaphore(args.connect_concurrency)
+    times = []
+
+    async def connect(client):
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await client.connect(port, args.connect_timeout)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                return False
+            times.append(time.perf_counter() - start)
+            return True
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(connect(client) for client in clients))
+    elapsed = time.perf_counter() - start
+    connected = [client for client, ok in zip(clients, results) if ok]
+    times.sort()
+    return connected, {
+        'requested': args.clients,
+        'connected': len(connected),
+        'failed': args.clients - len(connected),
+        'seconds': elapsed,
+        'connects_per_sec': len(connected) / elapsed if elapsed else None,
+        'handshake_p50_ms': _ms(percentile(times, 0.5)),
+        'handshake_p99_ms': _ms(percentile(times, 0.99)),
+    }
+
+
+async def run_messaging(clients, stats, args):
+    """Phase 2: --senders clients chat at --rate for --duration seconds."""
+    # Picked evenly, so legacy clients send their share
+    senders = clients[::max(1, len(clients) // args.senders)][:args.senders]
+    padding = 'x' * max(0, args.message_size - 24)
+    sent = 0
+
+    async def chat(number, client):
+        nonlocal sent
+        interval = 1 / args.rate
+        deadline = time.perf_counter() + args.duration
+        # Spread the senders over the first interval
+        next_time = time.perf_counter() + interval * number / len(senders)
+        while next_time < deadline:
+            await asyncio.sleep(max(0, next_time - time.perf_counter()))
+            client.say(f"t={time.perf_counter():.6f}; {padding}")
+            sent += 1
+            next_time += interval
+
+    stats.latencies = []
+    stats.merged = 0
+    stats.recording = True
+    start = time.perf_counter()
+    await asyncio.gather(*(chat(number, client) for number, client in enumerate(senders)))
+    expected = sent * (len(clients) - 1)
+    drain_deadline = time.perf_counter() + args.drain
+    while (len(stats.latencies) + stats.merged < expected
+           and time.perf_counter() < drain_deadline):
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - start
+    stats.recording = False
+
+    latencies = sorted(stats.latencies)
+    return {
+        'senders': len(senders),
+        'sent': sent,
+        'expected_deliveries': expected,
+        'delivered': len(latencies),
+        'merged': stats.merged,
+        'lost': expected - len(latencies) - stats.merged,
+        'seconds': elapsed,
+        'delivered_per_sec': len(latencies) / elapsed if elapsed else None,
+        'p50_ms': _ms(percentile(latencies, 0.5)),
+        'p99_ms': _ms(percentile(latencies, 0.99)),
+        'p999_ms': _ms(percentile(latencies, 0.999)),
+        'max_ms': _ms(latencies[-1] if latencies else None),
+    }
+
+
+async def run_file_relay(port, clients, stats, args):
+    """Phase 3: upload a file on the legacy "FILE:" path and time its
+    arrival at the legacy clients and the framed downloaders."""
+    size = int(args.file_size * 1024 * 1024)
+    uploader = SyntheticClient('uploader', True, stats)
+    await uploader.connect(port, args.connect_timeout)
+    # Let the join notice reach everyone before counting file bytes
+    await asyncio.sleep(1)
+
+    header = f"FILE:load.bin:{size}:uploader"
+    receivers = []
+    downloaders = 0
+    for client in clients:
+        if client.legacy:
+            client.file_expected = len(header) + size
+        elif downloaders < args.downloaders:
+            client.downloader = True
+            client.file_expected = size
+            downloaders += 1
+        else:
+            continue
+        client.file_received = 0
+        receivers.append(client)
+    stats.file_done = []
+
+    uploader.writer.write(header.encode('utf-8'))
+    await uploader.writer.drain()
+    # The server reads the header as one message
+    await asyncio.sleep(0.2)
+    start = time.perf_counter()
+    for client in receivers:
+        client.file_start = start
+    data = os.urandom(1024 * 1024)
+    remaining = size
+    while remaining > 0:
+        uploader.writer.write(data[:min(len(data), remaining)])
+        remaining -= min(len(data), remaining)
+        await uploader.writer.drain()
+    uploaded = time.perf_counter() - start
+
+    deadline = time.perf_counter() + args.file_timeout
+    while len(stats.file_done) < len(receivers) and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - start
+    uploader.close()
+
+    done = sorted(stats.file_done)
+    received = sum(min(client.file_received, client.file_expected) for client in receivers)
+    for client in receivers:
+        client.file_expected = None
+        client.downloader = False
+    return {
+        'file_bytes': size,
+        'legacy_receivers': len(receivers) - downloaders,
+        'downloaders': downloaders,
+        'completed': len(done),
+        'upload_seconds': uploaded,
+        'seconds': elapsed,
+        'throughput_mb_s': received / elapsed / (1024 * 1024) if elapsed else None,
+        'per_receiver_p50_s': percentile(done, 0.5),
+        'per_receiver_max_s': done[-1] if done else None,
+    }
+
+
+def _ms(seconds):
+    return None if seconds is None else seconds * 1000
+
+
+def start_server(engine, port, directory, extra_args):
+    log = open(os.path.join(directory, 'server.log'), 'wb')
+    command = [sys.executable, os.path.join(ROOT, 'server.py'), '--host', '127.0.0.1',
+               '--port', str(port), '--engine', engine,
+               '--log-dir', os.path.join(directory, 'logs'),
+               '--blob-store', os.path.join(directory, 'blobs'),
+               '--history-dir', os.path.join(directory, 'history')] + extra_args
+    return subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT), log
+
+
+async def wait_for_port(port, proc, timeout=10):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"server exited with status {proc.returncode}")
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError("server did not start listening")
+
+
+async def run_engine(engine, args):
+    directory = tempfile.mkdtemp(prefix='loadgen-')
+    port = free_port()
+    proc, log = start_server(engine, port, directory, shlex.split(args.server_args))
+    stats = Stats()
+    clients = []
+    try:
+        await wait_for_port(port, proc)
+        # The probe connection above has come and gone
+        await asyncio.sleep(0.5)
+        idle_kb = server_rss_kb(proc.pid)
+        clients, connections = await connect_clients(port, stats, args)
+        await asyncio.sleep(args.settle)
+        loaded_kb = server_rss_kb(proc.pid)
+        if idle_kb is not None and loaded_kb is not None and clients:
+            connections['server_rss_idle_kb'] = idle_kb
+            connections['server_rss_loaded_kb'] = loaded_kb
+            connections['server_kb_per_connection'] = (loaded_kb - idle_kb) / len(clients)
+        result = {'connections': connections}
+        print(f"  connections: {connections['connected']}/{connections['requested']} "
+              f"in {connections['seconds']:.2f}s", flush=True)
+        if clients and args.senders:
+            result['messaging'] = await run_messaging(clients, stats, args)
+            print(f"  messaging: {result['messaging']['delivered']}/"
+                  f"{result['messaging']['expected_deliveries']} delivered, "
+                  f"{result['messaging']['merged']} merged", flush=True)
+        if clients and args.file_size > 0:
+            result['files'] = await run_file_relay(port, clients, stats, args)
+            print(f"  files: {result['files']['completed']}/"
+                  f"{result['files']['legacy_receivers'] + result['files']['downloaders']} "
+                  f"receivers done", flush=True)
+        return result
+    except RuntimeError:
+        log.flush()
+        with open(os.path.join(directory, 'server.log'), 'rb') as f:
+            sys.stderr.write(f.read()[-2000:].decode('utf-8', errors='replace'))
+        raise
+    finally:
+        for client in clients:
+            client.close()
+        proc.terminate()
+        try:
+            proc.wait(10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        log.close()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def print_results(runs):
+    for section, metric, _ in SUMMARY:
+        row = f"{section + '.' + metric:<38}"
+        for engine in runs:
+            value = runs[engine].get(section, {}).get(metric)
+            row += f" {_format(value):>12}"
+        print(row)
+
+
+def print_comparison(runs, config, previous):
+    print(f"\nchange against {previous['created']} ({', '.join(previous['runs'])})")
+    changed = [key for key in LOAD_SETTINGS if previous['config'].get(key) != config.get(key)]
+    if changed:
+        print(f"note: the runs differ in {', '.join('--' + key.replace('_', '-') for key in changed)}")
+    for engine, result in runs.items():
+        old = previous['runs'].get(engine)
+        if old is None:
+            continue
+        print(engine)
+        for section, metric, higher_is_better in SUMMARY:
+            before = old.get(section, {}).get(metric)
+            after = result.get(section, {}).get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            better = (change > 0) == higher_is_better
+            verdict = 'better' if better and abs(change) > 0.05 else 'worse' if abs(change) > 0.05 else ''
+            print(f"  {section + '.' + metric:<36} {_format(before):>12} -> {_format(after):>12} "
+                  f"{change:>+8.1%} {verdict}")
+
+
+def _format(value):
+    if value is None:
+        return '-'
+    if isinstance(value, float):
+        return f"{value:.2f}"
+    return str(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--engines', nargs='+', choices=('threaded', 'asyncio'),
+                        default=['threaded', 'asyncio'])
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--legacy-ratio', type=float, default=0.1,
+                        help="fraction of clients on the legacy text protocol")
+    parser.add_argument('--connect-concurrency', type=int, default=100,
+                        help="handshakes in progress at once")
+    parser.add_argument('--connect-timeout', type=float, default=10)
+    parser.add_argument('--settle', type=float, default=2,
+                        help="seconds to wait after connecting, for join notices to go out")
+    parser.add_argument('--senders', type=int, default=10)
+    parser.add_argument('--rate', type=float, default=5, help="messages per second per sender")
+    parser.add_argument('--duration', type=float, default=10, help="seconds of chatting")
+    parser.add_argument('--message-size', type=int, default=64)
+    parser.add_argument('--drain', type=float, default=10,
+                        help="seconds to wait for deliveries after the last message")
+    parser.add_argument('--file-size', type=float, default=8, help="MB to upload (0: skip)")
+    parser.add_argument('--downloaders', type=int, default=10,
+                        help="framed clients that download the uploaded file")
+    parser.add_argument('--file-timeout', type=float, default=60)
+    parser.add_argument('--server-args', default='', help="extra arguments for server.py")
+    parser.add_argument('--output', default='loadgen.json', help="file to save the results to")
+    parser.add_argument('--compare', help="earlier result file to compare with")
+    args = parser.parse_args()
+
+    raise_open_file_limit()
+    runs = {}
+    for engine in args.engines:
+        print(f"{engine} engine", flush=True)
+        runs[engine] = asyncio.run(run_engine(engine, args))
+
+    results = {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': vars(args),
+        'runs': runs,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+
+    print(f"\n{'metric':<38}" + ''.join(f" {engine:>12}" for engine in runs))
+    print_results(runs)
+    print(f"\nsaved to {args.output}")
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            print_comparison(runs, results['config'], json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+# benchmarks/markup.py
+"""Microbenchmark: time to render 1000 chat messages with formatting.
+
+Compares the client's previous renderer, which split each message on
+``**``, ``*`` and ``_`` in three nested loops and inserted every fragment
+separately, with markup.parse_markup and one insert per message, with the
+parse cache cold and warm. By default inserts go to a stand-in widget that
+only counts them, so only the Python side is measured; with --tk (needs a
+display) they go to a real tkinter Text widget.
+
+    python benchmarks/markup.py
+    python benchmarks/markup.py --messages 5000 --formatted-ratio 0.3 --tk
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from markup import insert_args, parse_markup  # noqa: E402
+
+WORDS = ['hello', 'meeting', 'at', 'noon', 'snake_case', 'file', 'ok', 'see', 'you', '2*3', 'the', 'report']
+
+
+class CountingText:
+    """Stands in for tkinter.Text: counts insert calls."""
+
+    def __init__(self):
+        self.inserts = 0
+
+    def insert(self, index, *args):
+        self.inserts += 1
+
+    def delete(self, first, last=None):
+        pass
+
+
+def make_messages(count, formatted_ratio, seed=1):
+    rng = random.Random(seed)
+    messages = []
+    for i in range(count):
+        words = [rng.choice(WORDS) for _ in range(rng.randint(3, 12))]
+        if rng.random() < formatted_ratio:
+            j = rng.randrange(len(words))
+            words[j] = rng.choice(['**{}**', '*{}*', '_{}_']).format(words[j])
+        messages.append(f"[12:00:{i % 60:02d}] user{i % 7}: {' '.join(words)}")
+    return messages
+
+
+def split_render(text_area, message, bubble_tag='bubble_other'):
+    """The previous renderer."""
+    if '**' in message or '*' in message or '_' in message:
+        text_area.insert('end', '\n')
+        parts = message.split('**')
+        is_bold = False
+        for part in parts:
+            italic_parts = part.split('*')
+            is_italic = False
+            for ip in italic_parts:
+                underline_parts = ip.split('_')
+                is_underline = False
+                for up in underline_parts:
+                    tags = [bubble_tag]
+                    if is_bold: tags.append('bold')
+                    if is_italic: tags.append('italic')
+                    if is_underline: tags.append('underline')
+                    text_area.insert('end', up, ' '.join(tags) if tags else bubble_tag)
+                    is_underline = not is_underline
+                is_italic = not is_italic
+            is_bold = not is_bold
+        text_area.insert('end', '\n')
+    else:
+        text_area.insert('end', f'\n{message}\n', bubble_tag)
+
+
+def run_render(text_area, message, bubble_tag='bubble_other'):
+    """The current renderer."""
+    text_area.insert('end', '\n', bubble_tag, *insert_args(parse_markup(message), bubble_tag), '\n', bubble_tag)
+
+
+def measure(render, text_area, messages):
+    """Return (ms per 1000 messages, insert calls per message)."""
+    before = getattr(text_area, 'inserts', 0)
+    start = time.perf_counter()
+    for message in messages:
+        render(text_area, message)
+    elapsed = time.perf_counter() - start
+    text_area.delete('1.0', 'end')
+    inserts = getattr(text_area, 'inserts', before) - before
+    return elapsed / len(messages) * 1e6, inserts / len(messages)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--formatted-ratio', type=float, default=0.2,
+                        help="fraction of messages with formatting markers")
+    parser.add_argument('--tk', action='store_true', help="insert into a real tkinter Text widget")
+    args = parser.parse_args()
+
+    messages = make_messages(args.messages, args.formatted_ratio)
+    if args.tk:
+        import tkinter
+        root = tkinter.Tk()
+        text_area = tkinter.Text(root)
+        text_area.pack()
+    else:
+        text_area = CountingText()
+
+    results = [('nested split', measure(split_render, text_area, messages))]
+    parse_markup.cache_clear()
+    results.append(('single pass, cold cache', measure(run_render, text_area, messages)))
+    results.append(('single pass, warm cache', measure(run_render, text_area, messages)))
+
+    print(f"{'renderer':<24} {'ms per 1k msgs':>15} {'inserts/msg':>12}")
+    for name, (ms, inserts) in results:
+        calls = f"{inserts:.2f}" if not args.tk else '-'
+        print(f"{name:<24} {ms:>15.2f} {calls:>12}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+# benchmarks/wire.py
+"""Microbenchmark: bytes on the wire and encode/decode CPU per chat message.
+
+Encodes the same stream of chat events in each format the server can send
+them in: a "[HH:MM:SS] nickname: text" MSG_TEXT line (clients before
+ENVELOPE_VERSION), a JSON MSG_EVENT envelope, and a binary
+MSG_COMPACT_EVENT with interned names, whose MSG_NAME announcements are
+counted too. Decoding includes reassembling the frames. A page of history,
+the largest frame in normal chat, is measured as JSON with and without
+compression, and the client's outgoing line as MSG_TEXT and MSG_SAY.
+
+    python benchmarks/wire.py
+    python benchmarks/wire.py --messages 50000 --senders 200 --rooms 10 --words 20
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from protocol import (  # noqa: E402
+    DEFAULT_ROOM, EVENT_CHAT, MSG_COMPACT_EVENT, MSG_EVENT, MSG_HISTORY, MSG_NAME, MSG_SAY,
+    MSG_TEXT, FrameDecoder, NameTable, compress_frame, decode_compact_event, decode_json,
+    decompress_frame, encode_compact_event, encode_frame, encode_json, encode_name, event_line,
+    make_event, parse_name,
+)
+
+WORDS = ['hello', 'meeting', 'at', 'noon', 'is', 'the', 'report', 'ready', 'ok', 'see', 'you',
+         'tomorrow', 'thanks', 'lunch', 'deploy', 'build', 'failed', 'again', 'fixed', 'now']
+
+
+def make_events(count, senders, rooms, words, seed=1):
+    rng = random.Random(seed)
+    rooms = [DEFAULT_ROOM] + [f"room{i}" for i in range(1, rooms)]
+    start = time.time()
+    events = []
+    for i in range(count):
+        text = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 2 * words)))
+        events.append(make_event(EVENT_CHAT, text, f"user{rng.randrange(senders)}",
+                                 rng.choice(rooms), i + 1, start + i * 0.5))
+    return events
+
+
+def encode_text(events):
+    return [encode_frame(MSG_TEXT, event_line(event).encode('utf-8')) for event in events]
+
+
+def encode_envelope(events):
+    return [encode_frame(MSG_EVENT, encode_json(event)) for event in events]
+
+
+def encode_compact(events):
+    """As the server sends them to one client: each name announced once."""
+    table = NameTable()
+    known = set()
+    frames = []
+    for event in events:
+        data = encode_frame(MSG_COMPACT_EVENT, encode_compact_event(event, table.intern))
+        for name in (event['sender'], event['room']):
+            name_id = table.intern(name)
+            if name_id not in known:
+                known.add(name_id)
+                data = encode_frame(MSG_NAME, encode_name(name_id, name)) + data
+        frames.append(data)
+    return frames
+
+
+def decode(stream):
+    names = {}
+    for msg_type, payload in FrameDecoder().feed(stream):
+        if msg_type == MSG_TEXT:
+            payload.decode('utf-8')
+        elif msg_type == MSG_EVENT:
+            decode_json(payload)
+        elif msg_type == MSG_NAME:
+            name_id, name = parse_name(payload)
+            names[name_id] = name
+        elif msg_type == MSG_COMPACT_EVENT:
+            decode_compact_event(payload, names)
+
+
+def measure(encode, events):
+    """Return (bytes per message, encode us per message, decode us per message)."""
+    start = time.process_time()
+    frames = encode(events)
+    encoded = time.process_time() - start
+    stream = b''.join(frames)
+    start = time.process_time()
+    decode(stream)
+    decoded = time.process_time() - start
+    count = len(events)
+    return len(stream) / count, encoded / count * 1e6, decoded / count * 1e6
+
+
+def measure_page(events, page_size, repeat=200):
+    """Bytes and encode/decode us of one history page, plain and compressed."""
+    page = encode_json({'room': DEFAULT_ROOM, 'more': True, 'messages': [
+        {'id': event['id'], 'time': event['time'], 'text': f"{event['sender']}: {event['text']}"}
+        for event in events[:page_size]]})
+    results = []
+    for name, encode in (('plain', lambda: encode_frame(MSG_HISTORY, page)),
+                         ('zlib', lambda: compress_frame(MSG_HISTORY, page))):
+        start = time.process_time()
+        for _ in range(repeat):
+            frame = encode()
+        encoded = (time.process_time() - start) / repeat * 1e6
+        start = time.process_time()
+        for _ in range(repeat):
+            (msg_type, payload), = FrameDecoder().feed(frame)
+            if name == 'zlib':
+                msg_type, payload = decompress_frame(payload)
+            decode_json(payload)
+        decoded = (time.process_time() - start) / repeat * 1e6
+        results.append((name, len(frame), encoded, decoded))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--senders', type=int, default=50)
+    parser.add_argument('--rooms', type=int, default=5)
+    parser.add_argument('--words', type=int, default=8, help="average words per message")
+    parser.add_argument('--page-size', type=int, default=50, help="messages per history page")
+    args = parser.parse_args()
+
+    events = make_events(args.messages, args.senders, args.rooms, args.words)
+    print(f"{args.messages} chat messages, {args.senders} senders, {args.rooms} rooms")
+    print(f"{'format':<16} {'bytes/msg':>10} {'encode us':>10} {'decode us':>10}")
+    baseline = None
+    for name, encode in (('text line', encode_text), ('json envelope', encode_envelope),
+                         ('compact', encode_compact)):
+        size, encoded, decoded = measure(encode, events)
+        baseline = baseline or size
+        print(f"{name:<16} {size:>10.1f} {encoded:>10.2f} {decoded:>10.2f}   {size / baseline:.0%} of text")
+
+    print(f"\nhistory page of {args.page_size} messages")
+    print(f"{'format':<16} {'bytes':>10} {'encode us':>10} {'decode us':>10}")
+    for name, size, encoded, decoded in measure_page(events, args.page_size):
+        print(f"{name:<16} {size:>10} {encoded:>10.1f} {decoded:>10.1f}")
+
+    sent_text = sum(len(encode_frame(MSG_TEXT, f"{e['sender']}: {e['text']}".encode('utf-8'))) for e in events)
+    sent_say = sum(len(encode_frame(MSG_SAY, e['text'].encode('utf-8'))) for e in events)
+    print(f"\nclient to server: {sent_text / len(events):.1f} bytes/msg as MSG_TEXT, "
+          f"{sent_say / len(events):.1f} as MSG_SAY")
+
+
+if __name__ == "__main__":
+    main()
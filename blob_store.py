@@ -0,0 +1,276 @@
+# blob_store.py
+"""Content-addressed file store used by the server for shared files.
+
+Blobs are named by the SHA-256 of their content and sharded into two
+directory levels (``ab/cd/abcd...``) so no directory grows too large. The
+store is bounded in size; when it is full the least recently used blobs
+are evicted, except those currently being sent to a client.
+
+Uploads whose hash was announced in advance are written to
+``partial/<digest>`` instead of an anonymous temporary file, so an
+interrupted upload can be resumed where it stopped. Partial files do not
+count against the size limit and are removed after PARTIAL_MAX_AGE.
+"""
+import collections
+import hashlib
+import logging
+import os
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+HASH_NAME = 'sha256'
+
+# Seconds an interrupted upload is kept for resuming
+PARTIAL_MAX_AGE = 24 * 60 * 60
+
+
+def is_valid_digest(digest):
+    """Check that a client-supplied digest is a lowercase hex SHA-256."""
+    return (isinstance(digest, str) and len(digest) == 64
+            and all(c in '0123456789abcdef' for c in digest))
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    """Hash a file on disk without loading it into memory."""
+    h = hashlib.new(HASH_NAME)
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class BlobWriter:
+    """Receives one blob into a temporary file, hashing it on the way.
+
+    A writer for an announced digest keeps its data in the partial file of
+    that digest and continues after the first `offset` bytes already there.
+    """
+
+    def __init__(self, store, partial_digest=None, offset=0):
+        self.store = store
+        self.partial_digest = partial_digest
+        self.hash = hashlib.new(HASH_NAME)
+        self.size = 0
+        if partial_digest is None:
+            self.temp_path = os.path.join(store.temp_dir, uuid.uuid4().hex)
+            self.file = open(self.temp_path, 'wb')
+            return
+
+        self.temp_path = store.partial_path(partial_digest)
+        self.file = open(self.temp_path, 'r+b' if offset else 'wb')
+        try:
+            # Rebuild the hash state from the bytes kept last time
+            while self.size < offset:
+                chunk = self.file.read(min(1024 * 1024, offset - self.size))
+                if not chunk:
+                    raise ValueError(f"Only {self.size} bytes of {partial_digest} to resume from")
+                self.hash.update(chunk)
+                self.size += len(chunk)
+            self.file.truncate(offset)
+            self.file.seek(offset)
+        except Exception:
+            self.file.close()
+            raise
+
+    def write(self, data):
+        self.file.write(data)
+        self.hash.update(data)
+        self.size += len(data)
+
+    def digest(self):
+        """Digest of everything written so far."""
+        return self.hash.hexdigest()
+
+    def commit(self):
+        """Move the blob into the store and return its digest."""
+        self.file.close()
+        digest = self.hash.hexdigest()
+        self.store._add(digest, self.temp_path, self.size)
+        self.store._writer_done(self)
+        return digest
+
+    def discard(self):
+        self.file.close()
+        try:
+            os.remove(self.temp_path)
+        except OSError:
+            pass
+        self.store._writer_done(self)
+
+    def suspend(self):
+        """Stop writing but keep a partial file to resume from later."""
+        if self.partial_digest is None:
+            self.discard()
+            return
+        self.file.close()
+        self.store._writer_done(self)
+
+
+class BlobStore:
+    def __init__(self, root='blobs', max_bytes=1024 * 1024 * 1024):
+        """Open (or create) a store under `root` holding at most `max_bytes`."""
+        self.root = root
+        self.max_bytes = max_bytes
+        self.temp_dir = os.path.join(root, 'tmp')
+        self.partial_dir = os.path.join(root, 'partial')
+        self.lock = threading.Lock()
+        # digest -> size, least recently used first
+        self.blobs = collections.OrderedDict()
+        self.total_bytes = 0
+        # digest -> number of readers that must not see it evicted
+        self.pins = collections.Counter()
+        # Digests whose partial file has a writer open
+        self.writing = set()
+
+        os.makedirs(self.temp_dir, exist_ok=True)
+        os.makedirs(self.partial_dir, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        """Index the blobs already on disk, oldest access first."""
+        # Leftovers from uploads interrupted by a restart
+        for name in os.listdir(self.temp_dir):
+            try:
+                os.remove(os.path.join(self.temp_dir, name))
+            except OSError:
+                pass
+
+        # Uploads nobody came back to resume
+        expired = time.time() - PARTIAL_MAX_AGE
+        for name in os.listdir(self.partial_dir):
+            path = os.path.join(self.partial_dir, name)
+            try:
+                if os.stat(path).st_mtime < expired:
+                    os.remove(path)
+            except OSError:
+                pass
+
+        skip = {os.path.abspath(self.temp_dir), os.path.abspath(self.partial_dir)}
+        found = []
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            if os.path.abspath(dirpath) in skip:
+                dirnames[:] = []
+                continue
+            for name in filenames:
+                if is_valid_digest(name):
+                    stat = os.stat(os.path.join(dirpath, name))
+                    found.append((stat.st_mtime, name, stat.st_size))
+        for _, digest, size in sorted(found):
+            self.blobs[digest] = size
+            self.total_bytes += size
+        logger.info(f"Blob store {self.root}: {len(self.blobs)} files, {self.total_bytes} bytes")
+
+    def path_for(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def partial_path(self, digest):
+        return os.path.join(self.partial_dir, digest)
+
+    def writer(self, expected_hash=None, offset=0):
+        """Start receiving a new blob. If its hash is known the data goes to
+        a resumable partial file, continuing after `offset` bytes kept from
+        an earlier attempt (ValueError if there are not that many)."""
+        with self.lock:
+            resumable = is_valid_digest(expected_hash) and expected_hash not in self.writing
+            if resumable:
+                self.writing.add(expected_hash)
+        if not resumable:
+            if offset:
+                raise ValueError("Nothing to resume from")
+            return BlobWriter(self)
+        try:
+            return BlobWriter(self, expected_hash, offset)
+        except Exception:
+            with self.lock:
+                self.writing.discard(expected_hash)
+            raise
+
+    def partial_size(self, digest):
+        """Bytes of an interrupted upload of `digest` that can be resumed."""
+        with self.lock:
+            if not is_valid_digest(digest) or digest in self.writing:
+                return 0
+        try:
+            return os.path.getsize(self.partial_path(digest))
+        except OSError:
+            return 0
+
+    def _writer_done(self, writer):
+        if writer.partial_digest is not None:
+            with self.lock:
+                self.writing.discard(writer.partial_digest)
+
+    def has(self, digest):
+        """Whether the blob is stored; counts as a use for LRU purposes."""
+        with self.lock:
+            if digest not in self.blobs:
+                return False
+            self._touch(digest)
+            return True
+
+    def size_of(self, digest):
+        with self.lock:
+            return self.blobs.get(digest)
+
+    def acquire(self, digest):
+        """Pin a blob while it is being read. Returns its path, or None if
+        the blob is not stored."""
+        with self.lock:
+            if digest not in self.blobs:
+                return None
+            self.pins[digest] += 1
+            self._touch(digest)
+            return self.path_for(digest)
+
+    def release(self, digest):
+        with self.lock:
+            self.pins[digest] -= 1
+            if self.pins[digest] <= 0:
+                del self.pins[digest]
+            self._evict()
+
+    def _touch(self, digest):
+        self.blobs.move_to_end(digest)
+        try:
+            # Keep the on-disk order in step so LRU survives a restart
+            os.utime(self.path_for(digest))
+        except OSError:
+            pass
+
+    def _add(self, digest, temp_path, size):
+        path = self.path_for(digest)
+        with self.lock:
+            if digest in self.blobs:
+                # Same content uploaded again: keep the stored copy
+                os.remove(temp_path)
+                self._touch(digest)
+                return
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temp_path, path)
+            self.blobs[digest] = size
+            self.total_bytes += size
+            self._evict()
+
+    def _evict(self):
+        """Drop least recently used, unpinned blobs until under the limit."""
+        if self.total_bytes <= self.max_bytes:
+            return
+        newest = next(reversed(self.blobs))
+        for digest in list(self.blobs):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if self.pins[digest] or digest == newest:
+                # In use, or the blob that was just added
+                continue
+            size = self.blobs.pop(digest)
+            self.total_bytes -= size
+            try:
+                os.remove(self.path_for(digest))
+            except OSError as e:
+                logger.error(f"Error evicting blob {digest}: {e}")
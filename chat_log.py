@@ -0,0 +1,153 @@
+# chat_log.py
+"""Chat log written off the message path.
+
+ChatServer.log_message only appends a line to an in-memory ring buffer; a
+background thread writes the buffered lines to ``logs/chat_log_*.txt`` in
+batches, once `batch_size` lines are waiting or `flush_interval` seconds
+have passed. If the writer falls behind by more than `capacity` lines the
+oldest ones are dropped rather than slowing down delivery.
+
+The log is rotated to a new file once it reaches `max_bytes` or is
+`max_age` seconds old, and rotated files can be gzipped. close() writes
+out everything still buffered.
+"""
+import collections
+import datetime
+import gzip
+import logging
+import os
+import shutil
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ChatLog:
+    def __init__(self, directory='logs', batch_size=256, flush_interval=0.5, capacity=65536,
+                 max_bytes=10 * 1024 * 1024, max_age=None, compress=False):
+        """Start a log under `directory`. `max_bytes` / `max_age` of None
+        disable size / time based rotation."""
+        self.directory = directory
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.compress = compress
+
+        self.lines = collections.deque(maxlen=capacity)
+        self.cond = threading.Condition()
+        self.closed = False
+
+        # Counters
+        self.written_lines = 0
+        self.dropped_lines = 0
+        self.batches = 0
+        self.rotations = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self.path = None
+        self.file = None
+        self._open()
+
+        self.thread = threading.Thread(target=self._writer_loop, daemon=True)
+        self.thread.start()
+
+    def write(self, line):
+        """Queue one line. Never blocks on disk I/O."""
+        with self.cond:
+            if self.closed:
+                return
+            if len(self.lines) == self.lines.maxlen:
+                self.dropped_lines += 1
+            self.lines.append(line)
+            if len(self.lines) >= self.batch_size:
+                self.cond.notify()
+
+    def close(self):
+        """Write out the buffered lines and stop the writer."""
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.cond.notify()
+        self.thread.join()
+
+    def stats(self):
+        with self.cond:
+            return {
+                'path': self.path,
+                'buffered_lines': len(self.lines),
+                'written_lines': self.written_lines,
+                'dropped_lines': self.dropped_lines,
+                'batches': self.batches,
+                'rotations': self.rotations,
+            }
+
+    def _open(self):
+        timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+        path = os.path.join(self.directory, f"chat_log_{timestamp}.txt")
+        n = 1
+        while os.path.exists(path) or os.path.exists(path + '.gz'):
+            # Rotated more than once within a second
+            n += 1
+            path = os.path.join(self.directory, f"chat_log_{timestamp}_{n}.txt")
+        self.path = path
+        self.file = open(path, 'a', encoding='utf-8')
+        self.opened_at = time.monotonic()
+        self.size = 0
+
+    def _writer_loop(self):
+        while True:
+            with self.cond:
+                if not self.closed and len(self.lines) < self.batch_size:
+                    self.cond.wait(self.flush_interval)
+                batch = list(self.lines)
+                self.lines.clear()
+                closing = self.closed
+
+            if batch:
+                self._write_batch(batch)
+            if self._should_rotate():
+                self._rotate()
+            if closing:
+                self.file.close()
+                return
+
+    def _write_batch(self, batch):
+        data = '\n'.join(batch) + '\n'
+        try:
+            self.file.write(data)
+            self.file.flush()
+        except Exception as e:
+            logger.error(f"Error logging message: {e}")
+            return
+        self.size += len(data)
+        with self.cond:
+            self.written_lines += len(batch)
+            self.batches += 1
+
+    def _should_rotate(self):
+        if not self.size:
+            return False
+        if self.max_bytes is not None and self.size >= self.max_bytes:
+            return True
+        return self.max_age is not None and time.monotonic() - self.opened_at >= self.max_age
+
+    def _rotate(self):
+        """Start a new log file, compressing the old one if configured."""
+        old_path = self.path
+        try:
+            self.file.close()
+            self._open()
+        except Exception as e:
+            logger.error(f"Error rotating chat log: {e}")
+            return
+        self.rotations += 1
+        if self.compress:
+            try:
+                with open(old_path, 'rb') as src, gzip.open(old_path + '.gz', 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+                os.remove(old_path)
+            except Exception as e:
+                logger.error(f"Error compressing {old_path}: {e}")
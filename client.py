@@ -6,6 +6,52 @@ from tkinter import filedialog, simpledialog, ttk, messagebox
 import sys
 import datetime
 import os
+import collections
+import itertools
+import json
+import shutil
+import tempfile
+import time
+
+from blob_store import file_digest
+from local_history import LocalHistory
+from markup import insert_args, parse_markup
+from protocol import (
+    MSG_TEXT, MSG_FILE_HEADER, MSG_FILE_DATA, MSG_FILE_ABORT, MSG_FILE_OFFER, MSG_FILE_NEED,
+    MSG_BLOB_REQUEST, MSG_FILE_META, MSG_BLOB_RANGE,
+    MSG_TRANSFER_BEGIN, MSG_TRANSFER_CHUNK, MSG_TRANSFER_ABORT, MSG_HISTORY_REQUEST, MSG_HISTORY,
+    MSG_EVENT, MSG_COMPACT_EVENT, MSG_NAME, MSG_SAY, MSG_OPTIONS, MSG_COMPRESSED, MSG_NICKNAME,
+    MULTIPLEX_VERSION, PULL_ATTACHMENTS_VERSION, RESUMABLE_VERSION, HISTORY_VERSION, COMPACT_VERSION,
+    EVENT_CHAT, EVENT_DM, EVENT_JOIN, EVENT_LEAVE, EVENT_SYSTEM, COMPRESS_ABOVE,
+    ChecksumError, FrameDecoder, decode_compact_event, decode_json, decompress_frame, encode_chunk,
+    encode_frame, encode_hello, encode_json, event_line, parse_chunk, parse_hello_ack, parse_name,
+)
+
+# Size of the file data frames sent by the sender thread. Chat messages
+# wait for at most one chunk of an upload.
+UPLOAD_CHUNK_SIZE = 16 * 1024
+
+# Times a damaged or interrupted transfer is resumed before giving up
+MAX_TRANSFER_RETRIES = 3
+
+# Messages (or lines of the local history file) loaded per page of
+# history; older pages are loaded when the chat is scrolled to the top
+HISTORY_PAGE_SIZE = 50
+
+# Messages kept in the chat area; older ones are dropped from it and read
+# back from the history when scrolled back to
+MAX_RENDERED_MESSAGES = 1000
+
+# How often (ms) the Tk thread shows what the network threads queued, and
+# the most queued items it handles at a time
+UI_TICK_MS = 30
+UI_BATCH_SIZE = 500
+
+# Most search results shown
+SEARCH_LIMIT = 200
+
+# Notifications that are not kept in the local history
+HISTORY_SKIP = ("joined the chat", "left the chat", "error:", "failed to", "could not")
 
 
 class ServerSelectionDialog:
@@ -199,6 +245,7 @@ class Client:
         self.loading_screen.window.update()
         
         # Initialize socket connection
+        self.host, self.port = host, port
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
             self.sock.connect((host, port))
@@ -210,7 +257,62 @@ class Client:
         # Initialize other variables
         self.gui_done = False
         self.running = True
-        self.history_file = "chat_history.txt"
+        # Segmented local history; an old chat_history.txt becomes its first segment
+        self.local_history = LocalHistory("chat_history", legacy_file="chat_history.txt")
+        # Id of the oldest server history message shown, and whether the
+        # server has older ones
+        self.oldest_history_id = None
+        self.more_history = False
+        # Position in the local history of the oldest line shown, None
+        # once there is nothing older
+        self.history_position = None
+        self.loading_history = False
+        # Messages and calls from other threads for the Tk thread, as
+        # (None, show_message args) or (func, args); see drain_ui_queue()
+        self.ui_queue = collections.deque()
+        # Messages in the chat area, top to bottom, as (mark, key): the mark
+        # is where the message starts, the key where the history keeps it,
+        # ('local', position) or ('server', id), or None if it does not
+        self.rendered = collections.deque()
+        self.prepended = None
+        self.mark_ids = itertools.count(1)
+        # Set when messages at the bottom were dropped while scrolled back;
+        # the latest ones are shown again on scrolling back down
+        self.newer_evicted = False
+        # With the history on the server: this session's lines are read
+        # back from the local history down to `history_floor`, and
+        # older ones from the server, below `session_history_bound`
+        self.history_floor = None
+        self.session_history_bound = None
+        # Unfinished downloads that can be resumed after a reconnect
+        self.resume_file = "downloads.json"
+        # Downloads are requested on the Tk thread and finished on the
+        # receive thread, and both update the resume file
+        self.resume_lock = threading.Lock()
+        self.incoming_file = None
+        # Multiplexed downloads in progress, by transfer id
+        self.incoming_transfers = {}
+        self.transfer_ids = itertools.count(1)
+        # File offers waiting for the server's MSG_FILE_NEED, by hash
+        self.pending_offers = {}
+        # Requested downloads waiting for the server's MSG_BLOB_RANGE, by
+        # transfer id (or by hash if the server does not multiplex)
+        self.downloads = {}
+
+        # Frames and uploads waiting for the sender thread
+        self.send_cond = threading.Condition()
+        self.outbox = collections.deque()
+        self.uploads = collections.deque()
+        # Every upload of this session by transfer id, so the server can
+        # ask for one to be resumed
+        self.uploads_by_id = {}
+
+        # Answer the NICK prompt and negotiate framing before anything else
+        self.handshake()
+
+        if self.framed:
+            sender_thread = threading.Thread(target=self.sender_loop, daemon=True)
+            sender_thread.start()
         
         # Start receive thread
         receive_thread = threading.Thread(target=self.receive, daemon=True)
@@ -220,6 +322,185 @@ class Client:
         self.loading_screen.destroy()
         self.gui_loop()
 
+    def handshake(self, legacy=False):
+        """Reply to the server's NICK prompt and switch to framed messages
+        if the server supports them, otherwise stay on the legacy text protocol.
+
+        An old server takes the whole hello as the nickname, so when no
+        HELLO ack comes back the connection is made again with `legacy`,
+        answering the prompt with just the nickname."""
+        self.framed = False
+        self.protocol_version = 0
+        self.decoder = None
+        self.pending = b''
+        # Name ids of compact events, announced anew in every session
+        self.names = {}
+        try:
+            self.sock.settimeout(5)
+            acknowledged = self.negotiate(legacy)
+        except socket.timeout:
+            # No prompt: nothing to fall back from
+            acknowledged = True
+        finally:
+            self.sock.settimeout(None)
+        if not acknowledged:
+            # Old server: start over without framing
+            self.sock.close()
+            self.sock = socket.create_connection((self.host, self.port))
+            self.handshake(legacy=True)
+
+    def negotiate(self, legacy):
+        """The exchange after connecting, for handshake(). Returns False if
+        the hello went unanswered."""
+        prompt = self.sock.recv(1024)
+        if prompt.strip() != b'NICK':
+            self.pending = prompt
+            return True
+        if legacy:
+            self.sock.sendall(self.nickname.encode('utf-8'))
+            return True
+        self.sock.sendall(encode_hello(self.nickname))
+        try:
+            reply = self.sock.recv(8192)
+        except socket.timeout:
+            return False
+        version, rest = parse_hello_ack(reply)
+        if version is None:
+            return False
+        self.framed = True
+        self.protocol_version = version
+        self.decoder = FrameDecoder()
+        self.pending = rest
+        if version >= COMPACT_VERSION:
+            options = {'compression': ['zlib'], 'compress_above': COMPRESS_ABOVE}
+            self.sock.sendall(encode_frame(MSG_OPTIONS, encode_json(options)))
+        return True
+
+    def send_message(self, msg_type, payload):
+        """Queue a payload as a frame for the sender thread, or send it as
+        raw bytes on the legacy protocol."""
+        if self.framed:
+            with self.send_cond:
+                self.outbox.append(encode_frame(msg_type, payload))
+                self.send_cond.notify()
+        else:
+            self.sock.sendall(payload)
+
+    def multiplexes_files(self):
+        """Whether file data can be sent in chunks tagged with a transfer id."""
+        return self.protocol_version >= MULTIPLEX_VERSION
+
+    def checks_chunks(self):
+        """Whether chunks carry their offset and a CRC-32, and transfers can be resumed."""
+        return self.protocol_version >= RESUMABLE_VERSION
+
+    def sender_loop(self):
+        """Write queued frames to the socket. Chat and control frames always
+        go first; uploads only get the socket when the outbox is empty, one
+        chunk at a time and taking turns if the server multiplexes them."""
+        while self.running:
+            with self.send_cond:
+                while self.running and not self.outbox and not self.uploads:
+                    self.send_cond.wait()
+                if not self.running:
+                    return
+                upload = None
+                if self.outbox:
+                    data = b''.join(self.outbox)
+                    self.outbox.clear()
+                else:
+                    upload = self.uploads[0]
+
+            try:
+                if upload is None:
+                    self.sock.sendall(data)
+                else:
+                    self.send_upload_chunk(upload)
+            except Exception as e:
+                if self.running:
+                    self.log_message(f"Error: {str(e)}")
+                with self.send_cond:
+                    uploads = list(self.uploads)
+                    self.uploads.clear()
+                for upload in uploads:
+                    upload['file'].close()
+                    self.call_in_ui(self.finish_upload, upload, str(e))
+                return
+
+    def send_upload_chunk(self, upload):
+        """Send the start of an upload or its next chunk."""
+        with self.send_cond:
+            restart = upload['restart']
+            upload['restart'] = None
+        if restart is not None:
+            if upload['file'] is None or upload['file'].closed:
+                upload['file'] = open(upload['path'], 'rb')
+            upload['file'].seek(restart)
+            upload['sent'] = restart
+            upload['started'] = False
+
+        if not upload['started']:
+            upload['started'] = True
+            if self.multiplexes_files():
+                begin = {
+                    'id': upload['id'],
+                    'name': upload['filename'],
+                    'size': upload['size'],
+                    'hash': upload['hash'],
+                }
+                if self.checks_chunks():
+                    begin['offset'] = upload['sent']
+                self.sock.sendall(encode_frame(MSG_TRANSFER_BEGIN, encode_json(begin)))
+            else:
+                header = f"FILE:{upload['filename']}:{upload['size']}:{self.nickname}"
+                self.sock.sendall(encode_frame(MSG_FILE_HEADER, header.encode('utf-8')))
+        else:
+            chunk = upload['file'].read(min(UPLOAD_CHUNK_SIZE, upload['size'] - upload['sent']))
+            if not chunk:
+                # The file shrank after it was offered
+                if self.multiplexes_files():
+                    self.sock.sendall(encode_frame(MSG_TRANSFER_ABORT, encode_json({'id': upload['id']})))
+                with self.send_cond:
+                    self.uploads.remove(upload)
+                upload['file'].close()
+                self.call_in_ui(self.finish_upload, upload, "the file changed while it was being sent")
+                return
+            if self.checks_chunks():
+                self.sock.sendall(encode_chunk(upload['id'], chunk, upload['sent']))
+            elif self.multiplexes_files():
+                self.sock.sendall(encode_chunk(upload['id'], chunk))
+            else:
+                self.sock.sendall(encode_frame(MSG_FILE_DATA, chunk))
+            upload['sent'] += len(chunk)
+            self.call_in_ui(self.update_upload_progress, upload)
+
+        with self.send_cond:
+            if upload['sent'] >= upload['size']:
+                self.uploads.remove(upload)
+                upload['file'].close()
+                self.call_in_ui(self.finish_upload, upload)
+            elif self.multiplexes_files() and self.uploads[0] is upload:
+                # Let the next upload have a turn
+                self.uploads.rotate(-1)
+
+    def offer_file(self, filename, file_size, digest):
+        """Announce a file by content hash and wait for the server's answer.
+        Returns (need, offset): whether the file still has to be uploaded,
+        and how much of it the server kept from an interrupted upload."""
+        offer = {'event': threading.Event(), 'need': True, 'offset': 0}
+        self.pending_offers[digest] = offer
+        try:
+            self.send_message(MSG_FILE_OFFER, encode_json({
+                'name': filename,
+                'size': file_size,
+                'hash': digest,
+            }))
+            # No answer in time: upload anyway
+            offer['event'].wait(10)
+            return offer['need'], offer['offset']
+        finally:
+            self.pending_offers.pop(digest, None)
+
     def gui_loop(self):
         self.win = customtkinter.CTk()
         self.win.title(f"Chat Application - {self.nickname}")
@@ -251,6 +532,15 @@ class Client:
         # Button frame for window controls
         self.window_controls = customtkinter.CTkFrame(self.header)
         self.window_controls.pack(side="right")
+
+        # Search box for the local history
+        self.search_entry = customtkinter.CTkEntry(
+            self.header,
+            placeholder_text="Search history",
+            width=200
+        )
+        self.search_entry.pack(side="right", padx=10)
+        self.search_entry.bind('<Return>', lambda e: self.search_history())
         
         self.maximize_button = customtkinter.CTkButton(
             self.window_controls,
@@ -280,7 +570,7 @@ class Client:
             pady=10
         )
         self.text_area.pack(fill="both", expand=True, pady=(0, 10))
-        self.text_area.configure(state="disabled")
+        self.text_area.configure(state="disabled", yscrollcommand=self.on_chat_scroll)
         
         # Configure tags for message bubbles and formatting
         self.text_area.tag_configure('bubble_self', 
@@ -302,6 +592,13 @@ class Client:
         self.text_area.tag_configure('bold', font=("Helvetica", 12, "bold"))
         self.text_area.tag_configure('italic', font=("Helvetica", 12, "italic"))
         self.text_area.tag_configure('underline', underline=True)
+        self.text_area.tag_configure('notification',
+            justify='center',
+            spacing1=10,
+            spacing3=10,
+            foreground='#666666',
+            background='#E8E8E8',
+        )
         
         # Bottom frame for input and buttons
         self.bottom_frame = customtkinter.CTkFrame(self.main_frame)
@@ -381,9 +678,19 @@ class Client:
         
         self.gui_done = True
         self.win.protocol("WM_DELETE_WINDOW", self.stop)
-        self.load_chat_history()
+        if self.protocol_version >= HISTORY_VERSION:
+            # The server keeps the history: fetch just its latest page
+            self.history_floor = self.local_history.end()
+            self.request_history()
+        else:
+            self.load_chat_history()
+        self.win.after(500, self.resume_downloads)
+        self.drain_ui_queue()
         self.win.mainloop()
 
+    def show_nickname(self):
+        self.win.title(f"Chat Application - {self.nickname}")
+
     def toggle_fullscreen(self):
         """Toggle fullscreen mode"""
         self.is_fullscreen = not self.is_fullscreen
@@ -426,11 +733,18 @@ class Client:
                 if file_size > 100 * 1024 * 1024:  # 100MB
                     messagebox.showerror("Error", "File is too large. Maximum size is 100MB.")
                     return
+
+                if self.framed:
+                    # Hashing and waiting for the server's answer take a
+                    # while; the GUI goes on meanwhile
+                    threading.Thread(target=self.offer_upload, args=(file_path, filename, file_size),
+                                     daemon=True).start()
+                    return
                     
                 # Send file header with error handling
                 try:
                     header = f"FILE:{filename}:{file_size}:{self.nickname}"
-                    self.sock.send(header.encode('utf-8'))
+                    self.send_message(MSG_FILE_HEADER, header.encode('utf-8'))
                 except Exception as e:
                     messagebox.showerror("Error", f"Failed to initiate file transfer: {str(e)}")
                     return
@@ -470,7 +784,7 @@ class Client:
                                 break
                             try:
                                 self.sock.settimeout(10)  # 10 second timeout
-                                self.sock.sendall(chunk)
+                                self.send_message(MSG_FILE_DATA, chunk)
                                 self.sock.settimeout(None)  # Reset timeout
                                 sent += len(chunk)
                                 progress = (sent / file_size) * 100
@@ -495,300 +809,980 @@ class Client:
                 except:
                     pass
 
+    def offer_upload(self, file_path, filename, file_size):
+        """Worker thread: hash a file and offer it to the server, then have
+        the Tk thread queue its upload, unless the server already has it."""
+        try:
+            digest = file_digest(file_path)
+            # Skip the upload if the server already has this file
+            need, offset = self.offer_file(filename, file_size, digest)
+        except Exception as e:
+            self.call_in_ui(messagebox.showerror, "Error", f"Failed to send file: {str(e)}")
+            self.log_message(f"Error sending file: {str(e)}")
+            return
+        if not need:
+            self.log_message(f"You shared file: {filename}")
+            return
+        if offset:
+            self.log_message(f"Resuming upload of {filename} from {offset / 1024:.1f} KB")
+        self.call_in_ui(self.queue_upload, file_path, filename, file_size, digest, offset)
+
+    def queue_upload(self, file_path, filename, file_size, digest, offset=0):
+        """Tk thread: hand a file to the sender thread, which interleaves it
+        with chat messages and other uploads. Starts after the first
+        `offset` bytes if the server kept them from an earlier attempt."""
+        progress_window = customtkinter.CTkToplevel()
+        progress_window.title("Sending File")
+        screen_width = progress_window.winfo_screenwidth()
+        screen_height = progress_window.winfo_screenheight()
+        x = (screen_width - 300) // 2
+        y = (screen_height - 150) // 2
+        progress_window.geometry(f"300x150+{x}+{y}")
+
+        progress_label = customtkinter.CTkLabel(
+            progress_window,
+            text=f"Sending {filename}..."
+        )
+        progress_label.pack(pady=10)
+
+        progress_bar = ttk.Progressbar(
+            progress_window,
+            length=200,
+            mode='determinate'
+        )
+        progress_bar.pack(pady=10)
+
+        upload = {
+            'id': next(self.transfer_ids),
+            'path': file_path,
+            'filename': filename,
+            'size': file_size,
+            'hash': digest,
+            'file': None,
+            'sent': 0,
+            'started': False,
+            'restart': offset,
+            'retries': 0,
+            'progress_window': progress_window,
+            'progress_bar': progress_bar,
+        }
+        self.uploads_by_id[upload['id']] = upload
+        with self.send_cond:
+            self.uploads.append(upload)
+            self.send_cond.notify()
+
+    def resume_upload(self, info):
+        """The server stopped one of our uploads (damaged data, or the file
+        did not match its hash): send it again from the offset it reports."""
+        upload = self.uploads_by_id.get(info.get('id'))
+        if upload is None:
+            return
+        error = info.get('error', 'transfer failed')
+        if upload['retries'] >= MAX_TRANSFER_RETRIES:
+            self.log_message(f"Upload of {upload['filename']} failed: {error}")
+            return
+        upload['retries'] += 1
+        offset = int(info.get('offset', 0))
+        self.log_message(f"Resuming upload of {upload['filename']} from {offset / 1024:.1f} KB ({error})")
+        with self.send_cond:
+            # Applied by the sender thread before its next chunk
+            upload['restart'] = offset
+            if upload not in self.uploads:
+                self.uploads.append(upload)
+            self.send_cond.notify()
+
+    def update_upload_progress(self, upload):
+        if upload['size'] and upload['progress_window'] is not None:
+            upload['progress_bar']['value'] = (upload['sent'] / upload['size']) * 100
+
+    def finish_upload(self, upload, error=None):
+        """Called on the GUI thread once the sender thread is done with an upload."""
+        if upload['progress_window'] is not None:
+            upload['progress_window'].destroy()
+            upload['progress_window'] = None
+        if error:
+            messagebox.showerror("Error", f"Failed to send file: {error}")
+            self.log_message(f"Error sending file: {error}")
+        else:
+            self.log_message(f"You shared file: {upload['filename']}")
+
     def write(self):
         message = self.input_area.get("1.0", "end-1c").strip()
         if message:
             timestamp = datetime.datetime.now().strftime('%H:%M:%S')
             # Format pesan yang akan dikirim ke server
             server_message = f"{self.nickname}: {message}"
-            self.sock.send(server_message.encode('utf-8'))
+            if self.protocol_version >= COMPACT_VERSION:
+                # The server knows who is talking
+                self.send_message(MSG_SAY, message.encode('utf-8'))
+            else:
+                self.send_message(MSG_TEXT, server_message.encode('utf-8'))
+            if message.startswith('/'):
+                # Room commands are answered by the server, not kept in history
+                self.log_message(f"[{timestamp}] {message}")
+                self.input_area.delete("1.0", "end")
+                return
+            # Simpan ke history; the sender's own line is always kept,
+            # whatever words it contains
+            line = f"[{timestamp}] {server_message}"
+            position = self.local_history.append(line)
+            key = None if position is None else ('local', position)
             # Tampilkan pesan di layar pengirim
-            self.log_message(f"[{timestamp}] {server_message}")
+            self.log_message(line, key=key, style='self')
             self.input_area.delete("1.0", "end")
-            # Simpan ke history
-            self.save_to_history(f"[{timestamp}] {server_message}")
 
     def load_chat_history(self):
+        """Show the last page of the local history; older pages are read
+        when the chat is scrolled to the top."""
         try:
-            if os.path.exists(self.history_file):
-                with open(self.history_file, 'r', encoding='utf-8') as f:
-                    history = f.read()
-                    if history:
-                        self.text_area.configure(state='normal')
-                        self.text_area.insert('end', history)
-                        self.text_area.configure(state='disabled')
-                        self.text_area.see('end')
+            self.history_position = self.local_history.end()
+            self.load_older_lines()
+            self.text_area.see('end')
         except Exception as e:
             self.log_message(f"Error loading chat history: {str(e)}")
 
-    def save_to_history(self, message):
+    def load_older_lines(self):
+        """Show the page of the local history before the oldest line shown."""
+        entries, self.history_position = self.local_history.read_before(
+            self.history_position, HISTORY_PAGE_SIZE, self.history_floor)
+
+        def insert(index):
+            for position, line in entries:
+                self.log_message(line.rstrip('\n'), index, ('local', position))
+
+        if entries:
+            self.prepend_history(insert)
+
+    def prepend_history(self, insert):
+        """Insert older history above everything shown, keeping the view
+        where it is. `insert` is called with the index to insert at."""
+        self.text_area.configure(state='normal')
+        # Marks move with the text around them: 'history_top' stays after
+        # the inserted text so pieces come out in order, and 'view_top'
+        # keeps pointing at the line that was at the top of the view
+        self.text_area.mark_set('view_top', '@0,0')
+        self.text_area.mark_gravity('view_top', 'right')
+        self.text_area.mark_set('history_top', '1.0')
+        self.text_area.mark_gravity('history_top', 'right')
+        self.prepended = []
+        insert('history_top')
+        self.rendered.extendleft(reversed(self.prepended))
+        self.prepended = None
+        self.text_area.configure(state='disabled')
+        self.text_area.yview('view_top')
+        self.evict_newest()
+
+    def evict_oldest(self):
+        """Drop the oldest messages over MAX_RENDERED_MESSAGES from the chat
+        area; scrolling back reads them from the history again."""
+        excess = len(self.rendered) - MAX_RENDERED_MESSAGES
+        if excess <= 0:
+            return
+        evicted = [self.rendered.popleft() for _ in range(excess)]
+        self.text_area.configure(state='normal')
+        self.text_area.delete('1.0', self.rendered[0][0])
+        self.text_area.configure(state='disabled')
+        for mark, _ in evicted:
+            self.text_area.mark_unset(mark)
+        self.resume_history_at(next((key for _, key in self.rendered if key is not None), None))
+
+    def evict_newest(self):
+        """After scrolling back, drop the newest messages over
+        MAX_RENDERED_MESSAGES; reload_latest() shows them again."""
+        excess = len(self.rendered) - MAX_RENDERED_MESSAGES
+        if excess <= 0:
+            return
+        evicted = [self.rendered.pop() for _ in range(excess)]
+        self.text_area.configure(state='normal')
+        self.text_area.delete(evicted[-1][0], 'end')
+        self.text_area.configure(state='disabled')
+        for mark, _ in evicted:
+            self.text_area.mark_unset(mark)
+        self.newer_evicted = True
+
+    def resume_history_at(self, key):
+        """Make scrolling back load the history before `key`, the key of
+        the oldest message shown (None: the whole local history)."""
+        if key is None:
+            key = ('local', self.local_history.end())
+        source, position = key
+        if source == 'server':
+            self.history_position = None
+            self.oldest_history_id = position
+            self.more_history = True
+        else:
+            self.history_position = position
+            if self.protocol_version >= HISTORY_VERSION:
+                # And then the server's history from before this session
+                self.oldest_history_id = self.session_history_bound
+                self.more_history = self.session_history_bound is not None
+
+    def reload_latest(self):
+        """Show the latest messages again, once scrolled back down after
+        they were dropped."""
         try:
-            with open(self.history_file, 'a', encoding='utf-8') as f:
-                f.write(message + '\n')
+            self.text_area.configure(state='normal')
+            self.text_area.delete('1.0', 'end')
+            self.text_area.configure(state='disabled')
+            for mark, _ in self.rendered:
+                self.text_area.mark_unset(mark)
+            self.rendered.clear()
+            self.newer_evicted = False
+            self.resume_history_at(None)
+            self.load_older_lines()
+            if not self.rendered and self.more_history:
+                # Nothing from this session: the server's latest page
+                self.request_history(self.oldest_history_id)
+                return
+            self.text_area.see('end')
         except Exception as e:
-            self.log_message(f"Error saving to history: {str(e)}")
-    
+            self.log_message(f"Error loading chat history: {str(e)}")
+        self.loading_history = False
+
+    def on_chat_scroll(self, first, last):
+        """yscrollcommand of the chat area: load an older page of history
+        once the top is reached, and the latest messages again at the
+        bottom if they were dropped."""
+        if self.loading_history:
+            return
+        # Not from inside the widget's own scroll callback
+        if float(last) >= 1 and self.newer_evicted:
+            self.loading_history = True
+            self.win.after_idle(self.reload_latest)
+        elif float(first) > 0:
+            return
+        elif self.history_position is not None:
+            self.loading_history = True
+            self.win.after_idle(self.load_older_local_page)
+        elif self.protocol_version >= HISTORY_VERSION and self.more_history:
+            self.loading_history = True
+            self.request_history(self.oldest_history_id)
+
+    def load_older_local_page(self):
+        try:
+            self.load_older_lines()
+        except Exception as e:
+            self.history_position = None
+            self.log_message(f"Error loading chat history: {str(e)}")
+        finally:
+            self.loading_history = False
+
+    def request_history(self, before=None):
+        """Ask the server for the page of history before message id `before`,
+        or for the latest page."""
+        request = {'limit': HISTORY_PAGE_SIZE}
+        if before is not None:
+            request['before'] = before
+        self.send_message(MSG_HISTORY_REQUEST, encode_json(request))
+
+    def handle_history(self, page):
+        """Show a page of history sent by the server above what is shown."""
+        self.call_in_ui(self.show_history_page, page)
+
+    def show_history_page(self, page):
+        messages = page.get('messages', [])
+        if self.oldest_history_id is None and messages:
+            # The first page: everything from before this session is below
+            self.session_history_bound = messages[-1]['id'] + 1
+        was_empty = not self.rendered
+        if messages:
+            self.oldest_history_id = messages[0]['id']
+        self.more_history = bool(page.get('more')) and self.oldest_history_id is not None
+
+        def insert(index):
+            for message in messages:
+                timestamp = datetime.datetime.fromtimestamp(message['time']).strftime('%H:%M:%S')
+                # History pages only hold "nickname: text" chat lines
+                style = 'self' if message['text'].startswith(f"{self.nickname}: ") else 'other'
+                self.log_message(f"[{timestamp}] {message['text']}", index, ('server', message['id']), style)
+
+        self.prepend_history(insert)
+        if was_empty:
+            self.text_area.see('end')
+        self.loading_history = False
+
+    def search_history(self):
+        """Show the local history lines containing every word typed in the
+        search box."""
+        query = self.search_entry.get().strip()
+        if not query:
+            return
+        started = time.perf_counter()
+        results = self.local_history.search(query, SEARCH_LIMIT)
+        elapsed = (time.perf_counter() - started) * 1000
+
+        results_window = customtkinter.CTkToplevel()
+        results_window.title(f"Search: {query}")
+        results_window.geometry("600x400")
+        summary = customtkinter.CTkLabel(
+            results_window,
+            text=f"{len(results)} results in {elapsed:.1f} ms"
+        )
+        summary.pack(pady=10)
+        results_box = customtkinter.CTkTextbox(results_window, wrap="word")
+        results_box.pack(fill="both", expand=True, padx=10, pady=(0, 10))
+        results_box.insert("1.0", '\n'.join(results) if results else "No messages found.")
+        results_box.configure(state="disabled")
+
     def clear_chat_history(self):
         """Clear chat history file and current display"""
         try:
-            if os.path.exists(self.history_file):
-                os.remove(self.history_file)
+            self.local_history.clear()
             if self.gui_done:
                 self.text_area.configure(state='normal')
                 self.text_area.delete('1.0', 'end')
                 self.text_area.configure(state='disabled')
+                for mark, _ in self.rendered:
+                    self.text_area.mark_unset(mark)
+            self.rendered.clear()
+            self.newer_evicted = False
+            # Nothing older to load back in
+            self.history_position = None
+            self.more_history = False
+            self.session_history_bound = None
         except Exception as e:
             self.log_message(f"Error clearing chat history: {str(e)}")
 
     def save_to_history(self, message):
-        """Only save important messages to reduce history size"""
-        try:
-            # Skip saving certain types of messages
-            if any(skip in message.lower() for skip in [
-                "joined the chat",
-                "left the chat",
-                "error:",
-                "failed to",
-                "could not"
-            ]):
-                return
-                
-            # Limit history file size
-            if os.path.exists(self.history_file):
-                if os.path.getsize(self.history_file) > 1024 * 1024:  # 1MB limit
-                    # Keep only the last 1000 lines
-                    with open(self.history_file, 'r', encoding='utf-8') as f:
-                        lines = f.readlines()[-1000:]
-                    with open(self.history_file, 'w', encoding='utf-8') as f:
-                        f.writelines(lines)
-            
-            # Append new message
-            with open(self.history_file, 'a', encoding='utf-8') as f:
-                f.write(message + '\n')
-        except Exception as e:
-            print(f"Error saving to history: {str(e)}")
+        """Keep a line received on the untyped (legacy) path in the local
+        history, unless it looks like a server notice (HISTORY_SKIP). Only
+        queues it: the history writes in batches from its own thread.
+        Returns where the line will be kept (see self.rendered), or None
+        if it is not kept."""
+        if any(skip in message.lower() for skip in HISTORY_SKIP):
+            return None
+        position = self.local_history.append(message)
+        return None if position is None else ('local', position)
+
+    def log_message(self, message, index='end', key=None, style=None):
+        """Show a message in the chat area: at the end, or at `index` for
+        older history. `key` tells where the history keeps it, so it can be
+        shown again after being dropped (see MAX_RENDERED_MESSAGES); for
+        `style` see render_message().
+
+        New messages may come from any thread: they are only queued, and
+        shown by drain_ui_queue() on the Tk thread. Older history is
+        inserted by the Tk thread itself, inside prepend_history()."""
+        if message.strip() == 'NICK':
+            return
+        if index == 'end':
+            self.ui_queue.append((None, (message, index, key, style)))
+            return
+        self.show_message(message, index, key, style)
+
+    def call_in_ui(self, func, *args):
+        """Have the Tk thread call `func(*args)`, in order with the queued
+        messages."""
+        self.ui_queue.append((func, args))
+
+    def drain_ui_queue(self):
+        """Tk thread: show the queued messages and run the queued calls, a
+        batch every UI_TICK_MS. The chat area is made editable once for a
+        run of messages and scrolled once per batch."""
+        if not self.running:
+            return
+        shown = False
+        editing = False
+        for _ in range(min(len(self.ui_queue), UI_BATCH_SIZE)):
+            func, args = self.ui_queue.popleft()
+            try:
+                if func is None:
+                    if not editing:
+                        self.text_area.configure(state='normal')
+                        editing = True
+                    shown = self.show_message(*args) or shown
+                else:
+                    if editing:
+                        self.text_area.configure(state='disabled')
+                        editing = False
+                    func(*args)
+            except Exception as e:
+                print(f"Error updating the chat: {e}")
+        if editing:
+            self.text_area.configure(state='disabled')
+        if shown:
+            self.text_area.see('end')
+            self.evict_oldest()
+        # Straight on if a burst is still waiting
+        self.win.after(1 if self.ui_queue else UI_TICK_MS, self.drain_ui_queue)
 
-    def log_message(self, message):
-        """Enhanced message display with notifications and regular messages"""
+    def show_message(self, message, index='end', key=None, style=None):
+        """Tk thread: insert a message, with the chat area editable.
+        Returns whether it was shown."""
+        if index == 'end' and self.newer_evicted:
+            # Not below a gap: shown with the latest messages on scrolling down
+            return False
+        mark = f"message_{next(self.mark_ids)}"
+        # Left gravity keeps the mark before the message inserted at it;
+        # right gravity afterwards moves it below anything prepended there
+        self.text_area.mark_set(mark, 'end-1c' if index == 'end' else index)
+        self.text_area.mark_gravity(mark, 'left')
+        self.render_message(message, index, style)
+        self.text_area.mark_gravity(mark, 'right')
+        if index == 'end':
+            self.rendered.append((mark, key))
+        else:
+            self.prepended.append((mark, key))
+        return True
+
+    def render_message(self, message, index, style=None):
+        """Enhanced message display with notifications and regular messages.
+        `style` is 'notification', 'self' or 'other'; lines that come
+        without one (from servers before ENVELOPE_VERSION, or from the
+        local history) are classified by their text."""
         if self.gui_done:
             try:
-                self.text_area.configure(state='normal')
-                
-                # Skip NICK messages
-                if message.strip() == 'NICK':
-                    return
+                if style is None:
+                    # Split join message and first message
+                    if "joined the chat!" in message and ":" in message:
+                        parts = message.split("]", 1)
+                        if len(parts) > 1:
+                            timestamp = parts[0].strip('[')
+                            content = parts[1].strip()
 
-                # Set up notification style
-                self.text_area.tag_configure('notification', 
-                    justify='center',
-                    spacing1=10,
-                    spacing3=10,
-                    foreground='#666666',
-                    background='#E8E8E8',
-                )
+                            # Split into join notification and first message
+                            name_and_message = content.split(":", 1)
+                            name = name_and_message[0].split("joined")[0].strip()
 
-                # Split join message and first message
-                if "joined the chat!" in message and ":" in message:
-                    parts = message.split("]", 1)
-                    if len(parts) > 1:
-                        timestamp = parts[0].strip('[')
-                        content = parts[1].strip()
-                        
-                        # Split into join notification and first message
-                        name_and_message = content.split(":", 1)
-                        name = name_and_message[0].split("joined")[0].strip()
-                        
-                        # Display join notification
-                        self.text_area.insert('end', '\n')
-                        self.text_area.insert('end', f"{name} joined the chat!\n", 'notification')
-                        
-                        # Display first message if exists
-                        if len(name_and_message) > 1:
-                            first_message = name_and_message[1].strip()
-                            if first_message and "joined the chat!" not in first_message:
-                                self.text_area.insert('end', f"\n[{timestamp}] {name}: {first_message}\n", 'bubble_other')
-                    return
+                            # Display join notification
+                            self.text_area.insert(index, '\n')
+                            self.text_area.insert(index, f"{name} joined the chat!\n", 'notification')
+
+                            # Display first message if exists
+                            if len(name_and_message) > 1:
+                                first_message = name_and_message[1].strip()
+                                if first_message and "joined the chat!" not in first_message:
+                                    self.text_area.insert(index, f"\n[{timestamp}] {name}: {first_message}\n", 'bubble_other')
+                        return
+
+                    # Handle regular join/leave notifications
+                    if "joined the chat!" in message or "left the chat!" in message:
+                        parts = message.split("]", 1)
+                        if len(parts) > 1:
+                            content = parts[1].strip()
+                            name = content.split("joined" if "joined" in content else "left")[0].strip()
+                            action = "joined the chat!" if "joined" in content else "left the chat!"
+                            self.text_area.insert(index, '\n')
+                            self.text_area.insert(index, f"{name} {action}\n", 'notification')
+                        return
+
+                    style = 'self' if f"{self.nickname}:" in message else 'other'
 
-                # Handle regular join/leave notifications
-                if "joined the chat!" in message or "left the chat!" in message:
-                    parts = message.split("]", 1)
-                    if len(parts) > 1:
-                        content = parts[1].strip()
-                        name = content.split("joined" if "joined" in content else "left")[0].strip()
-                        action = "joined the chat!" if "joined" in content else "left the chat!"
-                        self.text_area.insert('end', '\n')
-                        self.text_area.insert('end', f"{name} {action}\n", 'notification')
+                if style == 'notification':
+                    self.text_area.insert(index, '\n', (), f"{message}\n", 'notification')
                     return
-                    
+
                 # Handle regular messages
-                is_self_message = f"{self.nickname}:" in message
-                bubble_tag = 'bubble_self' if is_self_message else 'bubble_other'
-                
-                if '**' in message or '*' in message or '_' in message:
-                    self.text_area.insert('end', '\n')
-                    parts = message.split('**')
-                    is_bold = False
-                    for part in parts:
-                        italic_parts = part.split('*')
-                        is_italic = False
-                        for ip in italic_parts:
-                            underline_parts = ip.split('_')
-                            is_underline = False
-                            for up in underline_parts:
-                                tags = [bubble_tag]
-                                if is_bold: tags.append('bold')
-                                if is_italic: tags.append('italic')
-                                if is_underline: tags.append('underline')
-                                
-                                self.text_area.insert('end', up, ' '.join(tags) if tags else bubble_tag)
-                                is_underline = not is_underline
-                            is_italic = not is_italic
-                        is_bold = not is_bold
-                    self.text_area.insert('end', '\n')
-                else:
-                    self.text_area.insert('end', f'\n{message}\n', bubble_tag)
-                
-                self.text_area.see('end')
-                self.text_area.configure(state='disabled')
+                bubble_tag = 'bubble_self' if style == 'self' else 'bubble_other'
+
+                # One insert for the whole bubble, formatting included
+                self.text_area.insert(index, '\n', bubble_tag,
+                                      *insert_args(parse_markup(message), bubble_tag), '\n', bubble_tag)
             except Exception as e:
                 print(f"Error displaying message: {e}")
 
     def handle_file_receive(self, header):
+        """Legacy protocol: read a file pushed by the server straight off
+        the socket, right after its "FILE:" header."""
+        incoming = None
+        try:
+            _, filename, filesize, sender = header.split(':')
+            filesize = int(filesize)
+            incoming = self.begin_pushed_file(filename, sender, filesize)
+            received = 0
+            self.sock.settimeout(10)  # 10 second timeout
             try:
-                _, filename, filesize, sender = header.split(':')
-                filesize = int(filesize)
-                
-                # Check file size
-                if filesize > 100 * 1024 * 1024:  # 100MB
-                    messagebox.showerror("Error", "File is too large. Maximum size is 100MB.")
-                    self._consume_file_data(filesize)
-                    return
-                    
-                save_path = filedialog.asksaveasfilename(
-                    defaultextension=os.path.splitext(filename)[1],
-                    initialfile=filename,
-                    title=f"Save file from {sender}"
-                )
-                
-                if not save_path:
-                    self._consume_file_data(filesize)
-                    return
-                    
-                progress_window = None
-                try:
-                    progress_window = customtkinter.CTkToplevel()
-                    progress_window.title("Receiving File")
-                    progress_window.geometry("300x150")
-                    
-                    screen_width = progress_window.winfo_screenwidth()
-                    screen_height = progress_window.winfo_screenheight()
-                    x = (screen_width - 300) // 2
-                    y = (screen_height - 150) // 2
-                    progress_window.geometry(f"300x150+{x}+{y}")
-                    
-                    progress_label = customtkinter.CTkLabel(
-                        progress_window,
-                        text=f"Receiving {filename}..."
-                    )
-                    progress_label.pack(pady=10)
-                    
-                    progress_bar = ttk.Progressbar(
-                        progress_window,
-                        length=200,
-                        mode='determinate'
-                    )
-                    progress_bar.pack(pady=10)
+                while received < filesize:
+                    chunk = self.sock.recv(min(8192, filesize - received))
+                    if not chunk:
+                        raise Exception("Connection lost while receiving file")
+                    received += len(chunk)
+                    self.receive_file_chunk(chunk, incoming)
+            except socket.timeout:
+                raise Exception("Connection timed out while receiving file")
+            finally:
+                self.sock.settimeout(None)  # Reset timeout
+        except Exception as e:
+            self.call_in_ui(messagebox.showerror, "Error", f"Failed to receive file: {str(e)}")
+            self.log_message(f"Error receiving file: {str(e)}")
+            self.abort_file_receive(incoming)
 
-                    # Receive with timeout and temporary file
-                    temp_path = save_path + '.tmp'
-                    received = 0
-                    
-                    with open(temp_path, 'wb') as f:
-                        while received < filesize:
-                            chunk_size = min(8192, filesize - received)
-                            try:
-                                self.sock.settimeout(10)  # 10 second timeout
-                                chunk = self.sock.recv(chunk_size)
-                                self.sock.settimeout(None)  # Reset timeout
-                                if not chunk:
-                                    raise Exception("Connection lost while receiving file")
-                                f.write(chunk)
-                                received += len(chunk)
-                                progress = (received / filesize) * 100
-                                progress_bar['value'] = progress
-                                progress_window.update()
-                            except socket.timeout:
-                                raise Exception("Connection timed out while receiving file")
-                    
-                    # Rename temp file to final file
-                    if os.path.exists(save_path):
-                        os.remove(save_path)
-                    os.rename(temp_path, save_path)
-                    
-                    self.log_message(f"Received file '{filename}' from {sender}")
-                    
-                    if messagebox.askyesno("File Received", f"File saved successfully. Do you want to open {filename}?"):
-                        try:
-                            os.startfile(save_path)
-                        except AttributeError:
-                            import subprocess
-                            subprocess.call(('xdg-open', save_path))
-                        except Exception:
-                            messagebox.showwarning("Error", "Could not open file automatically. Please open it manually.")
-                            
-                finally:
-                    if progress_window:
-                        progress_window.destroy()
-                    if os.path.exists(temp_path):
-                        try:
-                            os.remove(temp_path)
-                        except:
-                            pass
-                            
-            except Exception as e:
-                messagebox.showerror("Error", f"Failed to receive file: {str(e)}")
-                self.log_message(f"Error receiving file: {str(e)}")
-                # Ensure socket is reset
+    def begin_file_receive(self, header):
+        """Start receiving a framed file; its data arrives in later frames."""
+        try:
+            _, filename, filesize, sender = header.split(':')
+            self.begin_pushed_file(filename, sender, int(filesize))
+        except Exception as e:
+            self.call_in_ui(messagebox.showerror, "Error", f"Failed to receive file: {str(e)}")
+            self.log_message(f"Error receiving file: {str(e)}")
+            self.abort_file_receive()
+
+    def begin_pushed_file(self, filename, sender, filesize):
+        """A file sent without being asked for (servers before
+        PULL_ATTACHMENTS_VERSION). Its data is kept in a temporary file
+        while the Tk thread asks where to save it, so receiving goes on
+        meanwhile. Returns the transfer."""
+        # Check file size
+        if filesize > 100 * 1024 * 1024:  # 100MB
+            self.call_in_ui(messagebox.showerror, "Error", "File is too large. Maximum size is 100MB.")
+            return self.start_incoming_file(filename, sender, filesize, None)
+        fd, temp_path = tempfile.mkstemp(prefix='incoming-', suffix='.tmp')
+        os.close(fd)
+        incoming = self.start_incoming_file(filename, sender, filesize, None, temp_path=temp_path,
+                                            asking=True)
+        self.call_in_ui(self.ask_save_path, incoming)
+        return incoming
+
+    def ask_save_path(self, incoming):
+        """Tk thread: ask where to save a pushed file, and move it there if
+        it has already arrived."""
+        save_path = filedialog.asksaveasfilename(
+            defaultextension=os.path.splitext(incoming['filename'])[1],
+            initialfile=incoming['filename'],
+            title=f"Save file from {incoming['sender']}"
+        )
+        incoming['save_path'] = save_path or None
+        incoming['asking'] = False
+        if incoming['complete']:
+            self.place_received_file(incoming)
+
+    def start_incoming_file(self, filename, sender, filesize, save_path, offset=0, transfer_id=None,
+                            download=None, temp_path=None, asking=False):
+        """Prepare to receive `filesize` bytes of file data that will be
+        written from `offset` into a temporary file next to `save_path` (or
+        into `temp_path`, or discarded if there is neither). Multiplexed
+        transfers are kept by `transfer_id`, anything else becomes
+        `self.incoming_file`. Requested downloads keep their `.part` file to
+        resume from and are checked against their hash once complete.
+        `asking` means the save path is still being asked for.
+        Returns the transfer."""
+        if temp_path is None and save_path:
+            temp_path = save_path + '.tmp'
+        if download is not None:
+            temp_path = self.part_path(download)
+        file = None
+        if temp_path:
+            file = open(temp_path, 'r+b' if offset else 'wb')
+            file.seek(offset)
+
+        incoming = {
+            'transfer_id': transfer_id,
+            'download': download,
+            'offset': offset,
+            'filename': filename,
+            'sender': sender,
+            'filesize': filesize,
+            'received': 0,
+            'save_path': save_path,
+            'temp_path': temp_path,
+            'file': file,
+            'asking': asking,
+            'complete': False,
+            'progress_window': None,
+            'progress_bar': None,
+            'progress_queued': False,
+        }
+        if transfer_id is None:
+            self.incoming_file = incoming
+        else:
+            self.incoming_transfers[transfer_id] = incoming
+
+        if file:
+            self.call_in_ui(self.show_receive_progress, incoming)
+        if filesize == 0:
+            self.finish_file_receive(incoming)
+        return incoming
+
+    def show_receive_progress(self, incoming):
+        """Tk thread: open the progress window of a file being received."""
+        if incoming['complete'] or incoming['file'] is None:
+            return
+        progress_window = customtkinter.CTkToplevel()
+        progress_window.title("Receiving File")
+        screen_width = progress_window.winfo_screenwidth()
+        screen_height = progress_window.winfo_screenheight()
+        x = (screen_width - 300) // 2
+        y = (screen_height - 150) // 2
+        progress_window.geometry(f"300x150+{x}+{y}")
+
+        progress_label = customtkinter.CTkLabel(
+            progress_window,
+            text=f"Receiving {incoming['filename']}..."
+        )
+        progress_label.pack(pady=10)
+
+        progress_bar = ttk.Progressbar(
+            progress_window,
+            length=200,
+            mode='determinate'
+        )
+        progress_bar.pack(pady=10)
+        incoming['progress_window'] = progress_window
+        incoming['progress_bar'] = progress_bar
+
+    def update_receive_progress(self, incoming):
+        incoming['progress_queued'] = False
+        if incoming['filesize'] and incoming['progress_window'] is not None:
+            incoming['progress_bar']['value'] = (incoming['received'] / incoming['filesize']) * 100
+
+    def close_receive_progress(self, incoming):
+        if incoming['progress_window'] is not None:
+            incoming['progress_window'].destroy()
+            incoming['progress_window'] = None
+
+    def handle_file_meta(self, meta):
+        """A file was shared: announce it, and have the Tk thread ask the
+        user whether to download it, so chat keeps flowing meanwhile."""
+        filename = os.path.basename(str(meta.get('name', 'file')))
+        sender = meta.get('sender', '')
+        filesize = int(meta.get('size', 0))
+        digest = meta.get('hash')
+        self.log_message(f"{sender} shared file: {filename} ({filesize / 1024:.1f} KB)")
+        self.call_in_ui(self.offer_download, filename, sender, filesize, digest)
+
+    def offer_download(self, filename, sender, filesize, digest):
+        """Tk thread: ask whether to download a shared file, and where to."""
+        if any(download['hash'] == digest for download in list(self.downloads.values())):
+            return
+        if not messagebox.askyesno("File Shared", f"{sender} shared {filename} "
+                                   f"({filesize / 1024:.1f} KB). Do you want to download it?"):
+            return
+        save_path = filedialog.asksaveasfilename(
+            defaultextension=os.path.splitext(filename)[1],
+            initialfile=filename,
+            title=f"Save file from {sender}"
+        )
+        if not save_path:
+            return
+
+        download = {
+            'hash': digest,
+            'filename': filename,
+            'sender': sender,
+            'filesize': filesize,
+            'save_path': save_path,
+        }
+        # Pick up where an earlier download to the same place stopped
+        part_path = self.part_path(download)
+        offset = min(os.path.getsize(part_path), filesize) if os.path.exists(part_path) else 0
+        self.request_download(download, offset)
+
+    def part_path(self, download):
+        """Where a download is kept until it is complete and verified."""
+        return f"{download['save_path']}.{download['hash'][:12]}.part"
+
+    def request_download(self, download, offset=0):
+        """Ask the server for a shared file from `offset` to the end."""
+        download.setdefault('retries', 0)
+        request = {
+            'hash': download['hash'],
+            'name': download['filename'],
+            'offset': offset,
+            'length': download['filesize'] - offset,
+        }
+        key = download['hash']
+        if self.multiplexes_files():
+            key = request['id'] = next(self.transfer_ids)
+        self.downloads[key] = download
+        self.remember_download(download)
+        self.send_message(MSG_BLOB_REQUEST, encode_json(request))
+
+    def retry_download(self, incoming, error):
+        """Request the rest of a download again after a damaged chunk,
+        keeping the data received so far."""
+        download = incoming['download']
+        position = incoming['offset'] + incoming['received']
+        self.forget_incoming(incoming)
+        self.call_in_ui(self.close_receive_progress, incoming)
+        incoming['file'].close()
+        if download['retries'] >= MAX_TRANSFER_RETRIES:
+            self.log_message(f"Download of {download['filename']} failed: {error}")
+            return
+        download['retries'] += 1
+        self.log_message(f"Resuming download of {download['filename']} from "
+                         f"{position / 1024:.1f} KB ({error})")
+        self.request_download(download, position)
+
+    def load_resumable(self):
+        try:
+            with open(self.resume_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_resumable(self, downloads):
+        try:
+            with open(self.resume_file, 'w', encoding='utf-8') as f:
+                json.dump(downloads, f)
+        except OSError as e:
+            self.log_message(f"Error saving downloads: {str(e)}")
+
+    def remember_download(self, download):
+        """Record an unfinished download so it can be resumed after a restart."""
+        with self.resume_lock:
+            downloads = self.load_resumable()
+            downloads[download['hash']] = {key: download[key] for key in
+                                           ('hash', 'filename', 'sender', 'filesize', 'save_path')}
+            self.save_resumable(downloads)
+
+    def forget_download(self, digest):
+        with self.resume_lock:
+            downloads = self.load_resumable()
+            if downloads.pop(digest, None) is not None:
+                self.save_resumable(downloads)
+
+    def resume_downloads(self):
+        """Offer to continue the downloads that were cut off last time."""
+        if self.protocol_version < PULL_ATTACHMENTS_VERSION:
+            return
+        for digest, download in self.load_resumable().items():
+            part_path = self.part_path(download)
+            if not os.path.exists(part_path):
+                self.forget_download(digest)
+                continue
+            offset = min(os.path.getsize(part_path), download['filesize'])
+            if messagebox.askyesno("Resume Download", f"Resume downloading {download['filename']} "
+                                   f"from {download['sender']} ({offset / 1024:.1f} of "
+                                   f"{download['filesize'] / 1024:.1f} KB received)?"):
+                self.request_download(download, offset)
+            else:
+                self.forget_download(digest)
                 try:
-                    self.sock.settimeout(None)
-                except:
+                    os.remove(part_path)
+                except OSError:
                     pass
 
-    def _consume_file_data(self, filesize):
-        """Helper method to consume unwanted file data"""
+    def begin_range_receive(self, info):
+        """The server is about to send a requested range of a file."""
+        transfer_id = info.get('id')
+        download = self.downloads.pop(info.get('hash') if transfer_id is None else transfer_id, None)
+        if info.get('error'):
+            if download:
+                self.log_message(f"File '{download['filename']}' is no longer available")
+                self.forget_download(download['hash'])
+            return
+        if download is None:
+            # Not (or no longer) wanted: read past the data
+            self.start_incoming_file(info.get('hash'), '', int(info.get('length', 0)), None,
+                                     transfer_id=transfer_id)
+            return
         try:
-            remaining = filesize
-            while remaining > 0:
-                chunk_size = min(8192, remaining)
-                self.sock.recv(chunk_size)
-                remaining -= chunk_size
-        except:
-            pass
+            self.start_incoming_file(download['filename'], download['sender'], int(info['length']),
+                                     download['save_path'], offset=int(info.get('offset', 0)),
+                                     transfer_id=transfer_id, download=download)
+        except Exception as e:
+            self.call_in_ui(messagebox.showerror, "Error", f"Failed to receive file: {str(e)}")
+            self.log_message(f"Error receiving file: {str(e)}")
+            self.abort_file_receive()
+
+    def receive_file_chunk(self, chunk, incoming=None):
+        """Write one chunk of the file currently being received (or of the
+        multiplexed transfer `incoming`)."""
+        incoming = incoming or self.incoming_file
+        if incoming is None:
+            return
+        try:
+            if incoming['file']:
+                incoming['file'].write(chunk)
+                if not incoming['progress_queued']:
+                    # One update waiting in the UI queue is enough
+                    incoming['progress_queued'] = True
+                    self.call_in_ui(self.update_receive_progress, incoming)
+            incoming['received'] += len(chunk)
+            if incoming['received'] >= incoming['filesize']:
+                self.finish_file_receive(incoming)
+        except Exception as e:
+            self.call_in_ui(messagebox.showerror, "Error", f"Failed to receive file: {str(e)}")
+            self.log_message(f"Error receiving file: {str(e)}")
+            self.abort_file_receive(incoming)
+
+    def forget_incoming(self, incoming):
+        if incoming is self.incoming_file:
+            self.incoming_file = None
+        else:
+            self.incoming_transfers.pop(incoming['transfer_id'], None)
+
+    def finish_file_receive(self, incoming=None):
+        """Close a completely received file, check it, and have the Tk
+        thread move it into place."""
+        incoming = incoming or self.incoming_file
+        self.forget_incoming(incoming)
+        if not incoming['file']:
+            self.call_in_ui(self.close_receive_progress, incoming)
+            return
+
+        incoming['file'].close()
+        download = incoming['download']
+        if download is not None:
+            self.forget_download(download['hash'])
+            if file_digest(incoming['temp_path']) != download['hash']:
+                os.remove(incoming['temp_path'])
+                self.call_in_ui(self.close_receive_progress, incoming)
+                self.call_in_ui(messagebox.showerror, "Error", f"{incoming['filename']} was damaged "
+                                "in transfer. Please download it again.")
+                self.log_message(f"Error receiving file: {incoming['filename']} failed verification")
+                return
+        self.call_in_ui(self.place_received_file, incoming)
+
+    def place_received_file(self, incoming):
+        """Tk thread: move a received file to where the user wants it. A
+        pushed file whose save dialog is still open is moved once it closes."""
+        self.close_receive_progress(incoming)
+        incoming['complete'] = True
+        if incoming['asking']:
+            return
+        save_path = incoming['save_path']
+        if not save_path:
+            # Declined after it was pushed
+            os.remove(incoming['temp_path'])
+            return
+        try:
+            if os.path.exists(save_path):
+                os.remove(save_path)
+            shutil.move(incoming['temp_path'], save_path)
+        except OSError as e:
+            messagebox.showerror("Error", f"Failed to receive file: {str(e)}")
+            self.log_message(f"Error receiving file: {str(e)}")
+            return
+
+        filename = incoming['filename']
+        self.log_message(f"Received file '{filename}' from {incoming['sender']}")
+
+        if messagebox.askyesno("File Received", f"File saved successfully. Do you want to open {filename}?"):
+            try:
+                os.startfile(save_path)
+            except AttributeError:
+                import subprocess
+                subprocess.call(('xdg-open', save_path))
+            except Exception:
+                messagebox.showwarning("Error", "Could not open file automatically. Please open it manually.")
+
+    def abort_file_receive(self, incoming=None):
+        """Drop a partially received file. Any data still to come for it is
+        read and discarded."""
+        incoming = incoming or self.incoming_file
+        if incoming is None:
+            return
+        self.forget_incoming(incoming)
+        self.call_in_ui(self.close_receive_progress, incoming)
+        if incoming['file']:
+            incoming['file'].close()
+            incoming['file'] = None
+            try:
+                os.remove(incoming['temp_path'])
+            except:
+                pass
+        if incoming['download'] is not None:
+            self.forget_download(incoming['download']['hash'])
+
+    def handle_text(self, decoded_message):
+        """Display and store a chat line or notification."""
+        if decoded_message.strip() == 'NICK':
+            return
+
+        # Add timestamp for messages without one
+        if not decoded_message.startswith('['):
+            timestamp = datetime.datetime.now().strftime('%H:%M:%S')
+            decoded_message = f"[{timestamp}] {decoded_message}"
+
+        # Save non-notification messages to history
+        key = None
+        if not any(x in decoded_message for x in ["joined the chat", "left the chat"]):
+            key = self.save_to_history(decoded_message)
+
+        # Handle messages
+        self.log_message(decoded_message, key=key)
+
+    def handle_event(self, event):
+        """Show a message envelope from the server. Its kind says what it
+        is, so nothing has to be guessed from the text."""
+        kind = event.get('kind')
+        if kind in (EVENT_JOIN, EVENT_LEAVE, EVENT_SYSTEM):
+            # Notices from the server, not messages someone wrote
+            self.log_message(event['text'], style='notification')
+            return
+        line = event_line(event)
+        key = None
+        if kind in (EVENT_CHAT, EVENT_DM):
+            # Only messages people wrote are kept in the history
+            position = self.local_history.append(line)
+            key = None if position is None else ('local', position)
+        style = 'self' if event.get('sender') == self.nickname else 'other'
+        self.log_message(line, key=key, style=style)
+
+    def handle_frame(self, msg_type, payload):
+        """Dispatch one frame received from the server."""
+        if msg_type == MSG_COMPRESSED:
+            msg_type, payload = decompress_frame(payload)
+        if msg_type == MSG_COMPACT_EVENT:
+            self.handle_event(decode_compact_event(payload, self.names))
+        elif msg_type == MSG_NAME:
+            name_id, name = parse_name(payload)
+            self.names[name_id] = name
+        elif msg_type == MSG_NICKNAME:
+            # Ours was taken: the server added a suffix
+            self.nickname = payload.decode('utf-8')
+            self.call_in_ui(self.show_nickname)
+        elif msg_type == MSG_EVENT:
+            self.handle_event(decode_json(payload))
+        elif msg_type == MSG_TEXT:
+            self.handle_text(payload.decode('utf-8'))
+        elif msg_type == MSG_FILE_HEADER:
+            self.begin_file_receive(payload.decode('utf-8'))
+        elif msg_type == MSG_FILE_DATA:
+            self.receive_file_chunk(payload)
+        elif msg_type == MSG_HISTORY:
+            self.handle_history(decode_json(payload))
+        elif msg_type == MSG_FILE_META:
+            self.handle_file_meta(decode_json(payload))
+        elif msg_type == MSG_BLOB_RANGE:
+            self.begin_range_receive(decode_json(payload))
+        elif msg_type == MSG_TRANSFER_CHUNK:
+            try:
+                transfer_id, offset, data = parse_chunk(payload, self.checks_chunks())
+            except ChecksumError as e:
+                incoming = self.incoming_transfers.get(e.transfer_id)
+                if incoming and incoming['download']:
+                    self.retry_download(incoming, "checksum mismatch")
+                return
+            incoming = self.incoming_transfers.get(transfer_id)
+            if incoming is None:
+                return
+            if (offset is not None and incoming['download']
+                    and offset != incoming['offset'] + incoming['received']):
+                self.retry_download(incoming, "unexpected offset")
+                return
+            self.receive_file_chunk(data, incoming)
+        elif msg_type == MSG_TRANSFER_ABORT:
+            self.resume_upload(decode_json(payload))
+        elif msg_type == MSG_FILE_NEED:
+            reply = decode_json(payload)
+            offer = self.pending_offers.get(reply.get('hash'))
+            if offer:
+                offer['need'] = bool(reply.get('need', True))
+                offer['offset'] = int(reply.get('offset', 0))
+                offer['event'].set()
+        elif msg_type == MSG_FILE_ABORT:
+            if self.incoming_file:
+                self.log_message(f"File '{self.incoming_file['filename']}' from "
+                                 f"{self.incoming_file['sender']} was not completed")
+            self.abort_file_receive()
 
     def receive(self):
         while self.running:
             try:
-                message = self.sock.recv(8192)
-                if message:
+                message = self.pending or self.sock.recv(8192)
+                self.pending = b''
+                if self.framed:
+                    if not message:
+                        raise ConnectionError("Connection closed by server")
+                    for msg_type, payload in self.decoder.feed(message):
+                        self.handle_frame(msg_type, payload)
+                elif message:
                     if message.startswith(b'FILE:'):
                         self.handle_file_receive(message.decode('utf-8'))
                     else:
-                        decoded_message = message.decode('utf-8')
-                        
-                        if decoded_message.strip() == 'NICK':
-                            continue
-
-                        # Add timestamp for messages without one
-                        if not decoded_message.startswith('['):
-                            timestamp = datetime.datetime.now().strftime('%H:%M:%S')
-                            decoded_message = f"[{timestamp}] {decoded_message}"
-
-                        # Handle messages
-                        self.log_message(decoded_message)
-
-                        # Save non-notification messages to history
-                        if not any(x in decoded_message for x in ["joined the chat", "left the chat"]):
-                            self.save_to_history(decoded_message)
+                        self.handle_text(message.decode('utf-8'))
                                 
             except Exception as e:
                 if self.running:
@@ -797,6 +1791,9 @@ class Client:
             
     def stop(self):
         self.running = False
+        with self.send_cond:
+            self.send_cond.notify_all()
+        self.local_history.close()
         self.win.destroy()
         self.sock.close()
         sys.exit(0)
@@ -0,0 +1,322 @@
+# cluster.py
+"""Clustering several chat servers into one chat.
+
+Each server (a "node") publishes its room messages, joins, leaves and
+direct messages to a pub/sub backend and delivers what the other nodes
+publish to its own clients (see ChatServer.apply_bus_event). Backends are
+pluggable: anything with the PubSubBackend interface can be passed to
+ChatServer as its `bus`.
+
+Two backends are included:
+
+- LoopbackBackend connects servers in one process through a
+  LoopbackBroker, for tests.
+- TcpBackend connects to a TcpBroker, which relays every node's events to
+  all other nodes. Run the broker with ``python cluster.py --port 9000``
+  and start each server with ``--cluster brokerhost:9000``.
+
+Backends may deliver an event twice or out of order (a broker that
+redelivers after a reconnect, several brokers, ...). ClusterBus sits on
+top of a backend, numbers the events this node publishes, and delivers
+each other node's events exactly once, in the order it published them.
+"""
+import argparse
+import collections
+import itertools
+import json
+import logging
+import selectors
+import socket
+import threading
+import uuid
+
+from protocol import FrameDecoder
+from worker_bus import BusClient, BusHub
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BROKER_PORT = 9000
+
+# Out-of-order events kept per node while waiting for a missing one
+MAX_PENDING_EVENTS = 1024
+
+
+def new_node_id():
+    """Random id, so a restarted node does not look like the old one."""
+    return uuid.uuid4().hex[:12]
+
+
+class PubSubBackend:
+    """Interface of a cluster backend.
+
+    publish() sends a JSON-serialisable event dict to every other node,
+    stamped with this node's id as ``node``; it must not block on the
+    network. The callback given to start() receives the other nodes'
+    events, from one thread at a time. A backend should send
+    ``{'type': 'node_down', 'node': id}`` when it learns that a node has
+    gone, so its users can be removed.
+    """
+
+    def __init__(self, node_id=None):
+        self.node_id = node_id or new_node_id()
+
+    def start(self, on_event):
+        raise NotImplementedError
+
+    def publish(self, event):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+
+class LoopbackBroker:
+    """Connects the LoopbackBackends of servers running in one process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.backends = []
+
+    def attach(self, backend):
+        with self.lock:
+            self.backends.append(backend)
+
+    def detach(self, backend):
+        with self.lock:
+            if backend not in self.backends:
+                return
+            self.backends.remove(backend)
+        self.deliver({'type': 'node_down', 'node': backend.node_id}, backend)
+
+    def deliver(self, event, sender):
+        with self.lock:
+            backends = [b for b in self.backends if b is not sender]
+        for backend in backends:
+            backend.receive(event)
+
+
+class LoopbackBackend(PubSubBackend):
+    """In-process backend. Events are handed to the receiving node's own
+    thread, as a network backend would, so a node never handles an event
+    inside the call that published it."""
+
+    def __init__(self, broker, node_id=None):
+        super().__init__(node_id)
+        self.broker = broker
+        self.inbox = collections.deque()
+        self.cond = threading.Condition()
+        self.closed = False
+
+    def start(self, on_event):
+        self.broker.attach(self)
+        threading.Thread(target=self._dispatch_loop, args=(on_event,), daemon=True).start()
+
+    def publish(self, event):
+        if self.closed:
+            return
+        # Round-trip through JSON like the network backends do
+        self.broker.deliver(json.loads(json.dumps(dict(event, node=self.node_id))), self)
+
+    def receive(self, event):
+        with self.cond:
+            self.inbox.append(event)
+            self.cond.notify()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.broker.detach(self)
+
+    def _dispatch_loop(self, on_event):
+        while True:
+            with self.cond:
+                while not self.inbox and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    return
+                event = self.inbox.popleft()
+            try:
+                on_event(event)
+            except Exception as e:
+                logger.error(f"Error handling cluster event: {e}")
+
+
+class TcpBackend(BusClient):
+    """Backend connected to a TcpBroker; the worker bus client over TCP."""
+
+    def __init__(self, address, node_id=None):
+        super().__init__(socket.create_connection(address), node_id or new_node_id())
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class TcpBroker(BusHub):
+    """Relays the events of every connected node to all the others.
+
+    Nodes connect and disconnect at any time. A node's first event is its
+    hello (see ChatServer.__init__), which tells the broker the node id to
+    announce in node_down when the connection closes.
+    """
+
+    def __init__(self, host='0.0.0.0', port=DEFAULT_BROKER_PORT):
+        super().__init__()
+        self.listener = socket.create_server((host, port))
+        self.connection_ids = itertools.count(1)
+        # Connection id -> node id, once known
+        self.nodes = {}
+        self.closed = False
+
+    def serve(self):
+        """Relay events until close() is called."""
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.listener, selectors.EVENT_READ, None)
+        logger.info(f"Cluster broker listening on {self.listener.getsockname()}")
+        while not self.closed:
+            # Time out now and then so close() from another thread is noticed
+            for key, _ in self.selector.select(timeout=0.5):
+                self._ready(key)
+
+    def close(self):
+        self.closed = True
+        try:
+            self.listener.close()
+        except OSError:
+            pass
+        super().close()
+
+    def _ready(self, key):
+        if key.data is not None:
+            super()._ready(key)
+            return
+        sock, address = self.listener.accept()
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection_id = next(self.connection_ids)
+        self.workers[connection_id] = sock
+        self.decoders[connection_id] = FrameDecoder()
+        self.selector.register(sock, selectors.EVENT_READ, connection_id)
+        logger.info(f"Node connected from {address}")
+
+    def _relay(self, connection_id, frames):
+        if connection_id not in self.nodes:
+            try:
+                self.nodes[connection_id] = json.loads(frames[0][1])['node']
+            except (ValueError, KeyError) as e:
+                logger.error(f"Dropping node that did not identify itself: {e}")
+                self._drop(connection_id)
+                return
+        super()._relay(connection_id, frames)
+
+    def _node_id(self, connection_id):
+        return self.nodes.pop(connection_id, connection_id)
+
+
+class ClusterBus:
+    """Numbers the events this node publishes and delivers the events of
+    every other node exactly once and in the order that node published
+    them, whatever the backend underneath does.
+
+    Duplicates are recognised by their id (node id and sequence number).
+    An event that arrives early is held back until the ones before it
+    have been delivered; if one of them never comes, delivery skips ahead
+    once MAX_PENDING_EVENTS are waiting rather than stalling that node.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.node_id = backend.node_id
+        self.on_event = None
+        self.lock = threading.Lock()
+        self.seq = 0
+        # Node id -> next sequence number to deliver, and the events
+        # received ahead of it by sequence number
+        self.next_seq = {}
+        self.pending = {}
+
+        # Counters
+        self.delivered_events = 0
+        self.duplicate_events = 0
+        self.skipped_events = 0
+
+    def start(self, on_event):
+        self.on_event = on_event
+        self.backend.start(self._receive)
+
+    def publish(self, event):
+        with self.lock:
+            # Numbered and handed on under the lock, so the backend gets
+            # them in sequence
+            self.seq += 1
+            self.backend.publish(dict(event, seq=self.seq, id=f"{self.node_id}:{self.seq}"))
+
+    def close(self):
+        self.backend.close()
+
+    def _receive(self, event):
+        node = event.get('node')
+        seq = event.get('seq')
+        if seq is None:
+            # From the backend itself rather than a node
+            if event.get('type') == 'node_down':
+                with self.lock:
+                    self.next_seq.pop(node, None)
+                    self.pending.pop(node, None)
+            self.on_event(event)
+            return
+
+        with self.lock:
+            expected = self.next_seq.get(node, seq)
+            pending = self.pending.setdefault(node, {})
+            if seq < expected or seq in pending:
+                self.duplicate_events += 1
+                return
+            pending[seq] = event
+            ready = []
+            while pending:
+                if expected in pending:
+                    ready.append(pending.pop(expected))
+                    expected += 1
+                elif len(pending) > MAX_PENDING_EVENTS:
+                    missing = min(pending) - expected
+                    logger.warning(f"Skipping {missing} lost events from node {node}")
+                    self.skipped_events += missing
+                    expected = min(pending)
+                else:
+                    break
+            self.next_seq[node] = expected
+            self.delivered_events += len(ready)
+
+        # _receive is only ever called from one thread, so the order holds
+        for ready_event in ready:
+            self.on_event(ready_event)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'node_id': self.node_id,
+                'published_events': self.seq,
+                'delivered_events': self.delivered_events,
+                'duplicate_events': self.duplicate_events,
+                'skipped_events': self.skipped_events,
+            }
+
+
+def parse_address(text, default_port=DEFAULT_BROKER_PORT):
+    """"host:port" (or just "host") -> (host, port)."""
+    host, _, port = text.rpartition(':') if ':' in text else (text, '', '')
+    return host, int(port) if port else default_port
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Cluster broker for chat servers")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=DEFAULT_BROKER_PORT)
+    args = parser.parse_args()
+
+    broker = TcpBroker(args.host, args.port)
+    try:
+        broker.serve()
+    except KeyboardInterrupt:
+        logger.info("Broker stopped by user")
+    finally:
+        broker.close()
@@ -0,0 +1,252 @@
+# history_store.py
+"""Server-side message history.
+
+Chat lines are kept in a SQLite database in WAL mode, indexed by room and
+message id, so "the last N messages of a room before id X" is one index
+range scan however long the history gets. Message ids only ever grow.
+
+Like ChatLog, appending never waits for the disk: rows get their id
+immediately, are buffered, and a background thread inserts them in
+batches. Queries also see the rows that are still buffered.
+
+Messages are also added to an FTS5 full-text index, so search() finds the
+messages containing some words without scanning the table. Admins can
+search from the command line:
+
+    python history_store.py --history-dir history "some words" --room lobby
+"""
+import argparse
+import datetime
+import glob
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from search_index import tokenize
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    room TEXT NOT NULL,
+    time REAL NOT NULL,
+    text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_room_id ON messages (room, id);
+"""
+
+# Indexes the text of `messages` without keeping a second copy of it
+FULL_TEXT_SCHEMA = """
+CREATE VIRTUAL TABLE messages_fts USING fts5(text, content='messages', content_rowid='id');
+INSERT INTO messages_fts (messages_fts) VALUES ('rebuild');
+"""
+
+
+class HistoryStore:
+    def __init__(self, directory='history', batch_size=256, flush_interval=0.5):
+        """Open (or create) the history database under `directory`."""
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, 'messages.db')
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.cond = threading.Condition()
+        # Rows (id, room, time, text) waiting for the writer, and the
+        # batch it is inserting right now
+        self.pending = []
+        self.writing = []
+        self.closed = False
+        self.written_rows = 0
+
+        # Queries share one connection; the writer thread has its own
+        self.read_lock = threading.Lock()
+        self.reader = self._connect()
+        self.full_text = self._create_full_text_index(self.reader)
+        last_id = self.reader.execute('SELECT MAX(id) FROM messages').fetchone()[0]
+        self.next_id = (last_id or 0) + 1
+
+        self.thread = threading.Thread(target=self._writer_loop, daemon=True)
+        self.thread.start()
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        # With WAL, NORMAL only risks the last transactions on power loss
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.executescript(SCHEMA)
+        return db
+
+    def _create_full_text_index(self, db):
+        """Create the full-text index (indexing the messages stored so far)
+        unless it exists. False if SQLite was built without FTS5."""
+        if db.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone():
+            return True
+        try:
+            with db:
+                db.executescript(FULL_TEXT_SCHEMA)
+        except sqlite3.OperationalError as e:
+            logger.warning(f"No full-text index, searches will scan the history: {e}")
+            return False
+        return True
+
+    def append(self, room, text):
+        """Add a message to a room's history and return its id."""
+        with self.cond:
+            if self.closed:
+                return None
+            message_id = self.next_id
+            self.next_id += 1
+            self.pending.append((message_id, room, time.time(), text))
+            if len(self.pending) >= self.batch_size:
+                self.cond.notify()
+        return message_id
+
+    def page(self, room, before=None, limit=50):
+        """The last `limit` messages of `room` with an id below `before`
+        (the newest ones if None), oldest first, as dicts with id, time and
+        text; and whether there are older messages."""
+        with self.cond:
+            bound = self.next_id if before is None else before
+            buffered = [row for row in self.writing + self.pending
+                        if row[1] == room and row[0] < bound]
+        # One extra row tells whether there is more
+        rows = buffered[-(limit + 1):]
+        if len(rows) <= limit:
+            # Everything older than the buffered rows is in the database
+            if buffered:
+                bound = buffered[0][0]
+            with self.read_lock:
+                older = self.reader.execute(
+                    'SELECT id, room, time, text FROM messages WHERE room = ? AND id < ? '
+                    'ORDER BY id DESC LIMIT ?', (room, bound, limit + 1 - len(rows))).fetchall()
+            rows = older[::-1] + rows
+        more = len(rows) > limit
+        if more:
+            rows = rows[1:]
+        return [{'id': row[0], 'time': row[2], 'text': row[3]} for row in rows], more
+
+    def search(self, query, room=None, limit=50):
+        """The last `limit` messages containing every word of `query` (in
+        `room`, or in any room if None), newest first, as dicts with id,
+        room, time and text."""
+        words = tokenize(query)
+        if not words:
+            return []
+        with self.cond:
+            unwritten = self.writing + self.pending
+            # Everything older than the buffered rows is in the database
+            bound = unwritten[0][0] if unwritten else self.next_id
+        buffered = [row for row in unwritten
+                    if (room is None or row[1] == room) and _contains_words(row[3], words)]
+        rows = buffered[::-1][:limit]
+        if len(rows) < limit:
+            sql, params = self._search_sql(words, room)
+            with self.read_lock:
+                rows += self.reader.execute(sql, params + [bound, limit - len(rows)]).fetchall()
+        return [{'id': row[0], 'room': row[1], 'time': row[2], 'text': row[3]} for row in rows]
+
+    def _search_sql(self, words, room):
+        if self.full_text:
+            # Quoted, so words are never taken for FTS5 operators. CROSS
+            # JOIN makes SQLite walk the full-text matches, newest first,
+            # rather than the room's messages
+            sql = ('SELECT m.id, m.room, m.time, m.text FROM messages_fts f '
+                   'CROSS JOIN messages m ON m.id = f.rowid WHERE messages_fts MATCH ?')
+            params = [' '.join(f'"{word}"' for word in words)]
+        else:
+            sql = 'SELECT m.id, m.room, m.time, m.text FROM messages m WHERE ' + \
+                  ' AND '.join('m.text LIKE ?' for _ in words)
+            params = [f'%{word}%' for word in words]
+        if room is not None:
+            sql += ' AND m.room = ?'
+            params.append(room)
+        order = 'f.rowid' if self.full_text else 'm.id'
+        return sql + f' AND {order} < ? ORDER BY {order} DESC LIMIT ?', params
+
+    def close(self):
+        """Write out the buffered rows and stop the writer."""
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.cond.notify()
+        self.thread.join()
+        with self.read_lock:
+            self.reader.close()
+
+    def stats(self):
+        with self.cond:
+            return {
+                'path': self.path,
+                'buffered_rows': len(self.pending) + len(self.writing),
+                'written_rows': self.written_rows,
+                'next_id': self.next_id,
+            }
+
+    def _writer_loop(self):
+        db = self._connect()
+        while True:
+            with self.cond:
+                if not self.closed and len(self.pending) < self.batch_size:
+                    self.cond.wait(self.flush_interval)
+                self.writing = self.pending
+                self.pending = []
+                closing = self.closed
+
+            if self.writing:
+                written = 0
+                try:
+                    with db:
+                        db.executemany('INSERT INTO messages VALUES (?, ?, ?, ?)', self.writing)
+                        if self.full_text:
+                            db.executemany('INSERT INTO messages_fts (rowid, text) VALUES (?, ?)',
+                                           [(row[0], row[3]) for row in self.writing])
+                    written = len(self.writing)
+                except sqlite3.Error as e:
+                    logger.error(f"Error storing message history: {e}")
+                with self.cond:
+                    self.written_rows += written
+                    self.writing = []
+            if closing:
+                db.close()
+                return
+
+
+def _contains_words(text, words):
+    text = text.lower()
+    # The substring test rules out most lines before tokenizing them
+    return all(word in text for word in words) and set(words) <= set(tokenize(text))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Search the chat server's message history")
+    parser.add_argument('query', help="words the messages must all contain")
+    parser.add_argument('--history-dir', default='history',
+                        help="history directory of the server (workers' subdirectories included)")
+    parser.add_argument('--room', help="only search this room")
+    parser.add_argument('--limit', type=int, default=50)
+    args = parser.parse_args()
+
+    directories = [os.path.dirname(path) for path in
+                   sorted(glob.glob(os.path.join(args.history_dir, '**', 'messages.db'), recursive=True))]
+    if not directories:
+        parser.error(f"No message history in {args.history_dir}")
+    started = time.perf_counter()
+    results = []
+    for directory in directories:
+        store = HistoryStore(directory)
+        try:
+            results += store.search(args.query, args.room, args.limit)
+        finally:
+            store.close()
+    # Ids of different workers are unrelated: order by time
+    results.sort(key=lambda message: message['time'], reverse=True)
+    elapsed = (time.perf_counter() - started) * 1000
+    for message in results[:args.limit]:
+        timestamp = datetime.datetime.fromtimestamp(message['time']).strftime('%Y-%m-%d %H:%M:%S')
+        print(f"[{timestamp}] #{message['room']} {message['text']}")
+    print(f"{min(len(results), args.limit)} results in {elapsed:.1f} ms")
@@ -0,0 +1,375 @@
+# local_history.py
+"""The client's local chat history.
+
+Lines are appended to numbered segment files in a directory
+(``chat_history/000001.txt``, ...). A new segment is started once the
+current one reaches SEGMENT_BYTES, and when there are more than
+MAX_SEGMENTS the oldest one is deleted, so trimming never rewrites any
+data. ``index.json`` lists the segments with their sizes and line counts;
+it is only rewritten when a segment is started or dropped.
+
+append() only queues the line: a background thread writes the queued
+lines in batches, so the UI thread never waits on the disk. Still, append()
+returns the position (segment id, byte offset) the line will be written
+at, and reading goes backwards from such a position, a page at a time;
+see read_before().
+
+Each segment also has a search index, ``000001.idx`` (see search_index.py).
+The writer adds lines to it as it writes them, and saves it when the
+segment is full or the history is closed; whatever a saved index does not
+cover yet is indexed again on opening. search() finds the lines that
+contain all the words of a query.
+"""
+import json
+import logging
+import os
+import re
+import threading
+
+from search_index import InvertedIndex
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_BYTES = 256 * 1024
+MAX_SEGMENTS = 8
+
+INDEX_NAME = 'index.json'
+SEGMENT_NAME = re.compile(r'^(\d{6})\.txt$')
+
+
+def read_lines_before(path, end, count, block_size=64 * 1024):
+    """Return up to `count` lines of a file that end at byte offset `end`,
+    as (offset, line) pairs, and the offset where the first of them
+    starts. The file is read backwards in blocks, so only about as much as
+    is returned is read."""
+    data = b''
+    start = end
+    with open(path, 'rb') as f:
+        while start > 0 and data.count(b'\n') <= count:
+            size = min(block_size, start)
+            start -= size
+            f.seek(start)
+            data = f.read(size) + data
+    lines = data.splitlines(keepends=True)
+    if start > 0 or len(lines) > count:
+        # The first line may be cut off
+        lines = lines[-count:]
+    first = end - sum(len(line) for line in lines)
+    entries = []
+    offset = first
+    for line in lines:
+        entries.append((offset, line.decode('utf-8', errors='replace')))
+        offset += len(line)
+    return entries, first
+
+
+class LocalHistory:
+    def __init__(self, directory='chat_history', legacy_file=None, batch_size=64, flush_interval=0.5):
+        """Open (or create) the history in `directory`. A `legacy_file` in
+        the old single-file format is adopted as the first segment."""
+        self.directory = directory
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        os.makedirs(directory, exist_ok=True)
+
+        # Lines waiting for the writer thread
+        self.cond = threading.Condition()
+        self.lines = []
+        self.closed = False
+        # Where the next line appended will be written
+        self.tail = None
+
+        # Segments as dicts {id, bytes, lines}, oldest first; the last one
+        # is written to. Guarded by `lock`, like the open segment file.
+        self.lock = threading.Lock()
+        self.segments = self._load_index()
+        if not self.segments and legacy_file and os.path.exists(legacy_file):
+            os.replace(legacy_file, self._path(1))
+            self.segments = self._scan()
+            self._save_index()
+        if not self.segments:
+            self.segments = [{'id': 1, 'bytes': 0, 'lines': 0}]
+        self.file = None
+        # Segment id -> its search index
+        self.indexes = {}
+        self._load_indexes()
+        self.tail = (self.segments[-1]['id'], self.segments[-1]['bytes'])
+
+        self.thread = threading.Thread(target=self._writer_loop, daemon=True)
+        self.thread.start()
+
+    def _path(self, segment_id):
+        return os.path.join(self.directory, f"{segment_id:06d}.txt")
+
+    def _index_path(self, segment_id):
+        return os.path.join(self.directory, f"{segment_id:06d}.idx")
+
+    def _load_index(self):
+        """Segments from the index, or from the directory if the index is
+        missing or out of date (e.g. after a crash)."""
+        try:
+            with open(os.path.join(self.directory, INDEX_NAME), encoding='utf-8') as f:
+                segments = json.load(f)['segments']
+            for segment in segments:
+                if not os.path.exists(self._path(segment['id'])):
+                    return self._scan()
+        except (OSError, ValueError, KeyError, TypeError):
+            return self._scan()
+        if segments:
+            # Only the last segment can have grown since the index was saved
+            last = segments[-1]
+            size = os.path.getsize(self._path(last['id']))
+            if size != last['bytes']:
+                last.update(self._measure(last['id']))
+        return segments
+
+    def _scan(self):
+        segments = []
+        for name in sorted(os.listdir(self.directory)):
+            match = SEGMENT_NAME.match(name)
+            if match:
+                segments.append(dict(self._measure(int(match.group(1))), id=int(match.group(1))))
+        return segments
+
+    def _measure(self, segment_id):
+        with open(self._path(segment_id), 'rb') as f:
+            data = f.read()
+        return {'bytes': len(data), 'lines': data.count(b'\n')}
+
+    def _load_indexes(self):
+        """Load the segments' search indexes and index what they miss."""
+        for segment in self.segments:
+            index = InvertedIndex.load(self._index_path(segment['id']))
+            if index is None or index.covered > segment['bytes']:
+                index = InvertedIndex()
+            if index.covered < segment['bytes']:
+                try:
+                    with open(self._path(segment['id']), 'rb') as f:
+                        f.seek(index.covered)
+                        for data in f:
+                            index.add(index.covered, data.decode('utf-8', errors='replace'))
+                            index.covered += len(data)
+                except OSError as e:
+                    logger.error(f"Error indexing chat history: {e}")
+            self.indexes[segment['id']] = index
+
+    def _save_index(self):
+        path = os.path.join(self.directory, INDEX_NAME)
+        try:
+            with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump({'segments': self.segments}, f)
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            logger.error(f"Error saving history index: {e}")
+
+    def append(self, line):
+        """Queue a line to be written and return the position it will be
+        written at (None once closed). Never blocks on disk I/O."""
+        size = len(line.encode('utf-8')) + 1
+        with self.cond:
+            if self.closed:
+                return None
+            position = self.tail
+            # The writer starts a new segment after the line that fills one
+            segment_id, offset = position
+            offset += size
+            self.tail = (segment_id + 1, 0) if offset >= SEGMENT_BYTES else (segment_id, offset)
+            self.lines.append(line)
+            if len(self.lines) >= self.batch_size:
+                self.cond.notify()
+        return position
+
+    def end(self):
+        """Position just after the last line appended."""
+        with self.cond:
+            return self.tail
+
+    def flush(self):
+        """Write the queued lines now rather than when the writer gets to
+        them."""
+        with self.lock:
+            with self.cond:
+                batch = self.lines
+                self.lines = []
+            if batch:
+                self._write(batch)
+
+    def read_before(self, position, count, start=None):
+        """Up to `count` lines before `position` (but not before `start`,
+        if given), oldest first, as (position, line) pairs; and the position
+        of the first of them, or None when there is nothing older."""
+        if position is None:
+            return [], None
+        with self.lock:
+            ids = [segment['id'] for segment in self.segments]
+            written = (self.segments[-1]['id'], self.segments[-1]['bytes'])
+        if position > written:
+            # Lines still queued are read too
+            self.flush()
+        segment_id, offset = position
+        entries = []
+        while len(entries) < count:
+            if start is not None and (segment_id, offset) <= start:
+                return entries, None
+            if offset == 0:
+                earlier = [i for i in ids if i < segment_id]
+                if not earlier:
+                    return entries, None
+                segment_id = earlier[-1]
+                try:
+                    offset = os.path.getsize(self._path(segment_id))
+                except OSError:
+                    # Trimmed in the meantime
+                    return entries, None
+                continue
+            try:
+                page, offset = read_lines_before(self._path(segment_id), offset, count - len(entries))
+            except OSError:
+                return entries, None
+            page = [((segment_id, line_offset), line) for line_offset, line in page
+                    if start is None or (segment_id, line_offset) >= start]
+            entries = page + entries
+            if start is not None and (segment_id, offset) < start:
+                return entries, None
+        return entries, (segment_id, offset)
+
+    def search(self, query, limit=100):
+        """The last `limit` lines containing every word of `query`, newest
+        first."""
+        hits = []
+        with self.lock:
+            for segment in reversed(self.segments):
+                offsets = self.indexes[segment['id']].lookup(query)
+                hits.extend((segment['id'], offset) for offset in reversed(offsets[-(limit - len(hits)):]))
+                if len(hits) >= limit:
+                    break
+        lines = []
+        files = {}
+        try:
+            for segment_id, offset in hits:
+                if segment_id not in files:
+                    files[segment_id] = open(self._path(segment_id), 'rb')
+                f = files[segment_id]
+                f.seek(offset)
+                lines.append(f.readline().decode('utf-8', errors='replace').rstrip('\n'))
+        except OSError:
+            # Trimmed in the meantime
+            pass
+        finally:
+            for f in files.values():
+                f.close()
+        return lines
+
+    def clear(self):
+        """Delete the whole history."""
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            for segment in self.segments:
+                self._remove_segment(segment['id'])
+            self.segments = [{'id': self.segments[-1]['id'] + 1, 'bytes': 0, 'lines': 0}]
+            self.indexes = {self.segments[0]['id']: InvertedIndex()}
+            self._save_index()
+            with self.cond:
+                self.lines = []
+                self.tail = (self.segments[0]['id'], 0)
+
+    def close(self):
+        """Write out the queued lines and stop the writer."""
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.cond.notify()
+        self.thread.join()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'segments': len(self.segments),
+                'bytes': sum(segment['bytes'] for segment in self.segments),
+                'lines': sum(segment['lines'] for segment in self.segments),
+            }
+
+    def _writer_loop(self):
+        while True:
+            with self.cond:
+                if not self.closed and len(self.lines) < self.batch_size:
+                    self.cond.wait(self.flush_interval)
+                closing = self.closed
+
+            with self.lock:
+                # Taken under `lock`, so a flush() cannot write later lines first
+                with self.cond:
+                    batch = self.lines
+                    self.lines = []
+                if batch:
+                    self._write(batch)
+                if closing:
+                    if self.file is not None:
+                        self.file.close()
+                        self.file = None
+                    segment_id = self.segments[-1]['id']
+                    self.indexes[segment_id].save(self._index_path(segment_id))
+                    self._save_index()
+                    return
+
+    def _write(self, batch):
+        """Append a batch of lines, starting new segments as they fill up."""
+        chunk = []
+        size = 0
+        for line in batch:
+            data = (line + '\n').encode('utf-8')
+            chunk.append(data)
+            size += len(data)
+            if self.segments[-1]['bytes'] + size >= SEGMENT_BYTES:
+                if not self._write_chunk(chunk):
+                    return
+                self._start_segment()
+                chunk = []
+                size = 0
+        if chunk:
+            self._write_chunk(chunk)
+
+    def _write_chunk(self, chunk):
+        segment = self.segments[-1]
+        try:
+            if self.file is None:
+                self.file = open(self._path(segment['id']), 'ab')
+            self.file.write(b''.join(chunk))
+            self.file.flush()
+        except OSError as e:
+            logger.error(f"Error saving to history: {e}")
+            return False
+        index = self.indexes[segment['id']]
+        for data in chunk:
+            index.add(segment['bytes'], data.decode('utf-8'))
+            segment['bytes'] += len(data)
+        index.covered = segment['bytes']
+        segment['lines'] += len(chunk)
+        return True
+
+    def _start_segment(self):
+        """Close the full segment, start the next one and drop the oldest
+        ones over the limit."""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        # A full segment's index does not change any more
+        full_id = self.segments[-1]['id']
+        self.indexes[full_id].save(self._index_path(full_id))
+        self.segments.append({'id': full_id + 1, 'bytes': 0, 'lines': 0})
+        self.indexes[full_id + 1] = InvertedIndex()
+        while len(self.segments) > MAX_SEGMENTS:
+            oldest = self.segments.pop(0)
+            self._remove_segment(oldest['id'])
+        self._save_index()
+
+    def _remove_segment(self, segment_id):
+        self.indexes.pop(segment_id, None)
+        for path in (self._path(segment_id), self._index_path(segment_id)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -0,0 +1,75 @@
+# markup.py
+"""Chat message formatting: **bold**, *italic* and _underline_.
+
+parse_markup() turns a message into runs of (text, styles) in one pass
+over the markers, so a message can be inserted into a Text widget with a
+single call. A marker only opens a style if text follows it directly and
+only closes one if text precedes it; markers that are never closed are
+kept as they are. An underscore inside a word (``snake_case``) or next to
+another one (``__init__``) is never a marker. Parsed messages are cached,
+as the same lines are rendered again when history is reloaded.
+"""
+import functools
+import re
+
+MARKERS = {'**': 'bold', '*': 'italic', '_': 'underline'}
+# Longest first, so ** is not read as two *; runs of underscores are
+# matched whole so they can be left alone
+MARKER = re.compile(r'\*\*|\*|_+')
+
+CACHE_SIZE = 4096
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def parse_markup(message):
+    """The runs of `message` as a tuple of (text, styles), with styles a
+    tuple of 'bold', 'italic' and 'underline' in that order."""
+    if '*' not in message and '_' not in message:
+        return ((message, ()),)
+    # Style -> span of the marker that opened it
+    opened = {}
+    # (start, end, style) of the markers that were paired up
+    toggles = []
+    for match in MARKER.finditer(message):
+        style = MARKERS.get(match.group())
+        if style is None:
+            continue
+        start, end = match.span()
+        before = message[start - 1] if start > 0 else ' '
+        after = message[end] if end < len(message) else ' '
+        if style == 'underline' and before.isalnum() and after.isalnum():
+            continue
+        # A style is only closed around some text
+        if style in opened and opened[style][1] < start and not before.isspace():
+            toggles.append((*opened.pop(style), style))
+            toggles.append((start, end, style))
+        elif not after.isspace():
+            # A later opener leaves an unclosed earlier one as plain text
+            opened[style] = (start, end)
+    if not toggles:
+        return ((message, ()),)
+
+    # Everything between the paired markers is text, unpaired markers too
+    toggles.sort()
+    runs = []
+    active = set()
+    last = 0
+    for start, end, style in toggles + [(len(message), len(message), None)]:
+        if start > last:
+            styles = tuple(s for s in ('bold', 'italic', 'underline') if s in active)
+            if runs and runs[-1][1] == styles:
+                runs[-1] = (runs[-1][0] + message[last:start], styles)
+            else:
+                runs.append((message[last:start], styles))
+        active ^= {style}
+        last = end
+    return tuple(runs)
+
+
+def insert_args(runs, tag):
+    """Arguments for one Text.insert(index, *args) call inserting `runs`,
+    each tagged with `tag` and its styles."""
+    args = []
+    for text, styles in runs:
+        args += [text, (tag,) + styles]
+    return args
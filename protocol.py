@@ -0,0 +1,411 @@
+# protocol.py
+"""Wire protocol shared by server.py and client.py.
+
+Legacy clients speak plain UTF-8 text and treat every recv() as one
+message. Newer clients answer the server's NICK prompt with a HELLO and,
+once the server acknowledges it, both sides switch to length-prefixed
+frames:
+
+    +-------------------+-------------+-----------------+
+    | length (4 bytes)  | type (1)    | payload         |
+    +-------------------+-------------+-----------------+
+
+The length is big-endian and counts only the payload.
+
+From COMPACT_VERSION on, chat events are sent as MSG_COMPACT_EVENT frames
+instead of JSON envelopes:
+
+    +-----------------+----------------+-----------+---------+--------+------+
+    | kind, flags (1) | time (varint)  | [sender]  | [room]  | [id]   | text |
+    +-----------------+----------------+-----------+---------+--------+------+
+
+Integers are unsigned varints (7 bits per byte, low bits first); the time
+is in whole seconds. Sender and room are name ids, which the server
+assigns once and announces to each connection with a MSG_NAME frame before
+the first event that uses them. The text is the UTF-8 rest of the payload.
+Such clients can also ask for large frames to be compressed (MSG_OPTIONS);
+those arrive wrapped in MSG_COMPRESSED.
+"""
+import collections
+import datetime
+import json
+import struct
+import threading
+import zlib
+
+PROTOCOL_VERSION = 8
+
+# Version 2: shared files are announced with MSG_FILE_META and downloaded on
+# request instead of being pushed to every client.
+PULL_ATTACHMENTS_VERSION = 2
+# Version 3: file data travels in MSG_TRANSFER_CHUNK frames tagged with a
+# transfer id, so several transfers and chat messages can be interleaved.
+MULTIPLEX_VERSION = 3
+# Version 4: chunks also carry their file offset and a CRC-32, and
+# interrupted transfers can be resumed from the offset the receiver reports.
+RESUMABLE_VERSION = 4
+# Version 5: clients can page through the server's message history.
+HISTORY_VERSION = 5
+# Version 6: chat lines and notices arrive as MSG_EVENT envelopes whose
+# kind, sender, room, time and id are fields, instead of as MSG_TEXT lines.
+ENVELOPE_VERSION = 6
+# Version 7: events arrive as binary MSG_COMPACT_EVENT frames, the client
+# sends its lines as MSG_SAY, and frames can be compressed on request.
+COMPACT_VERSION = 7
+# Version 8: the server tells the client the nickname it registered it
+# under with MSG_NICKNAME, since a taken one gets a suffix.
+NICKNAME_VERSION = 8
+
+# Everyone starts in this room; its messages carry no [#room] prefix
+DEFAULT_ROOM = 'lobby'
+
+# Handshake: the client replies to NICK with HELLO_PREFIX + version + nickname
+# and must wait for the server's HELLO_PREFIX + version acknowledgement
+# before sending frames. Legacy text never starts with a NUL byte.
+HELLO_PREFIX = b'\x00CHAT'
+
+FRAME_HEADER = struct.Struct('!IB')
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+# Transfer id at the start of every MSG_TRANSFER_CHUNK payload, followed
+# from version 4 on by the offset of the data in the file and its CRC-32
+CHUNK_HEADER = struct.Struct('!I')
+CHECKED_CHUNK_HEADER = struct.Struct('!IQI')
+
+# Frame types
+MSG_TEXT = 1          # UTF-8 chat line or notification
+MSG_FILE_HEADER = 2   # UTF-8 "FILE:filename:filesize:sender"
+MSG_FILE_DATA = 3     # Raw bytes of the file announced by the last header
+MSG_FILE_ABORT = 4    # The file announced by the last header will not complete
+MSG_FILE_OFFER = 5    # JSON {name, size, hash}: announce a file before uploading it
+MSG_FILE_NEED = 6     # JSON {hash, need[, offset]}: whether the server needs the file's bytes,
+                      # and how many of them it already has from an interrupted upload
+MSG_BLOB_REQUEST = 7  # JSON {hash, name, offset, length}: ask for (part of) a stored file
+MSG_FILE_META = 8     # JSON {name, size, hash, sender}: a file is available for download
+MSG_BLOB_RANGE = 9    # JSON {hash, offset, length[, id, error]}: the range follows as FILE_DATA,
+                      # or as TRANSFER_CHUNK frames if the request had an id
+MSG_TRANSFER_BEGIN = 10  # JSON {id, name, size[, hash, offset]}: start (or resume) an upload
+MSG_TRANSFER_CHUNK = 11  # transfer id (4 bytes) + raw bytes of that transfer
+MSG_TRANSFER_ABORT = 12  # JSON {id[, offset, error]}: the upload with this transfer id will not
+                         # complete; from the server, `offset` is where to resume it
+MSG_HISTORY_REQUEST = 13  # JSON {limit[, room, before]}: the last `limit` messages of a room
+                          # (default: the one the client talks in) with an id below `before`
+MSG_HISTORY = 14          # JSON {room, messages: [{id, time, text}], more}: one page of history,
+                          # oldest first; `more` says whether older messages exist
+MSG_EVENT = 15            # JSON {kind, text, time[, sender, room, id]}: a message envelope,
+                          # see make_event()
+MSG_COMPACT_EVENT = 16    # binary message envelope, see encode_compact_event()
+MSG_NAME = 17             # varint id + UTF-8 name: the nickname or room a name id stands for from now on
+MSG_SAY = 18              # UTF-8 text the client says in its room, without "nickname: "
+MSG_OPTIONS = 19          # JSON {compression: [codecs], compress_above}: the client accepts
+                          # compressed frames of at least `compress_above` bytes
+MSG_COMPRESSED = 20       # type (1 byte) + zlib-compressed payload of another frame
+MSG_NICKNAME = 21         # UTF-8 nickname the server registered this client under
+
+# Kinds of MSG_EVENT. Shared files are announced with MSG_FILE_META.
+EVENT_CHAT = 'chat'       # `sender` said `text` in `room`; `id` is its history id
+EVENT_DM = 'dm'           # direct message from `sender`
+EVENT_JOIN = 'join'       # `sender` joined the chat or a room; `text` is the notice
+EVENT_LEAVE = 'leave'     # `sender` left the chat or a room
+EVENT_SYSTEM = 'system'   # server notice for this client
+
+# Compact events store the kind as its index in EVENT_KINDS, in the low
+# bits of their first byte, and which optional fields follow in the others
+EVENT_KINDS = (EVENT_CHAT, EVENT_DM, EVENT_JOIN, EVENT_LEAVE, EVENT_SYSTEM)
+KIND_MASK = 0x0f
+HAS_SENDER = 0x10
+HAS_ROOM = 0x20
+HAS_ID = 0x40
+# Names a NameTable keeps ids for; ids fit in two varint bytes
+MAX_NAMES = 16383
+
+# Smallest payload worth compressing; the server may use a larger one
+COMPRESS_ABOVE = 512
+
+
+class ProtocolError(Exception):
+    """Raised when a peer sends data that violates the framing protocol."""
+
+
+class ChecksumError(ProtocolError):
+    """A transfer chunk arrived damaged. The connection is still usable;
+    only the transfer has to be resumed."""
+
+    def __init__(self, transfer_id, offset):
+        super().__init__(f"Checksum mismatch in transfer {transfer_id} at offset {offset}")
+        self.transfer_id = transfer_id
+        self.offset = offset
+
+
+def encode_frame(msg_type, payload):
+    """Build a single frame."""
+    return FRAME_HEADER.pack(len(payload), msg_type) + payload
+
+
+def encode_frame_header(msg_type, length):
+    """Build just the header of a frame whose payload is sent separately."""
+    return FRAME_HEADER.pack(length, msg_type)
+
+
+def encode_chunk_header(transfer_id, length, offset=None, crc=None):
+    """Frame header and chunk header of a chunk whose `length` data bytes
+    are sent separately. Version 4 chunks pass their `offset` and `crc`."""
+    if offset is None:
+        return (FRAME_HEADER.pack(CHUNK_HEADER.size + length, MSG_TRANSFER_CHUNK)
+                + CHUNK_HEADER.pack(transfer_id))
+    return (FRAME_HEADER.pack(CHECKED_CHUNK_HEADER.size + length, MSG_TRANSFER_CHUNK)
+            + CHECKED_CHUNK_HEADER.pack(transfer_id, offset, crc))
+
+
+def encode_chunk(transfer_id, data, offset=None):
+    """Build a MSG_TRANSFER_CHUNK frame, with offset and CRC-32 if `offset` is given."""
+    if offset is None:
+        return encode_chunk_header(transfer_id, len(data)) + data
+    return encode_chunk_header(transfer_id, len(data), offset, zlib.crc32(data)) + data
+
+
+def parse_chunk(payload, checked=False):
+    """Return (transfer id, offset, data) of a MSG_TRANSFER_CHUNK payload.
+    The offset is None unless the chunk is `checked` (version 4), in which
+    case a ChecksumError is raised if the data does not match its CRC-32."""
+    header = CHECKED_CHUNK_HEADER if checked else CHUNK_HEADER
+    if len(payload) < header.size:
+        raise ProtocolError("Transfer chunk without a complete header")
+    if not checked:
+        return CHUNK_HEADER.unpack_from(payload)[0], None, payload[header.size:]
+    transfer_id, offset, crc = header.unpack_from(payload)
+    data = payload[header.size:]
+    if zlib.crc32(data) != crc:
+        raise ChecksumError(transfer_id, offset)
+    return transfer_id, offset, data
+
+
+def encode_json(obj):
+    """Payload encoding for structured control frames."""
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+
+def decode_json(payload):
+    try:
+        return json.loads(payload.decode('utf-8'))
+    except ValueError as e:
+        raise ProtocolError(f"Invalid JSON payload: {e}")
+
+
+def make_event(kind, text, sender=None, room=None, message_id=None, timestamp=None):
+    """A MSG_EVENT envelope; fields without a value are left out."""
+    event = {'kind': kind, 'text': text, 'time': datetime.datetime.now().timestamp()
+             if timestamp is None else timestamp}
+    if sender is not None:
+        event['sender'] = sender
+    if room is not None:
+        event['room'] = room
+    if message_id is not None:
+        event['id'] = message_id
+    return event
+
+
+def event_line(event):
+    """The chat line for an event, as clients before ENVELOPE_VERSION get
+    it: "[HH:MM:SS] nickname: text" for chat messages, "[HH:MM:SS] text"
+    for notices."""
+    timestamp = datetime.datetime.fromtimestamp(event['time']).strftime('%H:%M:%S')
+    kind = event.get('kind')
+    text = event['text']
+    if kind == EVENT_CHAT:
+        text = f"{event['sender']}: {text}"
+        if event.get('room', DEFAULT_ROOM) != DEFAULT_ROOM:
+            text = f"[#{event['room']}] {text}"
+    elif kind == EVENT_DM:
+        text = f"[DM] {event['sender']}: {text}"
+    return f"[{timestamp}] {text}"
+
+
+def encode_varint(value):
+    """Unsigned integer as 7 bits per byte, low bits first; the high bit of
+    a byte says whether another follows."""
+    data = bytearray()
+    while value > 0x7f:
+        data.append(value & 0x7f | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+
+def decode_varint(data, offset=0):
+    """Return (value, offset after it) of the varint at `offset`."""
+    value = 0
+    shift = 0
+    while True:
+        if offset >= len(data):
+            raise ProtocolError("Truncated varint")
+        if shift > 63:
+            raise ProtocolError("Varint too long")
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+class NameTable:
+    """Ids of the nicknames and rooms used in compact events, shared by
+    every connection so they can share the same encoded event.
+
+    At most `max_names` names have an id: once they are all given out, the
+    least recently used name gives its id up to the next new one. Whoever
+    was told what an id stands for must be told again when it changes
+    (see BaseConnection.deliver)."""
+
+    def __init__(self, max_names=MAX_NAMES):
+        self.max_names = max_names
+        # name -> id, least recently used first
+        self.ids = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def intern(self, name):
+        with self.lock:
+            name_id = self.ids.get(name)
+            if name_id is not None:
+                self.ids.move_to_end(name)
+            elif len(self.ids) < self.max_names:
+                name_id = self.ids[name] = len(self.ids) + 1
+            else:
+                _, name_id = self.ids.popitem(last=False)
+                self.ids[name] = name_id
+            return name_id
+
+
+def encode_name(name_id, name):
+    """MSG_NAME payload."""
+    return encode_varint(name_id) + name.encode('utf-8')
+
+
+def parse_name(payload):
+    """Return (id, name) of a MSG_NAME payload."""
+    name_id, offset = decode_varint(payload)
+    return name_id, payload[offset:].decode('utf-8')
+
+
+def encode_compact_event(event, intern):
+    """MSG_COMPACT_EVENT payload of an event; `intern` returns the id of a
+    name (see NameTable)."""
+    header = EVENT_KINDS.index(event['kind'])
+    fields = encode_varint(int(event['time']))
+    sender = event.get('sender')
+    if sender is not None:
+        header |= HAS_SENDER
+        fields += encode_varint(intern(sender))
+    room = event.get('room')
+    if room is not None:
+        header |= HAS_ROOM
+        fields += encode_varint(intern(room))
+    if event.get('id') is not None:
+        header |= HAS_ID
+        fields += encode_varint(event['id'])
+    return bytes([header]) + fields + event['text'].encode('utf-8')
+
+
+def decode_compact_event(payload, names):
+    """The event (as make_event() builds it) of a MSG_COMPACT_EVENT
+    payload; `names` maps the name ids announced so far to their names."""
+    if not payload:
+        raise ProtocolError("Empty compact event")
+    header = payload[0]
+    kind = header & KIND_MASK
+    if kind >= len(EVENT_KINDS):
+        raise ProtocolError(f"Unknown event kind {kind}")
+    timestamp, offset = decode_varint(payload, 1)
+    event = {'kind': EVENT_KINDS[kind], 'time': timestamp}
+    for flag, key in ((HAS_SENDER, 'sender'), (HAS_ROOM, 'room')):
+        if header & flag:
+            name_id, offset = decode_varint(payload, offset)
+            if name_id not in names:
+                raise ProtocolError(f"Unknown name id {name_id}")
+            event[key] = names[name_id]
+    if header & HAS_ID:
+        event['id'], offset = decode_varint(payload, offset)
+    event['text'] = payload[offset:].decode('utf-8')
+    return event
+
+
+def compress_frame(msg_type, payload):
+    """A MSG_COMPRESSED frame carrying a frame of `msg_type`, or None if
+    compressing does not make it smaller."""
+    data = zlib.compress(payload)
+    if len(data) + 1 >= len(payload):
+        return None
+    return encode_frame(MSG_COMPRESSED, bytes([msg_type]) + data)
+
+
+def decompress_frame(payload, max_size=MAX_FRAME_SIZE):
+    """Return (type, payload) of the frame inside a MSG_COMPRESSED payload."""
+    if not payload:
+        raise ProtocolError("Empty compressed frame")
+    decompressor = zlib.decompressobj()
+    try:
+        data = decompressor.decompress(payload[1:], max_size)
+    except zlib.error as e:
+        raise ProtocolError(f"Invalid compressed frame: {e}")
+    if decompressor.unconsumed_tail:
+        raise ProtocolError(f"Compressed frame exceeds limit of {max_size}")
+    return payload[0], data
+
+
+def encode_hello(nickname, version=PROTOCOL_VERSION):
+    """Client reply to the NICK prompt announcing framing support."""
+    return HELLO_PREFIX + bytes([version]) + nickname.encode('utf-8')
+
+
+def parse_hello(data):
+    """Return (version, nickname) for a HELLO reply, or None for a legacy reply."""
+    if not data.startswith(HELLO_PREFIX) or len(data) <= len(HELLO_PREFIX):
+        return None
+    version = data[len(HELLO_PREFIX)]
+    nickname = data[len(HELLO_PREFIX) + 1:].decode('utf-8')
+    return version, nickname
+
+
+def encode_hello_ack(version):
+    """Server acknowledgement selecting the protocol version."""
+    return HELLO_PREFIX + bytes([version])
+
+
+def parse_hello_ack(data):
+    """Return (version, remaining bytes), or (None, data) if this is not an ack."""
+    size = len(HELLO_PREFIX) + 1
+    if len(data) < size or not data.startswith(HELLO_PREFIX):
+        return None, data
+    return data[len(HELLO_PREFIX)], data[size:]
+
+
+class FrameDecoder:
+    """Incremental decoder that reassembles frames from arbitrary recv() chunks."""
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        """Add received bytes and return the list of complete (type, payload) frames."""
+        self._buffer += data
+        frames = []
+        offset = 0
+        header_size = FRAME_HEADER.size
+        while len(self._buffer) - offset >= header_size:
+            length, msg_type = FRAME_HEADER.unpack_from(self._buffer, offset)
+            if length > self.max_frame_size:
+                raise ProtocolError(f"Frame of {length} bytes exceeds limit of {self.max_frame_size}")
+            end = offset + header_size + length
+            if len(self._buffer) < end:
+                break
+            frames.append((msg_type, bytes(self._buffer[offset + header_size:end])))
+            offset = end
+        if offset:
+            del self._buffer[:offset]
+        return frames
+
+    def pending(self):
+        """Number of buffered bytes belonging to an incomplete frame."""
+        return len(self._buffer)
@@ -0,0 +1,91 @@
+# search_index.py
+"""Inverted index for full-text search of chat lines.
+
+Every word of a line is mapped to the ids of the lines containing it
+(its "postings"), so a query only looks at the lines that contain its
+words instead of scanning all of them. Ids are added in increasing order,
+which keeps every posting list sorted; a query with several words
+intersects them, starting from the shortest.
+
+LocalHistory keeps one index per segment file, with the byte offset of a
+line as its id. The server searches its history database with SQLite's
+own full-text index instead (see HistoryStore.search).
+"""
+import bisect
+import json
+import logging
+import os
+import re
+
+logger = logging.getLogger(__name__)
+
+WORD = re.compile(r'\w+')
+
+
+def tokenize(text):
+    """The words of `text`, lowercased, in order."""
+    return WORD.findall(text.lower())
+
+
+class InvertedIndex:
+    def __init__(self):
+        # Word -> sorted ids of the lines containing it
+        self.postings = {}
+        # How much of the source has been indexed (for LocalHistory: the
+        # segment's size in bytes)
+        self.covered = 0
+
+    def add(self, doc_id, text):
+        """Index a line. Ids must be added in increasing order."""
+        for word in set(tokenize(text)):
+            docs = self.postings.get(word)
+            if docs is None:
+                self.postings[word] = [doc_id]
+            else:
+                docs.append(doc_id)
+
+    def lookup(self, query):
+        """Ids of the lines containing every word of `query`, in order."""
+        words = set(tokenize(query))
+        if not words:
+            return []
+        lists = []
+        for word in words:
+            docs = self.postings.get(word)
+            if not docs:
+                return []
+            lists.append(docs)
+        lists.sort(key=len)
+        hits = lists[0]
+        for docs in lists[1:]:
+            hits = [doc for doc in hits if _contains(docs, doc)]
+            if not hits:
+                break
+        return hits
+
+    def save(self, path):
+        try:
+            with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump({'covered': self.covered, 'postings': self.postings}, f,
+                          separators=(',', ':'))
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            logger.error(f"Error saving search index: {e}")
+
+    @classmethod
+    def load(cls, path):
+        """The index saved at `path`, or None if it is missing or unreadable."""
+        try:
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f)
+            index = cls()
+            index.covered = data['covered']
+            index.postings = data['postings']
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        return index
+
+
+def _contains(docs, doc):
+    i = bisect.bisect_left(docs, doc)
+    return i < len(docs) and docs[i] == doc
@@ -4,138 +4,1699 @@ import threading
 import logging
 import datetime
 import os
+import sys
+import signal
+import asyncio
+import argparse
+import collections
+import concurrent.futures
+import contextlib
+import itertools
+import time
+import zlib
+
+from blob_store import BlobStore, is_valid_digest
+from chat_log import ChatLog
+from history_store import HistoryStore
+from cluster import ClusterBus, TcpBackend, parse_address
+from worker_bus import BusClient, BusHub
+from protocol import (
+    PROTOCOL_VERSION, MSG_TEXT, MSG_FILE_HEADER, MSG_FILE_DATA, MSG_FILE_ABORT,
+    MSG_FILE_OFFER, MSG_FILE_NEED, MSG_BLOB_REQUEST, MSG_FILE_META, MSG_BLOB_RANGE,
+    MSG_TRANSFER_BEGIN, MSG_TRANSFER_CHUNK, MSG_TRANSFER_ABORT, MSG_HISTORY_REQUEST, MSG_HISTORY,
+    MSG_EVENT, MSG_COMPACT_EVENT, MSG_NAME, MSG_SAY, MSG_OPTIONS, MSG_NICKNAME,
+    PULL_ATTACHMENTS_VERSION, MULTIPLEX_VERSION, RESUMABLE_VERSION, ENVELOPE_VERSION, COMPACT_VERSION,
+    NICKNAME_VERSION,
+    DEFAULT_ROOM, EVENT_CHAT, EVENT_DM, EVENT_JOIN, EVENT_LEAVE, EVENT_SYSTEM, COMPRESS_ABOVE,
+    ChecksumError, FrameDecoder, NameTable, ProtocolError, compress_frame, decode_json,
+    encode_chunk_header, encode_compact_event, encode_frame, encode_frame_header, encode_hello_ack,
+    encode_json, encode_name, event_line, make_event, parse_chunk, parse_hello,
+)
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Upper bounds for one scatter-gather write of queued messages
+MAX_BATCH_BUFFERS = 64
+MAX_BATCH_BYTES = 256 * 1024
+# How long a writer waits for more messages to send along with the first
+# one it finds queued (see BaseConnection)
+COALESCE_DELAY = 0.002
+
+# Receive buffer for uploads and frame size for relayed file data
+FILE_CHUNK_SIZE = 64 * 1024
+
+# Every client joins DEFAULT_ROOM on connect; it is never deleted
+MAX_ROOM_NAME = 32
+
+# Messages per page of history when a client does not say, and at most
+DEFAULT_HISTORY_PAGE = 50
+MAX_HISTORY_PAGE = 500
+
+
+def raise_open_file_limit():
+    """Raise the soft open-file limit so one process can hold many sockets."""
+    if resource is None:
+        return
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        target = hard if hard != resource.RLIM_INFINITY else 1024 * 1024
+        if soft == resource.RLIM_INFINITY or soft >= target:
+            return
+        resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+        logger.info(f"Raised open file limit from {soft} to {target}")
+    except (ValueError, OSError) as e:
+        logger.warning(f"Could not raise open file limit: {e}")
+
+
+def send_buffers(sock, buffers):
+    """Send several buffers with one sendmsg() call where available,
+    looping over partial writes without joining them into a new string.
+    Returns the number of send calls made."""
+    if not hasattr(sock, 'sendmsg'):  # Windows
+        sock.sendall(b''.join(buffers))
+        return 1
+    views = [memoryview(buf) for buf in buffers]
+    first = 0
+    calls = 0
+    while first < len(views):
+        sent = sock.sendmsg(views[first:first + MAX_BATCH_BUFFERS])
+        calls += 1
+        while first < len(views) and sent >= len(views[first]):
+            sent -= len(views[first])
+            first += 1
+        if sent:
+            views[first] = views[first][sent:]
+    return calls
+
+
+@contextlib.contextmanager
+def corked(sock, enabled=True):
+    """Hold back partial TCP segments until the block ends (Linux TCP_CORK),
+    so a frame header sent on its own leaves in the same segment as the
+    file data sent after it."""
+    if not enabled or not hasattr(socket, 'TCP_CORK'):
+        yield
+        return
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+    try:
+        yield
+    finally:
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
+        except OSError:
+            pass
+
+
+class RelayFile:
+    """A file (or a byte range of one) on disk shared by several outbound
+    queues. It is sent as a `header_type` frame carrying `header`, followed
+    by the data.
+
+    Every queue holding it owns one reference; `on_done` runs once the last
+    writer has finished streaming it.
+    """
+
+    def __init__(self, path, header, size, on_done=None, offset=0, header_type=MSG_FILE_HEADER):
+        self.path = path
+        self.header = header
+        self.size = size
+        self.offset = offset
+        self.header_type = header_type
+        self.on_done = on_done
+        self._refs = 1  # Held by the code that relays the file
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            self._refs += 1
+        return self
+
+    def release(self):
+        with self._lock:
+            self._refs -= 1
+            done = self._refs == 0
+        if done and self.on_done:
+            self.on_done()
+
+
+class OutboundTransfer:
+    """A RelayFile sent to one client as MSG_TRANSFER_CHUNK frames. The
+    writer sends one chunk at a time and takes turns with the client's
+    other transfers, so none of them holds up the rest."""
+
+    def __init__(self, relay, transfer_id):
+        self.relay = relay
+        self.transfer_id = transfer_id
+        self.position = relay.offset
+        self.end = relay.offset + relay.size
+        self.file = None
+
+    def next_chunk(self, checked=False):
+        """Return (frame header, offset, count, data) of the next chunk to
+        send. `data` is None unless the chunk is `checked`: its CRC-32 has
+        to be computed, so it is read here instead of sent with sendfile()."""
+        if self.file is None:
+            self.file = open(self.relay.path, 'rb')
+        offset = self.position
+        count = min(FILE_CHUNK_SIZE, self.end - offset)
+        self.position += count
+        if not checked:
+            return encode_chunk_header(self.transfer_id, count), offset, count, None
+        self.file.seek(offset)
+        data = self.file.read(count)
+        if len(data) != count:
+            raise OSError(f"{self.relay.path} is shorter than expected")
+        header = encode_chunk_header(self.transfer_id, count, offset, zlib.crc32(data))
+        return header, offset, count, data
+
+    def finished(self):
+        return self.position >= self.end
+
+    def release(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.relay.release()
+
+
+class FileUpload:
+    """A file being received from one client and relayed to the others.
+
+    Every upload is written to the blob store as it arrives. In 'stream'
+    mode each chunk is also queued for the framed recipients straight away,
+    so the server never holds more than the recipients' queues. Legacy
+    clients need the file bytes back to back with no other message in
+    between, and a client can follow only one streamed file at a time, so
+    those recipients (and everyone in 'spool' mode) are sent the stored
+    blob with sendfile() once the upload is complete.
+
+    An upload announced with its hash can resume at `offset` from what an
+    earlier, interrupted attempt left in the blob store. The hash is checked
+    at the end; a file that does not match is not shared.
+
+    On the asyncio engine the blob writer's file I/O and hashing (including
+    re-reading the kept part of a resumed upload) run on the server's
+    `blob_io` thread, in order, so they do not hold up the event loop.
+    """
+
+    # Seconds a stream recipient may hold up the uploader before it is dropped
+    STALL_TIMEOUT = 30
+
+    def __init__(self, chat_server, sender_client, header, expected_hash=None, offset=0,
+                 transfer_id=None):
+        self.server = chat_server
+        self.sender_client = sender_client
+        self.header = header
+        self.filename, self.filesize, self.sender = chat_server.parse_file_header(header.decode('utf-8'))
+        self.expected_hash = expected_hash
+        self.transfer_id = transfer_id
+        if not 0 <= offset <= self.filesize:
+            raise ProtocolError(f"Upload offset {offset} outside a {self.filesize} byte file")
+        self.remaining = self.filesize - offset
+        self.stream_to = []
+        self.done = False
+        # Last piece of blob work queued on the blob_io thread
+        self.pending_io = None
+        if chat_server.blob_io is None:
+            self.blob = chat_server.blob_store.writer(expected_hash, offset)
+        else:
+            if offset > chat_server.blob_store.partial_size(expected_hash):
+                raise ValueError(f"Not {offset} bytes of {expected_hash} to resume from")
+            self.blob = None
+            self._blob_io(self._open_blob, expected_hash, offset)
+
+        others = [client for client in chat_server.clients.members(sender_client.room)
+                  if client is not sender_client]
+        # A resumed upload cannot be streamed: the start is on disk already
+        if chat_server.file_relay == 'stream' and offset == 0:
+            with chat_server.stream_lock:
+                for client in others:
+                    if client.pulls_files():
+                        # Told about the file once it is complete
+                        continue
+                    if client.framed and client.incoming_stream is None:
+                        client.incoming_stream = self
+                        self.stream_to.append(client)
+        chat_server.fan_out(MSG_FILE_HEADER, header, droppable=False, recipients=self.stream_to)
+
+    def position(self):
+        """Offset of the next byte expected from the uploader."""
+        return self.filesize - self.remaining
+
+    def _blob_io(self, func, *args, then=None):
+        """Run blob work: right away on the threaded engine, queued behind
+        this upload's earlier blob work on the asyncio one. `then` is called
+        with the result, on the event loop."""
+        if self.server.blob_io is None:
+            result = func(*args)
+            if then is not None:
+                then(result)
+            return
+        self.pending_io = self.server.blob_io.submit(func, *args)
+        if then is not None:
+            loop = self.server.loop
+            self.pending_io.add_done_callback(
+                lambda future: loop.call_soon_threadsafe(self._io_done, future, then))
+
+    def _io_done(self, future, then):
+        try:
+            result = future.result()
+        except Exception as e:
+            logger.error(f"Error storing file '{self.filename}': {e}")
+            return
+        then(result)
+
+    def _open_blob(self, expected_hash, offset):
+        self.blob = self.server.blob_store.writer(expected_hash, offset)
+
+    def _write_blob(self, data):
+        if self.blob is None:
+            raise OSError(f"No blob to store '{self.filename}' in")
+        self.blob.write(data)
+
+    def write(self, data):
+        """Relay one chunk. `data` may be a view of a reused receive buffer;
+        it is copied once and the copy is shared by every recipient."""
+        if len(data) > self.remaining:
+            raise ProtocolError("File data exceeds the announced file size")
+        if self.server.blob_io is None:
+            self.blob.write(data)
+        else:
+            data = bytes(data)
+            self._blob_io(self._write_blob, data)
+        if self.stream_to:
+            self.server.fan_out(MSG_FILE_DATA, bytes(data), droppable=False, recipients=self.stream_to)
+        self.remaining -= len(data)
+
+    def wait_writable(self):
+        """Block the uploader (threaded engine) until stream recipients catch up."""
+        for client in list(self.stream_to):
+            if not client.wait_writable(self.STALL_TIMEOUT):
+                self._drop_recipient(client)
+
+    async def drain(self):
+        """Pause the uploader (asyncio engine) until its data is stored and
+        stream recipients catch up."""
+        if self.pending_io is not None:
+            await asyncio.wrap_future(self.pending_io)
+        for client in list(self.stream_to):
+            try:
+                await asyncio.wait_for(client.drain(), self.STALL_TIMEOUT)
+            except asyncio.TimeoutError:
+                self._drop_recipient(client)
+
+    def _drop_recipient(self, client):
+        self.stream_to.remove(client)
+        if client.incoming_stream is self:
+            client.incoming_stream = None
+        self.server.evict_client(client, f"stalled the transfer of '{self.filename}'")
+
+    def _release_recipients(self):
+        with self.server.stream_lock:
+            for client in self.stream_to:
+                if client.incoming_stream is self:
+                    client.incoming_stream = None
+
+    def finish(self):
+        """Complete the transfer: store the blob and send it to everyone who
+        did not get it streamed."""
+        if self.done:
+            return
+        self.done = True
+        self._release_recipients()
+        self._blob_io(self._commit_blob, then=self._committed)
+
+    def _commit_blob(self):
+        """Store the blob; returns its digest, or None if it does not match
+        the announced hash."""
+        if self.expected_hash and self.blob.digest() != self.expected_hash:
+            self.blob.discard()
+            return None
+        return self.blob.commit()
+
+    def _committed(self, digest):
+        if digest is None:
+            logger.warning(f"File '{self.filename}' from {self.sender} does not match "
+                           f"its announced hash, discarding it")
+            for client in self.stream_to:
+                client.send_message(MSG_FILE_ABORT, self.header)
+            self.server.upload_failed(self.sender_client, self, 0, "hash mismatch")
+            return
+        self.server.share_file(self.sender_client, digest, self.filename, self.filesize,
+                               self.sender, skip=self.stream_to)
+
+    def abort(self, keep_partial=False, then=None):
+        """Give up on an incomplete upload, keeping what was received for a
+        later resume if `keep_partial` is set and the hash was announced.
+        `then` is called once that is done."""
+        if self.done:
+            return
+        self.done = True
+        logger.warning(f"File '{self.filename}' from {self.sender} incomplete, "
+                       f"{self.remaining} of {self.filesize} bytes missing")
+        for client in self.stream_to:
+            client.send_message(MSG_FILE_ABORT, self.header)
+        self._release_recipients()
+        self._blob_io(self._close_blob, keep_partial,
+                      then=None if then is None else lambda result: then())
+
+    def _close_blob(self, keep_partial):
+        if self.blob is None:
+            return
+        if keep_partial:
+            self.blob.suspend()
+        else:
+            self.blob.discard()
+
+
+class BaseConnection:
+    """State shared by both engines' client connections.
+
+    Each connection owns a bounded outbound queue drained by its own writer,
+    so producers (broadcasts, file relays) only ever enqueue. Queued chat
+    messages count against the high/low watermarks; once a client goes over
+    the high watermark it is "congested" until its writer drains it below
+    the low watermark, and the slow-consumer policy decides whether new
+    droppable messages are discarded ('drop') or the client is
+    disconnected ('disconnect').
+
+    A writer that finds messages queued for a framed client waits up to
+    `coalesce_delay` seconds for more before sending, so a burst goes out
+    with one send call and in full TCP segments rather than one of each per
+    message. Legacy clients read one message per recv(), so theirs are
+    sent right away. With `cork`, a file's frame header and data are
+    corked together (again only for framed clients: legacy ones expect the
+    "FILE:" header in a recv() of its own).
+    """
+
+    POLICIES = ('drop', 'disconnect')
+
+    # Ids of the names in compact events, the same for every connection
+    names = NameTable()
+
+    # One of these exists per connected user, so keep them small
+    __slots__ = (
+        'id', 'nickname', 'address', 'connected_at', 'rooms', 'room',
+        'framed', 'protocol_version', 'decoder', 'known_names', 'compress_above',
+        'uploads', 'incoming_stream', 'offered_hash',
+        'queue', 'transfers', 'high_watermark', 'low_watermark', 'policy', 'on_evict',
+        'coalesce_delay', 'cork', 'congested', 'closed',
+        'queued_bytes', 'peak_queued_bytes', 'sent_messages', 'sent_bytes', 'send_calls',
+        'dropped_messages', 'received_messages', 'received_bytes',
+    )
+
+    def __init__(self, high_watermark=1024 * 1024, low_watermark=256 * 1024,
+                 policy='drop', on_evict=None, coalesce_delay=0, cork=False):
+        # Session details, filled in by ClientRegistry.add
+        self.id = None
+        self.nickname = None
+        self.address = None
+        self.connected_at = time.time()
+        # Rooms this client is subscribed to, and the one it talks in
+        self.rooms = set()
+        self.room = None
+
+        self.framed = False
+        self.protocol_version = 0
+        self.decoder = None
+        # Name ids this client has been told about (see deliver), and the
+        # size from which frames to it are compressed (None: never)
+        # What this client was told each name id stands for
+        self.known_names = {}
+        self.compress_above = None
+        # FileUploads this client is sending by transfer id (None for an
+        # upload started with MSG_FILE_HEADER), and the one streaming to it
+        self.uploads = {}
+        self.incoming_stream = None
+        # Hash announced by MSG_FILE_OFFER for the next upload
+        self.offered_hash = None
+
+        # Outbound queue of bytes, or RelayFile objects streamed from disk,
+        # and the multiplexed transfers that share the time it leaves idle
+        self.queue = collections.deque()
+        self.transfers = collections.deque()
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.policy = policy
+        self.on_evict = on_evict
+        self.coalesce_delay = coalesce_delay
+        self.cork = cork
+        self.congested = False
+        self.closed = False
+
+        # Counters
+        self.queued_bytes = 0
+        self.peak_queued_bytes = 0
+        self.sent_messages = 0
+        self.sent_bytes = 0
+        # Socket writes (sendmsg, sendall, sendfile) made to send them
+        self.send_calls = 0
+        self.dropped_messages = 0
+        self.received_messages = 0
+        self.received_bytes = 0
+
+    def enable_framing(self, version):
+        """Switch this connection from legacy text to length-prefixed frames."""
+        self.framed = True
+        self.protocol_version = version
+        self.decoder = FrameDecoder()
+
+    def event_format(self):
+        """The frame type this client gets message events as."""
+        if self.protocol_version >= COMPACT_VERSION:
+            return MSG_COMPACT_EVENT
+        if self.protocol_version >= ENVELOPE_VERSION:
+            return MSG_EVENT
+        return MSG_TEXT
+
+    def wire_format(self, msg_type):
+        """Clients with the same wire format get the same bytes for a
+        message of `msg_type`."""
+        if msg_type == MSG_EVENT:
+            return self.framed, self.compress_above, self.event_format()
+        return self.framed, self.compress_above
+
+    def pulls_files(self):
+        """Whether shared files are only announced to this client, which
+        downloads them on request."""
+        return self.protocol_version >= PULL_ATTACHMENTS_VERSION
+
+    def frame(self, msg_type, payload):
+        """Encode a payload for this client's protocol. The payload of a
+        MSG_EVENT is the event itself, sent in this client's event_format():
+        clients before ENVELOPE_VERSION get its chat line as MSG_TEXT.
+        Frames of at least `compress_above` bytes, file data aside, are
+        compressed if that makes them smaller."""
+        if msg_type == MSG_EVENT:
+            msg_type = self.event_format()
+            if msg_type == MSG_COMPACT_EVENT:
+                payload = encode_compact_event(payload, self.names.intern)
+            elif msg_type == MSG_EVENT:
+                payload = encode_json(payload)
+            else:
+                payload = event_line(payload).encode('utf-8')
+        if not self.framed:
+            return payload
+        if (self.compress_above is not None and len(payload) >= self.compress_above
+                and msg_type != MSG_FILE_DATA):
+            compressed = compress_frame(msg_type, payload)
+            if compressed is not None:
+                return compressed
+        return encode_frame(msg_type, payload)
+
+    def send_message(self, msg_type, payload, droppable=False):
+        """Queue a payload as a frame, or as raw bytes to legacy clients.
+
+        Droppable messages (chat lines, notifications) are subject to the
+        slow-consumer policy; everything else is always queued.
+        """
+        return self.deliver(self.frame(msg_type, payload), droppable, self.event_names(msg_type, payload))
+
+    @classmethod
+    def event_names(cls, msg_type, payload):
+        """The names of a message event as {id: name}, or None."""
+        if msg_type != MSG_EVENT:
+            return None
+        return {cls.names.intern(name): name for name in (payload.get('sender'), payload.get('room'))
+                if name is not None}
+
+    def deliver(self, data, droppable=False, names=None):
+        """Queue `data`, the frame() of a payload. If it is a compact event,
+        a MSG_NAME frame goes with it for each of its `names` (see
+        event_names) this client has not been told about yet, or was told
+        stood for another name before the id was reused; those count as
+        told once queued, so a later event naming them is queued after them."""
+        if (not names or self.protocol_version < COMPACT_VERSION
+                or names.items() <= self.known_names.items()):
+            return self.enqueue(data, droppable)
+        new_names = {name_id: name for name_id, name in names.items()
+                     if self.known_names.get(name_id) != name}
+        announce = b''.join(self.frame(MSG_NAME, encode_name(name_id, name))
+                            for name_id, name in new_names.items())
+        queued = self.enqueue(announce + data, droppable)
+        if queued:
+            self.known_names.update(new_names)
+        return queued
+
+    def send(self, data):
+        self.enqueue(data)
+        return len(data)
+
+    def sendall(self, data):
+        self.enqueue(data)
+
+    def send_file(self, relay_file, transfer_id=None):
+        """Queue a spooled file; the writer streams it from disk. With a
+        `transfer_id` it is sent in chunks whenever nothing else is queued."""
+        relay_file.acquire()
+        if transfer_id is None:
+            return self.enqueue(relay_file)
+        return self.enqueue(OutboundTransfer(relay_file, transfer_id))
+
+    def multiplexes_files(self):
+        """Whether this client understands MSG_TRANSFER_CHUNK frames."""
+        return self.protocol_version >= MULTIPLEX_VERSION
+
+    def checks_chunks(self):
+        """Whether transfer chunks carry an offset and CRC-32 (and uploads
+        from this client can be resumed)."""
+        return self.protocol_version >= RESUMABLE_VERSION
+
+    def queue_depth(self):
+        return len(self.queue) + len(self.transfers)
+
+    def _push(self, item, droppable):
+        """Append an item to the queue. The caller holds the queue lock."""
+        if self.closed:
+            return 'closed'
+        if isinstance(item, OutboundTransfer):
+            self.transfers.append(item)
+            return 'queued'
+        # Files stay on disk until they are sent, so only bytes count
+        size = len(item) if not isinstance(item, RelayFile) else 0
+        if droppable:
+            if self.queued_bytes + size > self.high_watermark:
+                self.congested = True
+            if self.congested:
+                if self.policy == 'disconnect':
+                    return 'evict'
+                self.dropped_messages += 1
+                return 'dropped'
+        self.queue.append(item)
+        self.queued_bytes += size
+        if self.queued_bytes > self.peak_queued_bytes:
+            self.peak_queued_bytes = self.queued_bytes
+        if self.queued_bytes > self.high_watermark:
+            self.congested = True
+        return 'queued'
+
+    def _after_push(self, item, result):
+        """Finish an enqueue outside the queue lock."""
+        if result != 'queued' and isinstance(item, (RelayFile, OutboundTransfer)):
+            item.release()
+        if result == 'evict':
+            self.evict(f"outbound queue over {self.high_watermark} bytes")
+        return result == 'queued'
+
+    def _sent(self, item):
+        """Account for an item the writer has finished sending."""
+        if isinstance(item, RelayFile):
+            self.sent_bytes += item.size
+        else:
+            self.queued_bytes -= len(item)
+            self.sent_bytes += len(item)
+        self.sent_messages += 1
+        if self.congested and self.queued_bytes <= self.low_watermark:
+            self.congested = False
+
+    def _has_work(self):
+        return bool(self.queue or self.transfers)
+
+    def _coalesces(self):
+        """Whether the writer should wait for more messages before sending
+        what is queued."""
+        return (self.coalesce_delay > 0 and self.framed and bool(self.queue)
+                and not isinstance(self.queue[0], RelayFile) and not self._batch_full())
+
+    def _batch_full(self):
+        return len(self.queue) >= MAX_BATCH_BUFFERS or self.queued_bytes >= MAX_BATCH_BYTES
+
+    def _next_work(self):
+        """Pick what the writer sends next. Queued messages always go first;
+        transfers only get the connection when the queue is empty, one chunk
+        at a time and in turn, so a chat line waits for at most one chunk.
+        Returns a batch from `_pop_batch`, or an OutboundTransfer."""
+        if self.queue:
+            return self._pop_batch()
+        return self.transfers.popleft()
+
+    def _chunk_sent(self, transfer, count):
+        """Put a transfer back in line after one of its chunks was sent."""
+        self.sent_bytes += count
+        self.sent_messages += 1
+        if transfer.finished() or self.closed:
+            transfer.release()
+        else:
+            self.transfers.append(transfer)
+
+    def _pop_batch(self):
+        """Take the next queue item, or for framed clients a run of
+        consecutive byte messages that the writer can send with a single
+        scatter-gather call. Legacy clients read one message per recv(), so
+        they get one message per send."""
+        item = self.queue.popleft()
+        batch = [item]
+        if not self.framed or isinstance(item, RelayFile):
+            return batch
+        size = len(item)
+        while (self.queue and len(batch) < MAX_BATCH_BUFFERS and size < MAX_BATCH_BYTES
+               and not isinstance(self.queue[0], RelayFile)):
+            item = self.queue.popleft()
+            batch.append(item)
+            size += len(item)
+        return batch
+
+    def _file_segments(self, offset, size):
+        """(offset, count) pieces of a file range: one frame per chunk for
+        framed clients, all of it at once for legacy clients."""
+        if not self.framed:
+            return [(offset, size)] if size else []
+        end = offset + size
+        return [(position, min(FILE_CHUNK_SIZE, end - position))
+                for position in range(offset, end, FILE_CHUNK_SIZE)]
+
+    def _discard_queue(self):
+        """Drop everything still queued when the connection closes."""
+        for item in self.queue:
+            if isinstance(item, RelayFile):
+                item.release()
+        self.queue.clear()
+        for transfer in self.transfers:
+            transfer.release()
+        self.transfers.clear()
+        self.queued_bytes = 0
+
+    def evict(self, reason):
+        if self.on_evict:
+            self.on_evict(self, reason)
+        else:
+            self.close()
+
+
+class ClientConnection(BaseConnection):
+    """Socket wrapper for the threaded engine, with a writer thread per client."""
+
+    __slots__ = ('sock', 'cond', 'writer_thread')
+
+    def __init__(self, sock, **queue_limits):
+        super().__init__(**queue_limits)
+        self.sock = sock
+        self.cond = threading.Condition()
+        self.writer_thread = threading.Thread(target=self._writer_loop, daemon=True)
+        self.writer_thread.start()
+
+    def enqueue(self, item, droppable=False):
+        with self.cond:
+            result = self._push(item, droppable)
+            # A writer waiting to coalesce only needs waking for a full batch
+            if result == 'queued' and (len(self.queue) <= 1 or not self.coalesce_delay
+                                       or self._batch_full()):
+                self.cond.notify_all()
+        return self._after_push(item, result)
+
+    def wait_writable(self, timeout=None):
+        """Block until the outbound queue has drained below the low watermark."""
+        with self.cond:
+            return self.cond.wait_for(
+                lambda: self.closed or self.queued_bytes <= self.low_watermark, timeout)
+
+    def _writer_loop(self):
+        while True:
+            with self.cond:
+                while not self._has_work() and not self.closed:
+                    self.cond.wait()
+                if self._coalesces():
+                    deadline = time.monotonic() + self.coalesce_delay
+                    while self._coalesces():
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self.cond.wait(remaining)
+                if self.closed:
+                    return
+                work = self._next_work()
+
+            try:
+                if isinstance(work, OutboundTransfer):
+                    count = self._send_chunk(work)
+                elif isinstance(work[0], RelayFile):
+                    self._send_file(work[0])
+                else:
+                    self.send_calls += send_buffers(self.sock, work)
+            except OSError as e:
+                if isinstance(work, OutboundTransfer):
+                    work.release()
+                if not self.closed:
+                    self.evict(f"send failed: {e}")
+                return
+
+            with self.cond:
+                if isinstance(work, OutboundTransfer):
+                    self._chunk_sent(work, count)
+                else:
+                    for item in work:
+                        self._sent(item)
+                self.cond.notify_all()
+
+    def _send_chunk(self, transfer):
+        """Send the next chunk of a multiplexed transfer with sendfile()."""
+        header, offset, count, data = transfer.next_chunk(self.checks_chunks())
+        if data is not None:
+            self.send_calls += send_buffers(self.sock, [header, data])
+            return count
+        with corked(self.sock, self.cork):
+            self.sock.sendall(header)
+            self.sock.sendfile(transfer.file, offset, count)
+        self.send_calls += 2
+        return count
+
+    def _send_file(self, relay):
+        """Send a spooled file with sendfile(), so its data never passes
+        through Python buffers."""
+        try:
+            with open(relay.path, 'rb') as f, corked(self.sock, self.cork and self.framed):
+                self.sock.sendall(self.frame(relay.header_type, relay.header))
+                self.send_calls += 1
+                for offset, count in self._file_segments(relay.offset, relay.size):
+                    if self.framed:
+                        self.sock.sendall(encode_frame_header(MSG_FILE_DATA, count))
+                        self.send_calls += 1
+                    self.sock.sendfile(f, offset, count)
+                    self.send_calls += 1
+        finally:
+            relay.release()
+
+    def recv(self, bufsize):
+        return self.sock.recv(bufsize)
+
+    def recv_into(self, buffer):
+        return self.sock.recv_into(buffer)
+
+    def getpeername(self):
+        return self.sock.getpeername()
+
+    def close(self):
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self._discard_queue()
+            self.cond.notify_all()
+        # Shutdown first so a writer blocked in sendall wakes up
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class AsyncClientConnection(BaseConnection):
+    """Socket-like wrapper around an asyncio stream, so broadcast and
+    remove_client can treat both engines' clients the same way. The queue
+    is drained by a writer task and only touched from the event loop."""
+
+    __slots__ = ('reader', 'writer', 'wakeup', 'drained', 'writer_task')
+
+    def __init__(self, reader, writer, **queue_limits):
+        super().__init__(**queue_limits)
+        self.reader = reader
+        self.writer = writer
+        self.wakeup = asyncio.Event()
+        self.drained = asyncio.Event()
+        self.writer_task = asyncio.get_running_loop().create_task(self._writer_loop())
+
+    def enqueue(self, item, droppable=False):
+        result = self._push(item, droppable)
+        if result == 'queued' and (len(self.queue) <= 1 or not self.coalesce_delay
+                                   or self._batch_full()):
+            self.wakeup.set()
+        return self._after_push(item, result)
+
+    async def drain(self):
+        """Wait until the outbound queue has drained below the low watermark."""
+        while not self.closed and self.queued_bytes > self.low_watermark:
+            self.drained.clear()
+            await self.drained.wait()
+
+    async def _writer_loop(self):
+        while True:
+            while not self._has_work() and not self.closed:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+            if self._coalesces():
+                deadline = time.monotonic() + self.coalesce_delay
+                while self._coalesces() and not self.closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self.wakeup.wait(), remaining)
+                    except asyncio.TimeoutError:
+                        break
+            if self.closed:
+                return
+            work = self._next_work()
+
+            try:
+                if isinstance(work, OutboundTransfer):
+                    count = await self._send_chunk(work)
+                elif isinstance(work[0], RelayFile):
+                    await self._send_file(work[0])
+                else:
+                    # The transport writes it with one send call if it can
+                    self.writer.writelines(work)
+                    self.send_calls += 1
+                    await self.writer.drain()
+            except OSError as e:
+                if isinstance(work, OutboundTransfer):
+                    work.release()
+                if not self.closed:
+                    self.evict(f"send failed: {e}")
+                return
+
+            if isinstance(work, OutboundTransfer):
+                self._chunk_sent(work, count)
+            else:
+                for item in work:
+                    self._sent(item)
+            if self.queued_bytes <= self.low_watermark:
+                self.drained.set()
+
+    async def _send_chunk(self, transfer):
+        """Send the next chunk of a multiplexed transfer with the loop's sendfile.
+        A checked chunk is read (and its CRC computed) off the event loop."""
+        loop = asyncio.get_running_loop()
+        if self.checks_chunks():
+            header, offset, count, data = await loop.run_in_executor(None, transfer.next_chunk, True)
+        else:
+            header, offset, count, data = transfer.next_chunk()
+        if data is not None:
+            self.writer.writelines([header, data])
+            self.send_calls += 1
+            await self.writer.drain()
+            return count
+        with corked(self.writer.get_extra_info('socket'), self.cork):
+            self.writer.write(header)
+            await loop.sendfile(self.writer.transport, transfer.file, offset, count)
+        self.send_calls += 2
+        return count
+
+    async def _send_file(self, relay):
+        """Send a spooled file with the loop's sendfile support (falls back
+        to plain writes where the platform has no sendfile)."""
+        loop = asyncio.get_running_loop()
+        try:
+            with open(relay.path, 'rb') as f, corked(self.writer.get_extra_info('socket'), self.cork and self.framed):
+                self.writer.write(self.frame(relay.header_type, relay.header))
+                self.send_calls += 1
+                for offset, count in self._file_segments(relay.offset, relay.size):
+                    if self.framed:
+                        self.writer.write(encode_frame_header(MSG_FILE_DATA, count))
+                        self.send_calls += 1
+                    await loop.sendfile(self.writer.transport, f, offset, count)
+                    self.send_calls += 1
+        finally:
+            relay.release()
+
+    def getpeername(self):
+        return self.writer.get_extra_info('peername')
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._discard_queue()
+        self.wakeup.set()
+        self.drained.set()
+        self.writer.close()
+
+
+class ClientRegistry:
+    """Connected clients by connection id, with an index by nickname and
+    the subscriber set of every room.
+
+    Joins, leaves and lookups are O(1) and safe to call from any thread.
+    Iterating goes over a snapshot that is rebuilt only after the set of
+    clients has changed, so broadcasts do not copy the registry each time;
+    rooms keep the same kind of snapshot of their members.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.by_id = {}
+        self.by_nickname = {}
+        self.ids = itertools.count(1)
+        self._snapshot = ()
+        self._stale = False
+        # Room name -> set of member clients, and cached member tuples
+        self.rooms = {DEFAULT_ROOM: set()}
+        self._room_snapshots = {}
+
+    def add(self, client, nickname, address=None, taken=()):
+        """Register a client and return the nickname it got: a suffix is
+        added if the requested one is in use here or in `taken`."""
+        with self.lock:
+            unique = nickname
+            n = 1
+            while unique in self.by_nickname or unique in taken:
+                n += 1
+                unique = f"{nickname}_{n}"
+            client.id = next(self.ids)
+            client.nickname = unique
+            client.address = address
+            self.by_id[client.id] = client
+            self.by_nickname[unique] = client
+            self._stale = True
+        return unique
+
+    def remove(self, client):
+        """Unregister a client. Returns False if it was not registered."""
+        with self.lock:
+            if self.by_id.pop(client.id, None) is None:
+                return False
+            if self.by_nickname.get(client.nickname) is client:
+                del self.by_nickname[client.nickname]
+            for room in list(client.rooms):
+                self._leave(client, room)
+            self._stale = True
+        return True
+
+    def join(self, client, room):
+        """Subscribe a client to a room, creating it if needed. Returns
+        False if it was already a member."""
+        with self.lock:
+            members = self.rooms.setdefault(room, set())
+            if client in members:
+                return False
+            members.add(client)
+            client.rooms.add(room)
+            self._room_snapshots.pop(room, None)
+        return True
+
+    def leave(self, client, room):
+        """Unsubscribe a client from a room. Returns False if it was not a member."""
+        with self.lock:
+            return self._leave(client, room)
+
+    def _leave(self, client, room):
+        members = self.rooms.get(room)
+        if not members or client not in members:
+            return False
+        members.discard(client)
+        client.rooms.discard(room)
+        self._room_snapshots.pop(room, None)
+        if not members and room != DEFAULT_ROOM:
+            del self.rooms[room]
+        return True
+
+    def members(self, room):
+        """Tuple of the clients subscribed to a room."""
+        with self.lock:
+            snapshot = self._room_snapshots.get(room)
+            if snapshot is None:
+                members = self.rooms.get(room)
+                if members is None:
+                    # Not cached, so unknown room names do not pile up
+                    return ()
+                snapshot = self._room_snapshots[room] = tuple(members)
+            return snapshot
+
+    def room_sizes(self):
+        """Member count of every room, by name."""
+        with self.lock:
+            return {room: len(members) for room, members in self.rooms.items()}
+
+    def get(self, nickname):
+        """The client using `nickname`, or None."""
+        return self.by_nickname.get(nickname)
+
+    def snapshot(self):
+        """Tuple of the clients connected right now."""
+        with self.lock:
+            if self._stale:
+                self._snapshot = tuple(self.by_id.values())
+                self._stale = False
+            return self._snapshot
+
+    def __contains__(self, client):
+        return self.by_id.get(client.id) is client
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def __iter__(self):
+        return iter(self.snapshot())
+
+
 class ChatServer:
-    def __init__(self, host, port):
-        """Initialize the chat server."""
+    ENGINES = ('threaded', 'asyncio')
+
+    FILE_RELAY_MODES = ('stream', 'spool')
+
+    def __init__(self, host, port, engine='threaded', high_watermark=1024 * 1024,
+                 low_watermark=256 * 1024, slow_consumer_policy='drop', file_relay='stream',
+                 blob_store_dir='blobs', blob_store_bytes=1024 * 1024 * 1024, log_dir='logs',
+                 log_max_bytes=10 * 1024 * 1024, log_max_age=None, log_compress=False,
+                 log_flush_interval=0.5, history_dir='history', compress_above=COMPRESS_ABOVE,
+                 coalesce_delay=COALESCE_DELAY, tcp_nodelay=True, tcp_cork=True,
+                 reuse_port=False, bus=None):
+        """Initialize the chat server. A worker started by run_workers shares
+        its port with the other workers (`reuse_port`). `bus` connects the
+        server to other workers or cluster nodes: a worker_bus.BusClient or
+        anything else with the interface of cluster.PubSubBackend.
+        Frames of `compress_above` bytes or more are compressed for clients
+        that ask for it (None: never). `coalesce_delay` and `tcp_cork` are
+        explained in BaseConnection; `tcp_nodelay` turns off Nagle's
+        algorithm on client sockets, as writers batch messages themselves."""
+        if engine not in self.ENGINES:
+            raise ValueError(f"Unknown engine '{engine}', expected one of {self.ENGINES}")
+        if file_relay not in self.FILE_RELAY_MODES:
+            raise ValueError(f"Unknown file relay mode '{file_relay}'")
+        if slow_consumer_policy not in BaseConnection.POLICIES:
+            raise ValueError(f"Unknown slow consumer policy '{slow_consumer_policy}'")
+        if low_watermark > high_watermark:
+            raise ValueError("low_watermark must not exceed high_watermark")
         self.host = host
         self.port = port
-        self.clients = []
-        self.nicknames = []
+        self.engine = engine
+        self.clients = ClientRegistry()
+
+        # Outbound queue and writer settings handed to every connection
+        self.queue_limits = {
+            'high_watermark': high_watermark,
+            'low_watermark': low_watermark,
+            'policy': slow_consumer_policy,
+            'on_evict': self.evict_client,
+            'coalesce_delay': coalesce_delay,
+            'cork': tcp_cork,
+        }
+        self.tcp_nodelay = tcp_nodelay
+        self.evicted_clients = 0
+
+        # Smallest frame compressed for clients that accept it, see set_options
+        self.compress_above = compress_above
+
+        # How uploads reach the other clients, see FileUpload
+        self.file_relay = file_relay
+        self.stream_lock = threading.Lock()
+        # Shared files, deduplicated by content hash
+        self.blob_store = BlobStore(blob_store_dir, blob_store_bytes)
+        # Thread of the asyncio engine for blob store writes and hashing
+        self.blob_io = None
         
         # Create server socket
         try:
             self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if reuse_port:
+                self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             self.server.bind((host, port))
-            self.server.listen()
+            self.server.listen(socket.SOMAXCONN)
             logger.info(f"Server running on {host}:{port}")
         except Exception as e:
             logger.error(f"Failed to start server: {e}")
             raise
 
-        # Create logs directory if it doesn't exist
-        if not os.path.exists('logs'):
-            os.makedirs('logs')
-        
-        self.log_file = f"logs/chat_log_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
+        # Chat log, written in batches by its own thread
+        self.chat_log = ChatLog(log_dir, flush_interval=log_flush_interval,
+                                max_bytes=log_max_bytes, max_age=log_max_age,
+                                compress=log_compress)
+        # Queryable message history, see handle_history_request
+        self.history = HistoryStore(history_dir)
+
+        # Clients of the other workers or cluster nodes: nickname -> node id
+        self.remote_nicknames = {}
+        # Event loop of the asyncio engine, which bus events must run on
+        self.loop = None
+        self.bus = bus
+        if bus is not None:
+            bus.start(self.handle_bus_event)
+            # Ask the others who is connected to them
+            bus.publish({'type': 'hello'})
 
     def log_message(self, message):
-        """Log messages to file."""
-        try:
-            with open(self.log_file, 'a', encoding='utf-8') as f:
-                f.write(f"{message}\n")
-        except Exception as e:
-            logger.error(f"Error logging message: {e}")
+        """Log messages to file. Only buffers the line: see ChatLog."""
+        self.chat_log.write(message)
+
+    def evict_client(self, client, reason):
+        """Disconnect a client whose outbound queue cannot keep up."""
+        self.evicted_clients += 1
+        logger.warning(f"Disconnecting slow client: {reason}")
+        self.remove_client(client)
+
+    def queue_stats(self):
+        """Outbound queue counters summed over all connected clients."""
+        stats = {
+            'clients': 0,
+            'queued_items': 0,
+            'active_transfers': 0,
+            'queued_bytes': 0,
+            'peak_queued_bytes': 0,
+            'congested_clients': 0,
+            'sent_messages': 0,
+            'send_calls': 0,
+            'dropped_messages': 0,
+            'received_messages': 0,
+            'evicted_clients': self.evicted_clients,
+        }
+        for client in self.clients.snapshot():
+            stats['clients'] += 1
+            stats['queued_items'] += client.queue_depth()
+            stats['active_transfers'] += len(client.transfers)
+            stats['queued_bytes'] += client.queued_bytes
+            stats['peak_queued_bytes'] = max(stats['peak_queued_bytes'], client.peak_queued_bytes)
+            stats['congested_clients'] += int(client.congested)
+            stats['sent_messages'] += client.sent_messages
+            stats['send_calls'] += client.send_calls
+            stats['dropped_messages'] += client.dropped_messages
+            stats['received_messages'] += client.received_messages
+        # How well writes are coalesced: 1.0 is one send call per message
+        stats['sends_per_message'] = stats['send_calls'] / max(stats['sent_messages'], 1)
+        return stats
+
+    def fan_out(self, msg_type, payload, exclude=None, droppable=True, recipients=None):
+        """Queue one message for every client (or every one of `recipients`)
+        except `exclude`.
+
+        The message is encoded at most once per wire format and the same
+        immutable bytes object is shared by every recipient's queue.
+        """
+        if recipients is None:
+            recipients = self.clients.snapshot()
+        names = BaseConnection.event_names(msg_type, payload)
+        encoded = {}
+        for client in recipients:
+            if client is exclude:
+                continue
+            try:
+                wire_format = client.wire_format(msg_type)
+                data = encoded.get(wire_format)
+                if data is None:
+                    data = encoded[wire_format] = client.frame(msg_type, payload)
+                client.deliver(data, droppable, names)
+            except Exception as e:
+                logger.error(f"Error broadcasting to client: {e}")
+                self.remove_client(client)
+
+    def broadcast(self, event, sender_client=None, room=None, history_line=None):
+        """Broadcast a message event (see protocol.make_event) to all
+        clients except sender, or only to the members of `room`. A
+        `history_line` is added to the room's history, here and on the
+        other nodes, and its id becomes the event's id.
+
+        Only enqueues: each client's writer does the actual network I/O.
+        """
+        if history_line is not None:
+            event['id'] = self.history.append(room, history_line)
+        recipients = None if room is None else self.clients.members(room)
+        self.fan_out(MSG_EVENT, event, exclude=sender_client, recipients=recipients)
+        if self.bus is not None:
+            self.bus.publish({'type': 'chat', 'room': room, 'event': event, 'history_line': history_line})
+
+    def notify(self, client, message):
+        """Send a server notice to one client."""
+        client.send_message(MSG_EVENT, make_event(EVENT_SYSTEM, message))
+
+    def handle_chat(self, client, message):
+        """Handle one chat line: run it if it is a command, otherwise relay
+        it to the members of the sender's current room.
+
+        Clients send lines as "nickname: text"; commands are lines whose
+        text starts with '/'.
+        """
+        _, sep, text = message.partition(': ')
+        command = text if sep else message
+        if command.startswith('/'):
+            self.handle_command(client, command)
+            return
+        if client.room is None:
+            self.notify(client, "You are not in any room. Use /join <room>.")
+            return
+        # Credited to the registered nickname, not the prefix the client sent
+        text = text if sep else message
+        line = f"{client.nickname}: {text}"
+        if client.room != DEFAULT_ROOM:
+            message = f"[#{client.room}] {line}"
+        else:
+            message = line
+        event = make_event(EVENT_CHAT, text, client.nickname, client.room)
+        self.broadcast(event, client, room=client.room, history_line=line)
+        self.log_message(message)
+
+    def handle_command(self, client, command):
+        """Run a chat command: /join, /leave, /rooms, /msg or /help."""
+        name, _, arg = command.strip().partition(' ')
+        arg = arg.strip()
+        if name == '/join':
+            self.join_room(client, arg)
+        elif name == '/leave':
+            self.leave_room(client, arg or client.room)
+        elif name == '/rooms':
+            sizes = self.clients.room_sizes()
+            listing = ', '.join(f"#{room} ({count})" for room, count in sorted(sizes.items()))
+            self.notify(client, f"Rooms: {listing}")
+        elif name == '/msg':
+            target_name, _, text = arg.partition(' ')
+            self.direct_message(client, target_name, text.strip())
+        else:
+            self.notify(client, "Commands: /join <room>, /leave [room], /rooms, /msg <nickname> <text>")
+
+    def join_room(self, client, room):
+        """Subscribe a client to a room and make it the room it talks in."""
+        room = room.lstrip('#')
+        if not room or len(room) > MAX_ROOM_NAME or not all(c.isalnum() or c in '-_' for c in room):
+            self.notify(client, f"Room names are up to {MAX_ROOM_NAME} letters, digits, '-' or '_'")
+            return
+        client.room = room
+        if self.clients.join(client, room):
+            notice = make_event(EVENT_JOIN, f"{client.nickname} joined #{room}", client.nickname, room)
+            self.broadcast(notice, client, room=room)
+        self.notify(client, f"You are now talking in #{room}")
+
+    def leave_room(self, client, room):
+        room = (room or '').lstrip('#')
+        if not self.clients.leave(client, room):
+            self.notify(client, f"You are not in #{room}")
+            return
+        notice = make_event(EVENT_LEAVE, f"{client.nickname} left #{room}", client.nickname, room)
+        self.broadcast(notice, client, room=room)
+        if client.room == room:
+            # Fall back to another room the client is still in
+            client.room = DEFAULT_ROOM if DEFAULT_ROOM in client.rooms else next(iter(client.rooms), None)
+        where = f"now talking in #{client.room}" if client.room else "not in any room"
+        self.notify(client, f"You left #{room}, {where}")
+
+    def direct_message(self, client, nickname, text):
+        """Deliver a message to a single client, found by nickname."""
+        target = self.clients.get(nickname)
+        if not text:
+            self.notify(client, "Usage: /msg <nickname> <text>")
+        elif target is not None:
+            # Like room chat, subject to the slow-consumer policy
+            target.send_message(MSG_EVENT, make_event(EVENT_DM, text, client.nickname), droppable=True)
+        elif nickname in self.remote_nicknames:
+            self.bus.publish({'type': 'dm', 'to': nickname, 'from': client.nickname, 'text': text})
+        else:
+            self.notify(client, f"No user called {nickname}")
+
+    def handle_bus_event(self, event):
+        """Called by the bus for every event another node published.
+        With the asyncio engine the event is handled on the event loop,
+        which owns the connections."""
+        loop = self.loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self.apply_bus_event, event)
+        else:
+            self.apply_bus_event(event)
+
+    def apply_bus_event(self, event):
+        """Deliver another node's message, join or leave to this node's clients."""
+        kind = event.get('type')
+        if kind == 'chat':
+            room = event['room']
+            message = event['event']
+            if event.get('history_line') is not None:
+                # Ids are per node: the one of this node's history
+                message['id'] = self.history.append(room, event['history_line'])
+            recipients = None if room is None else self.clients.members(room)
+            self.fan_out(MSG_EVENT, message, recipients=recipients)
+        elif kind == 'dm':
+            target = self.clients.get(event['to'])
+            if target is not None:
+                target.send_message(MSG_EVENT, make_event(EVENT_DM, event['text'], event['from']),
+                                    droppable=True)
+        elif kind == 'join':
+            self.remote_nicknames[event['nickname']] = event['node']
+            self.fan_out(MSG_EVENT, event['event'], recipients=self.clients.members(DEFAULT_ROOM))
+        elif kind == 'leave':
+            if self.remote_nicknames.pop(event['nickname'], None) is None:
+                # Already announced, when its node went down
+                return
+            self.fan_out(MSG_EVENT, event['event'], recipients=self.clients.members(DEFAULT_ROOM))
+        elif kind == 'hello':
+            # A node (re)started: tell it who is connected here
+            nicknames = [client.nickname for client in self.clients.snapshot()]
+            self.bus.publish({'type': 'roster', 'nicknames': nicknames})
+        elif kind == 'roster':
+            for nickname in event['nicknames']:
+                self.remote_nicknames[nickname] = event['node']
+        elif kind == 'node_down':
+            # Its clients are gone without saying goodbye
+            for nickname, node in list(self.remote_nicknames.items()):
+                if node == event['node']:
+                    del self.remote_nicknames[nickname]
+                    notice = make_event(EVENT_LEAVE, f"{nickname} left the chat!", nickname)
+                    self.fan_out(MSG_EVENT, notice, recipients=self.clients.members(DEFAULT_ROOM))
 
-    def broadcast(self, message, sender_client=None):
-        """Broadcast message to all clients except sender."""
-        timestamp = datetime.datetime.now().strftime('%H:%M:%S')
-        for client in self.clients:
-            if client != sender_client:
+    def parse_file_header(self, header):
+        """Split a "FILE:filename:filesize:sender" header into its fields."""
+        _, filename, filesize, sender = header.split(':')
+        return filename, int(filesize), sender
+
+    def relay_blob(self, digest, header, recipients):
+        """Queue a stored file for `recipients`. Returns False if the blob is
+        not (or no longer) in the store.
+
+        Each client's writer streams the blob from disk on its own; it stays
+        pinned against eviction until the last of them is done.
+        """
+        path = self.blob_store.acquire(digest)
+        if path is None:
+            return False
+        relay = RelayFile(path, header, self.blob_store.size_of(digest),
+                          on_done=lambda: self.blob_store.release(digest))
+        try:
+            for client in recipients:
                 try:
-                    if isinstance(message, str):
-                        client.send(f"[{timestamp}] {message}".encode('utf-8'))
-                    else:
-                        client.send(message)
+                    client.send_file(relay)
                 except Exception as e:
-                    logger.error(f"Error broadcasting to client: {e}")
+                    logger.error(f"Error sending file to client: {e}")
                     self.remove_client(client)
+        finally:
+            relay.release()
+        return True
+
+    def share_file(self, sender_client, digest, filename, filesize, sender, skip=()):
+        """Tell every other client about a stored file. Clients that pull
+        attachments only get its metadata; older clients are sent the file."""
+        meta_clients = []
+        push_clients = []
+        for client in self.clients.members(sender_client.room):
+            if client is sender_client or client in skip:
+                continue
+            if client.pulls_files():
+                meta_clients.append(client)
+            else:
+                push_clients.append(client)
+
+        if meta_clients:
+            meta = {'name': filename, 'size': filesize, 'hash': digest, 'sender': sender}
+            self.fan_out(MSG_FILE_META, encode_json(meta), droppable=False, recipients=meta_clients)
+        if push_clients:
+            header = f"FILE:{filename}:{filesize}:{sender}".encode('utf-8')
+            self.relay_blob(digest, header, push_clients)
+        self.finish_file_transfer(filename, filesize, sender)
+
+    def handle_file_offer(self, client, offer):
+        """Answer a MSG_FILE_OFFER. If the file is already stored the upload
+        is skipped and the other clients are told about the stored copy."""
+        digest = offer.get('hash')
+        if not is_valid_digest(digest):
+            raise ProtocolError("File offer without a valid hash")
+        need = not self.blob_store.has(digest)
+        reply = {'hash': digest, 'need': need}
+        if need and client.checks_chunks():
+            reply['offset'] = self.blob_store.partial_size(digest)
+        client.send_message(MSG_FILE_NEED, encode_json(reply))
+        if need:
+            client.offered_hash = digest
+            return
+
+        filename = os.path.basename(str(offer.get('name', digest))).replace(':', '_')
+        filesize = self.blob_store.size_of(digest)
+        self.share_file(client, digest, filename, filesize, client.nickname)
+
+    def handle_blob_request(self, client, request):
+        """Send the requested range of a stored file to the client that asked.
+        Requests with a transfer id are answered with multiplexed chunks."""
+        digest = request.get('hash')
+        transfer_id = request.get('id') if client.multiplexes_files() else None
+        offset = int(request.get('offset', 0))
+        length = request.get('length')
+        length = None if length is None else int(length)
+        path = self.blob_store.acquire(digest) if is_valid_digest(digest) else None
+        if path is None:
+            header = {'hash': digest, 'offset': 0, 'length': 0, 'error': 'not found'}
+            if transfer_id is not None:
+                header['id'] = transfer_id
+            client.send_message(MSG_BLOB_RANGE, encode_json(header))
+            return
+
+        filesize = self.blob_store.size_of(digest)
+        if not 0 <= offset <= filesize:
+            self.blob_store.release(digest)
+            raise ProtocolError(f"Range offset {offset} outside a {filesize} byte file")
+        length = filesize - offset if length is None else min(length, filesize - offset)
+        header = {'hash': digest, 'offset': offset, 'length': length, 'size': filesize}
+        if transfer_id is not None:
+            header['id'] = transfer_id
+
+        relay = RelayFile(path, encode_json(header), length, offset=offset,
+                          header_type=MSG_BLOB_RANGE,
+                          on_done=lambda: self.blob_store.release(digest))
+        try:
+            if transfer_id is None:
+                client.send_file(relay)
+            else:
+                client.send_message(MSG_BLOB_RANGE, relay.header)
+                if length:
+                    client.send_file(relay, transfer_id)
+        finally:
+            relay.release()
+
+    def finish_file_transfer(self, filename, filesize, sender):
+        """Record a relayed file transfer."""
+        logger.info(f"File '{filename}' ({filesize} bytes) transferred from {sender}")
+        self.log_message(f"[{datetime.datetime.now()}] {sender} shared file: {filename}")
 
     def handle_file_transfer(self, sender_client, message):
         """Handle file transfer between clients."""
+        upload = None
         try:
-            # Parse file header
-            header = message.decode('utf-8')
-            _, filename, filesize, sender = header.split(':')
-            filesize = int(filesize)
-            
-            # Create temp directory if not exists
-            if not os.path.exists('temp_files'):
-                os.makedirs('temp_files')
-            
-            # Save file temporarily
-            temp_path = os.path.join('temp_files', filename)
+            upload = FileUpload(self, sender_client, message)
+
+            # Receive file data into one reusable buffer
+            buffer = memoryview(bytearray(FILE_CHUNK_SIZE))
+            while upload.remaining > 0:
+                received = sender_client.recv_into(buffer[:min(FILE_CHUNK_SIZE, upload.remaining)])
+                if not received:
+                    break
+                upload.write(buffer[:received])
+                upload.wait_writable()
+
+            if upload.remaining:
+                upload.abort()
+            else:
+                upload.finish()
             
-            # Receive file data
-            file_data = b''
-            remaining = filesize
-            while remaining > 0:
-                chunk = sender_client.recv(min(8192, remaining))
+        except Exception as e:
+            logger.error(f"Error handling file transfer: {e}")
+            if upload:
+                upload.abort()
+
+    async def handle_file_transfer_async(self, sender_client, message):
+        """Handle file transfer between clients on the asyncio engine."""
+        upload = None
+        try:
+            upload = FileUpload(self, sender_client, message)
+
+            while upload.remaining > 0:
+                chunk = await sender_client.reader.read(min(FILE_CHUNK_SIZE, upload.remaining))
                 if not chunk:
                     break
-                file_data += chunk
-                remaining -= len(chunk)
-            
-            # Save file data
-            with open(temp_path, 'wb') as f:
-                f.write(file_data)
-            
-            # Broadcast file to all other clients
-            for client in self.clients:
-                if client != sender_client:
-                    try:
-                        # Send header first
-                        client.send(message)
-                        # Then send file data in chunks
-                        with open(temp_path, 'rb') as f:
-                            while True:
-                                chunk = f.read(8192)
-                                if not chunk:
-                                    break
-                                client.sendall(chunk)
-                    except Exception as e:
-                        logger.error(f"Error sending file to client: {e}")
-                        self.remove_client(client)
-            
-            # Clean up temp file
-            try:
-                os.remove(temp_path)
-            except:
-                pass
-            
-            logger.info(f"File '{filename}' ({filesize} bytes) transferred from {sender}")
-            self.log_message(f"[{datetime.datetime.now()}] {sender} shared file: {filename}")
-            
+                upload.write(chunk)
+                await upload.drain()
+
+            if upload.remaining:
+                upload.abort()
+            else:
+                upload.finish()
+
         except Exception as e:
             logger.error(f"Error handling file transfer: {e}")
+            if upload:
+                upload.abort()
+
+    def handle_frame(self, client, msg_type, payload):
+        """Dispatch one frame from a client using the framed protocol."""
+        if msg_type == MSG_TEXT:
+            self.handle_chat(client, payload.decode('utf-8'))
+        elif msg_type == MSG_SAY:
+            self.handle_chat(client, f"{client.nickname}: {payload.decode('utf-8')}")
+        elif msg_type == MSG_OPTIONS:
+            self.set_options(client, decode_json(payload))
+        elif msg_type == MSG_FILE_HEADER:
+            self.start_upload(client, None, payload, client.offered_hash)
+            client.offered_hash = None
+        elif msg_type == MSG_FILE_DATA:
+            self.upload_data(client, None, payload)
+        elif msg_type == MSG_TRANSFER_BEGIN:
+            info = decode_json(payload)
+            filename = os.path.basename(str(info.get('name', 'file'))).replace(':', '_')
+            header = f"FILE:{filename}:{int(info.get('size', 0))}:{client.nickname}"
+            offset = int(info.get('offset', 0)) if client.checks_chunks() else 0
+            self.start_upload(client, info.get('id'), header.encode('utf-8'), info.get('hash'), offset)
+        elif msg_type == MSG_TRANSFER_CHUNK:
+            try:
+                transfer_id, offset, data = parse_chunk(payload, client.checks_chunks())
+            except ChecksumError as e:
+                self.interrupt_upload(client, e.transfer_id, "checksum mismatch")
+                return
+            self.upload_data(client, transfer_id, data, offset)
+        elif msg_type == MSG_TRANSFER_ABORT:
+            self.abort_upload(client, decode_json(payload).get('id'))
+        elif msg_type == MSG_FILE_OFFER:
+            self.handle_file_offer(client, decode_json(payload))
+        elif msg_type == MSG_BLOB_REQUEST:
+            self.handle_blob_request(client, decode_json(payload))
+        elif msg_type == MSG_HISTORY_REQUEST:
+            self.handle_history_request(client, decode_json(payload))
+        else:
+            logger.warning(f"Ignoring unknown frame type {msg_type}")
+
+    def set_options(self, client, options):
+        """Apply the options a client asks for: frames to it are compressed
+        from its `compress_above` (but no less than the server's) if it
+        accepts zlib and compression is enabled here."""
+        threshold = options.get('compress_above')
+        if (self.compress_above is None or threshold is None
+                or 'zlib' not in (options.get('compression') or ())):
+            client.compress_above = None
+        else:
+            client.compress_above = max(int(threshold), self.compress_above)
+
+    def handle_history_request(self, client, request):
+        """Send one page of a room's history: the last `limit` messages
+        before message id `before`, or the newest ones."""
+        room = request.get('room') or client.room or DEFAULT_ROOM
+        before = request.get('before')
+        before = None if before is None else int(before)
+        limit = max(1, min(int(request.get('limit', DEFAULT_HISTORY_PAGE)), MAX_HISTORY_PAGE))
+        if self.loop is None:
+            self.send_history_page(client, room, self.history.page(str(room), before, limit))
+            return
+        # The query reads sqlite: keep it off the event loop
+        future = self.loop.run_in_executor(None, self.history.page, str(room), before, limit)
+        future.add_done_callback(lambda future: self.send_history_page(client, room, future.result()))
+
+    def send_history_page(self, client, room, page):
+        messages, more = page
+        reply = {'room': room, 'messages': messages, 'more': more}
+        client.send_message(MSG_HISTORY, encode_json(reply))
+
+    def start_upload(self, client, transfer_id, header, expected_hash=None, offset=0):
+        """Begin (or resume from `offset`) receiving a framed upload. Uploads
+        with a transfer id can run side by side; one started with
+        MSG_FILE_HEADER replaces the last."""
+        self.abort_upload(client, transfer_id)
+        try:
+            upload = FileUpload(self, client, header, expected_hash, offset, transfer_id)
+        except (ValueError, ProtocolError):
+            if not offset:
+                raise
+            # Less was kept than the client thinks, or the offset is past
+            # the end of the file: have it resume from what was kept
+            self.upload_failed(client, None, self.blob_store.partial_size(expected_hash),
+                               "cannot resume", transfer_id=transfer_id)
+            return
+        client.uploads[transfer_id] = upload
+        if upload.remaining == 0:
+            self.complete_upload(client, transfer_id)
+
+    def upload_data(self, client, transfer_id, data, offset=None):
+        """Add received data to one of the client's uploads."""
+        upload = client.uploads.get(transfer_id)
+        if upload is None:
+            if transfer_id is not None:
+                # Still in flight from an upload that was interrupted
+                return
+            raise ProtocolError("File data received without a file header")
+        if offset is not None and offset != upload.position():
+            self.interrupt_upload(client, transfer_id, "unexpected offset")
+            return
+        upload.write(data)
+        if upload.remaining == 0:
+            self.complete_upload(client, transfer_id)
+
+    def interrupt_upload(self, client, transfer_id, error):
+        """Stop an upload that received bad data, keeping what was good, and
+        tell the client where to resume it."""
+        upload = client.uploads.pop(transfer_id, None)
+        if upload is None:
+            return
+        logger.warning(f"Upload of '{upload.filename}' from {upload.sender} interrupted: {error}")
+        # The kept size is known once the blob is put aside
+        upload.abort(keep_partial=True, then=lambda: self.upload_failed(
+            client, upload, self.blob_store.partial_size(upload.expected_hash), error))
+
+    def upload_failed(self, client, upload, offset, error, transfer_id=None):
+        """Tell a client that its upload did not complete: clients that can
+        resume get the offset to continue from, others a chat notice."""
+        if upload is not None:
+            transfer_id = upload.transfer_id
+        if transfer_id is not None and client.checks_chunks():
+            client.send_message(MSG_TRANSFER_ABORT,
+                                encode_json({'id': transfer_id, 'offset': offset, 'error': error}))
+        elif upload is not None:
+            self.notify(client, f"File '{upload.filename}' could not be shared ({error})")
+
+    def complete_upload(self, client, transfer_id=None):
+        """Finish relaying a fully received framed upload."""
+        client.uploads.pop(transfer_id).finish()
+
+    def abort_upload(self, client, transfer_id=None):
+        """Discard a partially received framed upload."""
+        upload = client.uploads.pop(transfer_id, None)
+        if upload is not None:
+            upload.abort()
+
+    def abort_uploads(self, client):
+        """Stop every unfinished upload of a disconnecting client, keeping
+        the data of those that can be resumed."""
+        for transfer_id in list(client.uploads):
+            client.uploads.pop(transfer_id).abort(keep_partial=True)
+
+    def negotiate(self, client, reply):
+        """Read the reply to NICK, switch to framing if the client asked for it
+        and return the nickname. Legacy clients keep the text protocol."""
+        hello = parse_hello(reply)
+        if hello is None:
+            return reply.decode('utf-8')
+        version, nickname = hello
+        client.enable_framing(min(version, PROTOCOL_VERSION))
+        client.sendall(encode_hello_ack(client.protocol_version))
+        return nickname
+
+    def process_data(self, client, data):
+        """Handle data received from a framed client."""
+        for msg_type, payload in client.decoder.feed(data):
+            client.received_messages += 1
+            self.handle_frame(client, msg_type, payload)
+
+    def add_client(self, client, nickname, address):
+        """Register a new client and announce it to everyone else."""
+        requested = nickname
+        nickname = self.clients.add(client, nickname, address, taken=self.remote_nicknames)
+        self.clients.join(client, DEFAULT_ROOM)
+        client.room = DEFAULT_ROOM
+        if client.protocol_version >= NICKNAME_VERSION:
+            client.send_message(MSG_NICKNAME, nickname.encode('utf-8'))
+        if nickname != requested:
+            self.notify(client, f"Nickname {requested} is already in use, you are {nickname}")
 
-    def handle_client(self, client, address):
+        notice = make_event(EVENT_JOIN, f"{nickname} joined the chat!", nickname)
+        self.fan_out(MSG_EVENT, notice, exclude=client, recipients=self.clients.members(DEFAULT_ROOM))
+        if self.bus is not None:
+            self.bus.publish({'type': 'join', 'nickname': nickname, 'event': notice})
+
+        # Log the join
+        logger.info(f"New connection from {address}, nickname: {nickname}")
+        self.log_message(f"[{datetime.datetime.now()}] {nickname} joined the chat")
+
+    def tune_socket(self, sock):
+        """Set TCP_NODELAY on a client socket as configured."""
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(self.tcp_nodelay))
+        except (OSError, AttributeError):
+            pass
+
+    def handle_client(self, sock, address):
         """Handle individual client connection."""
+        self.tune_socket(sock)
+        client = ClientConnection(sock, **self.queue_limits)
+        nickname = None
         try:
             # Request nickname
             client.send('NICK'.encode('utf-8'))
-            nickname = client.recv(1024).decode('utf-8')
-            
-            # Send two separate messages for join notification
-            # 1. First send join notification to everyone else
-            for other_client in self.clients:
-                try:
-                    timestamp = datetime.datetime.now().strftime('%H:%M:%S')
-                    other_client.send(f"[{timestamp}] {nickname} joined the chat!".encode('utf-8'))
-                except:
-                    pass
-                    
-            # 2. Now add client to active lists
-            self.nicknames.append(nickname)
-            self.clients.append(client)
-            
-            # Log the join
-            logger.info(f"New connection from {address}, nickname: {nickname}")
-            self.log_message(f"[{datetime.datetime.now()}] {nickname} joined the chat")
+            nickname = self.negotiate(client, client.recv(1024))
+            self.add_client(client, nickname, address)
             
             # Main client handling loop
             while True:
@@ -143,13 +1704,17 @@ class ChatServer:
                     message = client.recv(8192)
                     if not message:
                         break
+                    client.received_bytes += len(message)
                     
-                    if message.startswith(b'FILE:'):
+                    if client.framed:
+                        self.process_data(client, message)
+                        for upload in list(client.uploads.values()):
+                            upload.wait_writable()
+                    elif message.startswith(b'FILE:'):
                         self.handle_file_transfer(client, message)
                     else:
-                        decoded_msg = message.decode('utf-8')
-                        self.broadcast(decoded_msg, client)
-                        self.log_message(decoded_msg)
+                        client.received_messages += 1
+                        self.handle_chat(client, message.decode('utf-8'))
                         
                 except ConnectionResetError:
                     break
@@ -160,32 +1725,82 @@ class ChatServer:
         except Exception as e:
             logger.error(f"Error in client handler: {e}")
         finally:
-            self.remove_client(client, nickname)
+            self.abort_uploads(client)
+            self.remove_client(client)
     
-    def remove_client(self, client, nickname=None):
-        """Remove client and clean up."""
+    def remove_client(self, client):
+        """Remove client and clean up. A connection that never got past the
+        handshake is only closed."""
         try:
-            if client in self.clients:
-                idx = self.clients.index(client)
-                self.clients.remove(client)
-                nickname = nickname or self.nicknames.pop(idx)
-                client.close()
+            registered = self.clients.remove(client)
+            client.close()
+            if registered:
+                nickname = client.nickname
                 
                 # Send leave notification
-                timestamp = datetime.datetime.now().strftime('%H:%M:%S')
-                for other_client in self.clients:
-                    try:
-                        other_client.send(f"[{timestamp}] {nickname} left the chat!".encode('utf-8'))
-                    except:
-                        pass
+                notice = make_event(EVENT_LEAVE, f"{nickname} left the chat!", nickname)
+                self.fan_out(MSG_EVENT, notice, recipients=self.clients.members(DEFAULT_ROOM))
+                if self.bus is not None:
+                    self.bus.publish({'type': 'leave', 'nickname': nickname, 'event': notice})
                         
                 self.log_message(f"[{datetime.datetime.now()}] {nickname} left the chat")
                 logger.info(f"Client {nickname} disconnected")
         except Exception as e:
             logger.error(f"Error removing client: {e}")
-    
+
+    async def handle_client_async(self, reader, writer):
+        """Handle individual client connection on the asyncio event loop."""
+        # asyncio turns Nagle off by itself; this keeps --no-nodelay honest
+        self.tune_socket(writer.get_extra_info('socket'))
+        client = AsyncClientConnection(reader, writer, **self.queue_limits)
+        address = client.getpeername()
+        nickname = None
+        try:
+            # Request nickname
+            client.send('NICK'.encode('utf-8'))
+            reply = await reader.read(1024)
+            if not reply:
+                client.close()
+                return
+            nickname = self.negotiate(client, reply)
+            self.add_client(client, nickname, address)
+
+            # Main client handling loop
+            while True:
+                try:
+                    message = await reader.read(8192)
+                    if not message:
+                        break
+                    client.received_bytes += len(message)
+
+                    if client.framed:
+                        self.process_data(client, message)
+                        for upload in list(client.uploads.values()):
+                            await upload.drain()
+                    elif message.startswith(b'FILE:'):
+                        await self.handle_file_transfer_async(client, message)
+                    else:
+                        client.received_messages += 1
+                        self.handle_chat(client, message.decode('utf-8'))
+
+                except ConnectionResetError:
+                    break
+                except Exception as e:
+                    logger.error(f"Error handling client {nickname}: {e}")
+                    break
+
+        except Exception as e:
+            logger.error(f"Error in client handler: {e}")
+        finally:
+            self.abort_uploads(client)
+            self.remove_client(client)
+
     def start(self):
         """Start the server and accept connections."""
+        if self.engine == 'asyncio':
+            self.start_asyncio()
+            return
+
         logger.info("Server started, waiting for connections...")
         while True:
             try:
@@ -200,27 +1815,188 @@ class ChatServer:
                 logger.error(f"Error accepting connection: {e}")
                 continue
 
+    def start_asyncio(self):
+        """Serve every client from a single asyncio event loop."""
+        raise_open_file_limit()
+        logger.info("Server started (asyncio engine), waiting for connections...")
+        asyncio.run(self._serve_asyncio())
+
+    async def _serve_asyncio(self):
+        self.loop = asyncio.get_running_loop()
+        self.blob_io = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='blob-io')
+        self.server.setblocking(False)
+        server = await asyncio.start_server(self.handle_client_async, sock=self.server)
+        async with server:
+            await server.serve_forever()
+
     def stop(self):
         """Stop the server gracefully."""
         logger.info("Shutting down server...")
-        for client in self.clients:
+        for client in self.clients.snapshot():
             try:
                 client.close()
             except:
                 pass
         self.server.close()
+        if self.bus is not None:
+            self.bus.close()
+        if self.blob_io is not None:
+            self.blob_io.shutdown()
+        self.chat_log.close()
+        self.history.close()
+
+
+def run_worker(worker_id, bus_sock, server_options):
+    """Body of one forked worker: serve clients on the shared port until
+    told to stop. Logs, stored files and history go to per-worker subdirectories."""
+    # The supervisor stops workers with SIGTERM
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    options = dict(server_options)
+    options['log_dir'] = os.path.join(options.get('log_dir', 'logs'), f"worker-{worker_id}")
+    options['blob_store_dir'] = os.path.join(options.get('blob_store_dir', 'blobs'), f"worker-{worker_id}")
+    options['history_dir'] = os.path.join(options.get('history_dir', 'history'), f"worker-{worker_id}")
+    server = None
+    try:
+        server = ChatServer(reuse_port=True, bus=BusClient(bus_sock, worker_id), **options)
+        logger.info(f"Worker {worker_id} (pid {os.getpid()}) started")
+        server.start()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    except Exception as e:
+        logger.error(f"Worker {worker_id} failed: {e}")
+        return 1
+    finally:
+        # Do not let a second signal cut the final log flush short
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        if server:
+            server.stop()
+    return 0
+
+
+def run_workers(count, **server_options):
+    """Fork `count` worker processes that share the listening port through
+    SO_REUSEPORT, and relay events between them (see worker_bus) until
+    they have all exited."""
+    if not hasattr(os, 'fork') or not hasattr(socket, 'SO_REUSEPORT'):
+        raise RuntimeError("Multiple workers need fork() and SO_REUSEPORT")
+    hub = BusHub()
+    bus_socks = {worker_id: hub.add_worker(worker_id) for worker_id in range(1, count + 1)}
+    pids = []
+    for worker_id, bus_sock in bus_socks.items():
+        pid = os.fork()
+        if pid == 0:
+            # Keep only this worker's end of the bus
+            hub.close()
+            for other in bus_socks.values():
+                if other is not bus_sock:
+                    other.close()
+            os._exit(run_worker(worker_id, bus_sock, server_options))
+        pids.append(pid)
+    for bus_sock in bus_socks.values():
+        bus_sock.close()
+
+    logger.info(f"Started {count} workers on port {server_options['port']}")
+    try:
+        hub.serve()
+    except KeyboardInterrupt:
+        logger.info("Stopping workers...")
+    finally:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in pids:
+            os.waitpid(pid, 0)
+        hub.close()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Real-time chat server")
+    parser.add_argument('--host', help="address to bind (default: local IP)")
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--engine', choices=ChatServer.ENGINES, default='threaded',
+                        help="threaded: one thread per client, asyncio: single event loop")
+    parser.add_argument('--high-watermark', type=int, default=1024 * 1024,
+                        help="queued bytes per client before it counts as a slow consumer")
+    parser.add_argument('--low-watermark', type=int, default=256 * 1024,
+                        help="queued bytes per client below which it recovers")
+    parser.add_argument('--slow-consumer', choices=BaseConnection.POLICIES, default='drop',
+                        help="drop new messages for slow clients or disconnect them")
+    parser.add_argument('--file-relay', choices=ChatServer.FILE_RELAY_MODES, default='stream',
+                        help="stream: forward chunks as they arrive, spool: relay from disk when complete")
+    parser.add_argument('--blob-store', default='blobs',
+                        help="directory holding shared files by content hash")
+    parser.add_argument('--blob-store-size', type=int, default=1024,
+                        help="maximum size of the file store in MB")
+    parser.add_argument('--log-dir', default='logs',
+                        help="directory for chat logs")
+    parser.add_argument('--log-max-size', type=int, default=10,
+                        help="start a new chat log after this many MB (0: never)")
+    parser.add_argument('--log-rotate-hours', type=float, default=0,
+                        help="start a new chat log after this many hours (0: never)")
+    parser.add_argument('--log-compress', action='store_true',
+                        help="gzip chat logs once they are rotated")
+    parser.add_argument('--log-flush-interval', type=float, default=0.5,
+                        help="seconds between writes of buffered chat log lines")
+    parser.add_argument('--history-dir', default='history',
+                        help="directory of the message history database")
+    parser.add_argument('--compress-above', type=int, default=COMPRESS_ABOVE,
+                        help="compress frames of this many bytes or more for clients that accept it (0: never)")
+    parser.add_argument('--coalesce-ms', type=float, default=COALESCE_DELAY * 1000,
+                        help="how long a client's writer waits to send queued messages together (0: never)")
+    parser.add_argument('--no-nodelay', action='store_true',
+                        help="leave Nagle's algorithm on for client sockets")
+    parser.add_argument('--no-cork', action='store_true',
+                        help="do not cork file headers together with their data (TCP_CORK, Linux)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of worker processes sharing the port (Linux)")
+    parser.add_argument('--cluster', metavar='HOST:PORT',
+                        help="join a cluster through the broker at this address (see cluster.py)")
+    parser.add_argument('--node-id', help="id of this server in the cluster (default: random)")
+    args = parser.parse_args()
+    if args.cluster and args.workers > 1:
+        parser.error("--cluster cannot be combined with --workers")
+
+    server = None
     try:
         # Get local IP address
-        HOST = socket.gethostbyname(socket.gethostname())
-        PORT = 8000
+        HOST = args.host or socket.gethostbyname(socket.gethostname())
+        PORT = args.port
         
-        server = ChatServer(HOST, PORT)
-        logger.info(f"Chat server started on {HOST}:{PORT}")
-        server.start()
+        options = dict(
+            host=HOST, port=PORT,
+            engine=args.engine,
+            high_watermark=args.high_watermark,
+            low_watermark=args.low_watermark,
+            slow_consumer_policy=args.slow_consumer,
+            file_relay=args.file_relay,
+            blob_store_dir=args.blob_store,
+            blob_store_bytes=args.blob_store_size * 1024 * 1024,
+            log_dir=args.log_dir,
+            log_max_bytes=args.log_max_size * 1024 * 1024 or None,
+            log_max_age=args.log_rotate_hours * 3600 or None,
+            log_compress=args.log_compress,
+            log_flush_interval=args.log_flush_interval,
+            history_dir=args.history_dir,
+            compress_above=args.compress_above or None,
+            coalesce_delay=args.coalesce_ms / 1000,
+            tcp_nodelay=not args.no_nodelay,
+            tcp_cork=not args.no_cork,
+        )
+        if args.workers > 1:
+            run_workers(args.workers, **options)
+        else:
+            if args.cluster:
+                backend = TcpBackend(parse_address(args.cluster), args.node_id)
+                options['bus'] = ClusterBus(backend)
+                logger.info(f"Joining cluster at {args.cluster} as node {backend.node_id}")
+            server = ChatServer(**options)
+            logger.info(f"Chat server started on {HOST}:{PORT} ({args.engine} engine)")
+            server.start()
     except KeyboardInterrupt:
         logger.info("Server stopped by user")
-        server.stop()
+        if server:
+            server.stop()
     except Exception as e:
-        logger.error(f"Fatal server error: {e}")
\ No newline at end of file
+        logger.error(f"Fatal server error: {e}")
@@ -0,0 +1,127 @@
+# tests/support.py
+"""Helpers shared by the tests: servers on loopback ports and a framed
+test client."""
+import logging
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+from protocol import (  # noqa: E402
+    HELLO_PREFIX, MSG_COMPACT_EVENT, MSG_NAME, MSG_SAY, FrameDecoder, decode_compact_event,
+    decode_json, encode_frame, encode_hello, parse_hello_ack, parse_name,
+)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class ChatClient:
+    """Framed test client that collects the events it is sent. With
+    `read=False` nothing is read, like a client that stopped reading."""
+
+    def __init__(self, port, nickname, read=True):
+        self.nickname = nickname
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        self.sock.recv(16)
+        self.sock.sendall(encode_hello(nickname))
+        self.decoder = FrameDecoder()
+        self.names = {}
+        self.events = []
+        # Every other frame, as (type, payload)
+        self.frames = []
+        self.lock = threading.Lock()
+        version, rest = parse_hello_ack(self.sock.recv(len(HELLO_PREFIX) + 1))
+        assert version is not None
+        self.feed(rest)
+        if read:
+            threading.Thread(target=self.read_loop, daemon=True).start()
+
+    def read_loop(self):
+        try:
+            while True:
+                data = self.sock.recv(65536)
+                if not data:
+                    return
+                self.feed(data)
+        except OSError:
+            pass
+
+    def feed(self, data):
+        for msg_type, payload in self.decoder.feed(data):
+            if msg_type == MSG_NAME:
+                name_id, name = parse_name(payload)
+                self.names[name_id] = name
+            elif msg_type == MSG_COMPACT_EVENT:
+                with self.lock:
+                    self.events.append(decode_compact_event(payload, self.names))
+            else:
+                with self.lock:
+                    self.frames.append((msg_type, payload))
+
+    def say(self, text):
+        self.send(MSG_SAY, text.encode('utf-8'))
+
+    def send(self, msg_type, payload):
+        self.sock.sendall(encode_frame(msg_type, payload))
+
+    def received(self, msg_type):
+        """Payloads of the frames of `msg_type` received so far, as JSON."""
+        with self.lock:
+            return [decode_json(payload) for frame_type, payload in self.frames if frame_type == msg_type]
+
+    def find(self, kind, text=None):
+        with self.lock:
+            return [event for event in self.events
+                    if event['kind'] == kind and (text is None or event['text'] == text)]
+
+    def close(self):
+        self.sock.close()
+
+
+class ServerTestCase(unittest.TestCase):
+    """Runs ChatServers on loopback ports, with their files in a
+    temporary directory."""
+
+    def setUp(self):
+        logging.disable(logging.WARNING)
+        self.directory = tempfile.mkdtemp()
+        self.servers = []
+
+    def tearDown(self):
+        for chat_server in self.servers:
+            chat_server.stop()
+        shutil.rmtree(self.directory, ignore_errors=True)
+        logging.disable(logging.NOTSET)
+
+    def start_server(self, name='server', **options):
+        directory = os.path.join(self.directory, name)
+        chat_server = server.ChatServer(
+            '127.0.0.1', 0, log_dir=os.path.join(directory, 'logs'),
+            blob_store_dir=os.path.join(directory, 'blobs'),
+            history_dir=os.path.join(directory, 'history'), **options)
+        # Named, so tests can tell work done on the server's own thread
+        threading.Thread(target=chat_server.start, name=f"{name}-main", daemon=True).start()
+        self.servers.append(chat_server)
+        return chat_server
+
+    def connect(self, chat_server, nickname, read=True):
+        """Connect a ChatClient and wait until the server has registered it."""
+        registered = len(chat_server.clients.by_id)
+        client = ChatClient(chat_server.server.getsockname()[1], nickname, read)
+        self.addCleanup(client.close)
+        self.assertTrue(wait_for(lambda: len(chat_server.clients.by_id) > registered))
+        return client
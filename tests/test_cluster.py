@@ -0,0 +1,100 @@
+# tests/test_cluster.py
+"""ClusterBus and cluster events over the in-process loopback backend.
+
+    python -m pytest tests
+"""
+import time
+import unittest
+
+from support import ServerTestCase, wait_for
+from cluster import ClusterBus, LoopbackBackend, LoopbackBroker
+from protocol import EVENT_DM
+
+
+class ClusterBusTest(unittest.TestCase):
+    """A raw backend publishes numbered events the way a misbehaving
+    broker might deliver them; a ClusterBus on another node receives them."""
+
+    def setUp(self):
+        broker = LoopbackBroker()
+        self.received = []
+        self.bus = ClusterBus(LoopbackBackend(broker, 'receiver'))
+        self.bus.start(self.received.append)
+        self.sender = LoopbackBackend(broker, 'sender')
+        self.sender.start(lambda event: None)
+
+    def tearDown(self):
+        self.sender.close()
+        self.bus.close()
+
+    def publish(self, *seqs):
+        for seq in seqs:
+            self.sender.publish({'type': 'chat', 'seq': seq, 'id': f"sender:{seq}"})
+
+    def delivered(self, count):
+        wait_for(lambda: len(self.received) >= count)
+        # Anything delivered by mistake would follow shortly
+        time.sleep(0.05)
+        return [event['seq'] for event in self.received]
+
+    def test_duplicates_are_delivered_once(self):
+        self.publish(1, 2, 2, 1, 3, 3)
+        self.assertEqual(self.delivered(3), [1, 2, 3])
+        self.assertEqual(self.bus.stats()['duplicate_events'], 3)
+
+    def test_events_are_delivered_in_publish_order(self):
+        # The first event seen from a node is where its numbering starts
+        self.publish(1, 4, 3, 5, 2)
+        self.assertEqual(self.delivered(5), [1, 2, 3, 4, 5])
+        self.assertEqual(self.bus.stats()['delivered_events'], 5)
+
+    def test_events_wait_for_a_missing_one(self):
+        self.publish(1, 3, 4)
+        self.assertEqual(self.delivered(1), [1])
+        self.publish(2)
+        self.assertEqual(self.delivered(4), [1, 2, 3, 4])
+
+    def test_node_down_starts_the_node_afresh(self):
+        self.publish(1, 2)
+        self.delivered(2)
+        self.sender.close()
+        self.assertTrue(wait_for(lambda: self.received[-1].get('type') == 'node_down'))
+        # A node that comes back under the same id numbers from 1 again
+        self.sender = LoopbackBackend(self.sender.broker, 'sender')
+        self.sender.start(lambda event: None)
+        self.publish(1)
+        self.assertTrue(wait_for(lambda: len(self.received) == 4))
+        self.assertEqual(self.received[-1]['seq'], 1)
+
+
+class ClusterDirectMessageTest(ServerTestCase):
+    """Two servers in one process, clustered over the loopback backend."""
+
+    def setUp(self):
+        super().setUp()
+        broker = LoopbackBroker()
+        self.servers_ab = [self.start_server(name, bus=ClusterBus(LoopbackBackend(broker, name)))
+                           for name in ('a', 'b')]
+
+    def test_direct_message_reaches_a_user_on_another_node(self):
+        a, b = self.servers_ab
+        alice = self.connect(a, 'alice')
+        bob = self.connect(b, 'bob')
+        self.assertTrue(wait_for(lambda: 'bob' in a.remote_nicknames))
+
+        alice.say('/msg bob hello over there')
+        self.assertTrue(wait_for(lambda: bob.find(EVENT_DM)))
+        dm, = bob.find(EVENT_DM)
+        self.assertEqual((dm['sender'], dm['text']), ('alice', 'hello over there'))
+        self.assertEqual(alice.find(EVENT_DM), [])
+
+    def test_remote_nickname_is_not_handed_out_again(self):
+        a, b = self.servers_ab
+        self.connect(b, 'bob')
+        self.assertTrue(wait_for(lambda: 'bob' in a.remote_nicknames))
+        self.connect(a, 'bob')
+        self.assertTrue(wait_for(lambda: a.clients.get('bob_2') is not None))
+
+
+if __name__ == "__main__":
+    unittest.main()
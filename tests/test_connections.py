@@ -0,0 +1,90 @@
+# tests/test_connections.py
+"""Outbound queues, slow-consumer policies and connection cleanup."""
+import socket
+import threading
+import unittest
+
+from support import ServerTestCase, wait_for
+from server import ClientConnection
+
+
+def writer_threads():
+    return [thread for thread in threading.enumerate() if '_writer_loop' in thread.name]
+
+
+class OutboundQueueTest(unittest.TestCase):
+    """A ClientConnection whose peer never reads."""
+
+    def connection(self, policy):
+        sock, self.peer = socket.socketpair()
+        self.addCleanup(self.peer.close)
+        # Small buffers, so the writer blocks soon and the queue fills
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        self.evicted = []
+        client = ClientConnection(sock, high_watermark=64 * 1024, low_watermark=16 * 1024,
+                                  policy=policy, on_evict=lambda c, reason: self.evicted.append(reason))
+        self.addCleanup(client.close)
+        return client
+
+    def flood(self, client, droppable, count=200):
+        return [client.enqueue(b'x' * 1024, droppable) for _ in range(count)]
+
+    def test_drop_policy_drops_over_the_high_watermark(self):
+        client = self.connection('drop')
+        results = self.flood(client, droppable=True)
+        self.assertIn(False, results)
+        self.assertGreater(client.dropped_messages, 0)
+        self.assertLessEqual(client.queued_bytes, client.high_watermark)
+        self.assertEqual(self.evicted, [])
+
+    def test_disconnect_policy_evicts(self):
+        client = self.connection('disconnect')
+        results = self.flood(client, droppable=True)
+        self.assertIn(False, results)
+        self.assertEqual(len(self.evicted), results.count(False))
+        self.assertEqual(client.dropped_messages, 0)
+
+    def test_messages_that_must_arrive_are_always_queued(self):
+        client = self.connection('disconnect')
+        results = self.flood(client, droppable=False)
+        self.assertTrue(all(results))
+        self.assertGreater(client.queued_bytes, client.high_watermark)
+        self.assertEqual(self.evicted, [])
+
+    def test_congestion_ends_below_the_low_watermark(self):
+        client = self.connection('drop')
+        self.flood(client, droppable=True)
+        self.assertTrue(client.congested)
+        self.peer.setblocking(False)
+
+        def drain():
+            try:
+                while self.peer.recv(65536):
+                    pass
+            except BlockingIOError:
+                pass
+            return client.queued_bytes == 0
+        self.assertTrue(wait_for(drain))
+        self.assertFalse(client.congested)
+        self.assertTrue(client.enqueue(b'x', droppable=True))
+
+
+class FailedHandshakeTest(ServerTestCase):
+
+    def test_failed_handshake_leaves_no_writer_thread(self):
+        chat_server = self.start_server()
+        port = chat_server.server.getsockname()[1]
+        before = len(writer_threads())
+        for _ in range(5):
+            with socket.create_connection(('127.0.0.1', port)) as sock:
+                sock.recv(16)
+                # Not UTF-8: decoding the nickname fails
+                sock.sendall(b'\xff\xfe')
+                sock.settimeout(5)
+                self.assertEqual(sock.recv(16), b'')
+        self.assertTrue(wait_for(lambda: len(writer_threads()) <= before))
+        self.assertEqual(len(chat_server.clients.by_id), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
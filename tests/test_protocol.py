@@ -0,0 +1,128 @@
+# tests/test_protocol.py
+"""Frames, varints, compact events and compressed frames."""
+import unittest
+
+import support  # noqa: F401 (puts the repo on sys.path)
+from protocol import (
+    EVENT_CHAT, EVENT_SYSTEM, MSG_COMPACT_EVENT, MSG_SAY, MSG_TEXT, NameTable, ProtocolError,
+    FrameDecoder, compress_frame, decode_compact_event, decode_varint, decompress_frame,
+    encode_compact_event, encode_frame, encode_hello, encode_hello_ack, encode_json, encode_varint,
+    make_event, parse_hello, parse_hello_ack,
+)
+
+
+class FrameDecoderTest(unittest.TestCase):
+
+    def test_frames_split_over_many_reads(self):
+        data = encode_frame(MSG_TEXT, b'hello') + encode_frame(MSG_SAY, b'')
+        decoder = FrameDecoder()
+        frames = []
+        for i in range(len(data)):
+            frames += decoder.feed(data[i:i + 1])
+        self.assertEqual(frames, [(MSG_TEXT, b'hello'), (MSG_SAY, b'')])
+        self.assertEqual(decoder.pending(), 0)
+
+    def test_frames_joined_in_one_read(self):
+        data = b''.join(encode_frame(MSG_TEXT, str(i).encode()) for i in range(100))
+        decoder = FrameDecoder()
+        frames = decoder.feed(data + encode_frame(MSG_TEXT, b'partial')[:-3])
+        self.assertEqual([payload for _, payload in frames], [str(i).encode() for i in range(100)])
+        self.assertEqual(decoder.pending(), len(encode_frame(MSG_TEXT, b'partial')) - 3)
+        self.assertEqual(decoder.feed(b'ial'), [(MSG_TEXT, b'partial')])
+
+    def test_oversized_frame_is_refused(self):
+        decoder = FrameDecoder(max_frame_size=10)
+        with self.assertRaises(ProtocolError):
+            decoder.feed(encode_frame(MSG_TEXT, b'x' * 11))
+
+
+class VarintTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        for value in (0, 1, 127, 128, 300, 2 ** 32, 2 ** 63 - 1):
+            data = encode_varint(value) + b'rest'
+            self.assertEqual(decode_varint(data), (value, len(data) - 4))
+        self.assertEqual(len(encode_varint(127)), 1)
+        self.assertEqual(len(encode_varint(128)), 2)
+
+    def test_truncated_varint(self):
+        with self.assertRaises(ProtocolError):
+            decode_varint(encode_varint(300)[:1])
+
+
+class CompactEventTest(unittest.TestCase):
+
+    def setUp(self):
+        self.table = NameTable()
+
+    def names(self):
+        return {name_id: name for name, name_id in self.table.ids.items()}
+
+    def round_trip(self, event):
+        payload = encode_compact_event(event, self.table.intern)
+        return decode_compact_event(payload, self.names())
+
+    def test_chat_event_round_trip(self):
+        event = make_event(EVENT_CHAT, 'hi there ☕', 'alice', 'lobby', 42, timestamp=1700000000)
+        self.assertEqual(self.round_trip(event), event)
+
+    def test_fields_without_a_value_stay_out(self):
+        event = make_event(EVENT_SYSTEM, 'Welcome', timestamp=1700000000)
+        self.assertEqual(self.round_trip(event), event)
+
+    def test_smaller_than_json(self):
+        event = make_event(EVENT_CHAT, 'ok', 'alice', 'lobby', 42, timestamp=1700000000)
+        self.assertLess(len(encode_compact_event(event, self.table.intern)), len(encode_json(event)) // 3)
+
+    def test_unknown_name_id_is_refused(self):
+        payload = encode_compact_event(make_event(EVENT_CHAT, 'hi', 'alice', timestamp=1), self.table.intern)
+        with self.assertRaises(ProtocolError):
+            decode_compact_event(payload, {})
+
+
+class NameTableTest(unittest.TestCase):
+
+    def test_ids_are_stable_while_in_use(self):
+        table = NameTable()
+        self.assertEqual(table.intern('alice'), table.intern('alice'))
+        self.assertNotEqual(table.intern('alice'), table.intern('bob'))
+
+    def test_least_recently_used_id_is_reused(self):
+        table = NameTable(max_names=2)
+        alice, bob = table.intern('alice'), table.intern('bob')
+        table.intern('alice')
+        self.assertEqual(table.intern('carol'), bob)
+        self.assertEqual(table.intern('alice'), alice)
+        self.assertEqual(len(table.ids), 2)
+
+
+class CompressedFrameTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        payload = b'the same words again ' * 100
+        frame = compress_frame(MSG_COMPACT_EVENT, payload)
+        self.assertLess(len(frame), len(payload))
+        (msg_type, inner), = FrameDecoder().feed(frame)
+        self.assertEqual(decompress_frame(inner), (MSG_COMPACT_EVENT, payload))
+
+    def test_incompressible_payload_is_left_alone(self):
+        self.assertIsNone(compress_frame(MSG_TEXT, b'short'))
+
+    def test_decompressed_size_is_limited(self):
+        frame = compress_frame(MSG_TEXT, b'\x00' * 10000)
+        (_, inner), = FrameDecoder().feed(frame)
+        with self.assertRaises(ProtocolError):
+            decompress_frame(inner, max_size=1000)
+
+
+class HelloTest(unittest.TestCase):
+
+    def test_hello_and_ack(self):
+        self.assertEqual(parse_hello(encode_hello('alice', 7)), (7, 'alice'))
+        self.assertIsNone(parse_hello(b'alice'))
+        self.assertEqual(parse_hello_ack(encode_hello_ack(8) + b'next'), (8, b'next'))
+        self.assertEqual(parse_hello_ack(b'[12:00:00] hi'), (None, b'[12:00:00] hi'))
+
+
+if __name__ == "__main__":
+    unittest.main()
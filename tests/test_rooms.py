@@ -0,0 +1,108 @@
+# tests/test_rooms.py
+"""Rooms, direct messages, and the slow-consumer policy for both, on
+both engines."""
+import time
+import unittest
+from unittest import mock
+
+from support import ServerTestCase, wait_for
+import server
+from protocol import EVENT_CHAT, EVENT_DM, EVENT_SYSTEM, NameTable
+
+# Enough to fill the socket buffers between server and client several times
+FLOOD_MESSAGES = 4000
+FLOOD_TEXT = 'x' * 4000
+
+
+class RoomsTest(ServerTestCase):
+    engine = 'threaded'
+
+    def start_server(self, name='server', **options):
+        return super().start_server(name, engine=self.engine, **options)
+
+    def test_room_chat_reaches_only_its_members(self):
+        chat_server = self.start_server()
+        alice = self.connect(chat_server, 'alice')
+        bob = self.connect(chat_server, 'bob')
+        carol = self.connect(chat_server, 'carol')
+        alice.say('/join dev')
+        bob.say('/join dev')
+        self.assertTrue(wait_for(lambda: bob.find(EVENT_SYSTEM, "You are now talking in #dev")))
+
+        alice.say('in dev only')
+        self.assertTrue(wait_for(lambda: bob.find(EVENT_CHAT, 'in dev only')))
+        message, = bob.find(EVENT_CHAT, 'in dev only')
+        self.assertEqual((message['sender'], message['room']), ('alice', 'dev'))
+        # Give a wrongly delivered copy time to arrive
+        time.sleep(0.1)
+        self.assertEqual(carol.find(EVENT_CHAT), [])
+        self.assertEqual(alice.find(EVENT_CHAT), [])
+
+    def test_leaving_a_room_falls_back_to_the_lobby(self):
+        chat_server = self.start_server()
+        alice = self.connect(chat_server, 'alice')
+        bob = self.connect(chat_server, 'bob')
+        alice.say('/join dev')
+        alice.say('/leave dev')
+        self.assertTrue(wait_for(lambda: alice.find(EVENT_SYSTEM, "You left #dev, now talking in #lobby")))
+        alice.say('back in the lobby')
+        self.assertTrue(wait_for(lambda: bob.find(EVENT_CHAT, 'back in the lobby')))
+        self.assertEqual(chat_server.clients.room_sizes().get('dev', 0), 0)
+
+    def test_direct_message_reaches_only_its_target(self):
+        chat_server = self.start_server()
+        alice = self.connect(chat_server, 'alice')
+        bob = self.connect(chat_server, 'bob')
+        carol = self.connect(chat_server, 'carol')
+        alice.say('/msg bob just for you')
+        self.assertTrue(wait_for(lambda: bob.find(EVENT_DM, 'just for you')))
+        self.assertEqual(bob.find(EVENT_DM)[0]['sender'], 'alice')
+        time.sleep(0.1)
+        self.assertEqual(carol.find(EVENT_DM), [])
+
+        alice.say('/msg nobody hello')
+        self.assertTrue(wait_for(lambda: alice.find(EVENT_SYSTEM, "No user called nobody")))
+
+    def test_reused_name_ids_are_announced_again(self):
+        chat_server = self.start_server()
+        # Room and nicknames take turns with two ids
+        with mock.patch.object(server.BaseConnection, 'names', NameTable(max_names=2)):
+            watcher = self.connect(chat_server, 'watcher')
+            talkers = [self.connect(chat_server, nickname) for nickname in ('alice', 'bob', 'carol')]
+            for round in range(3):
+                for talker in talkers:
+                    talker.say(f"round {round}")
+            self.assertTrue(wait_for(lambda: len(watcher.find(EVENT_CHAT)) == 9))
+        # Each talker's messages arrive in order, interleaved with the others'
+        self.assertEqual(sorted((event['sender'], event['room'], event['text'])
+                                for event in watcher.find(EVENT_CHAT)),
+                         [(nickname, 'lobby', f"round {round}")
+                          for nickname in ('alice', 'bob', 'carol') for round in range(3)])
+
+    def flood_direct_messages(self, policy):
+        chat_server = self.start_server(high_watermark=64 * 1024, low_watermark=16 * 1024,
+                                        slow_consumer_policy=policy)
+        attacker = self.connect(chat_server, 'attacker')
+        self.connect(chat_server, 'victim', read=False)
+        victim = chat_server.clients.get('victim')
+        for _ in range(FLOOD_MESSAGES):
+            attacker.say(f"/msg victim {FLOOD_TEXT}")
+        return chat_server, victim
+
+    def test_direct_message_flood_is_dropped_for_a_slow_reader(self):
+        chat_server, victim = self.flood_direct_messages('drop')
+        self.assertTrue(wait_for(lambda: victim.dropped_messages > 0, timeout=10))
+        self.assertLessEqual(victim.queued_bytes, victim.high_watermark + len(FLOOD_TEXT) + 64)
+
+    def test_direct_message_flood_evicts_a_slow_reader(self):
+        chat_server, victim = self.flood_direct_messages('disconnect')
+        self.assertTrue(wait_for(lambda: chat_server.clients.get('victim') is None, timeout=10))
+        self.assertTrue(victim.closed)
+
+
+class AsyncRoomsTest(RoomsTest):
+    engine = 'asyncio'
+
+
+if __name__ == "__main__":
+    unittest.main()
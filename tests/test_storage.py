@@ -0,0 +1,93 @@
+# tests/test_storage.py
+"""History pages and stored uploads, on both engines. The asyncio engine
+must not touch sqlite or the blob files from its event loop."""
+import hashlib
+import os
+import threading
+import unittest
+from unittest import mock
+
+from support import ServerTestCase, wait_for
+from blob_store import BlobWriter
+from history_store import HistoryStore
+from protocol import (
+    EVENT_CHAT, MSG_FILE_META, MSG_HISTORY, MSG_HISTORY_REQUEST, MSG_TRANSFER_ABORT,
+    MSG_TRANSFER_BEGIN, encode_chunk, encode_json,
+)
+
+
+class StorageTest(ServerTestCase):
+    engine = 'threaded'
+
+    def setUp(self):
+        super().setUp()
+        self.chat_server = self.start_server(engine=self.engine)
+        self.alice = self.connect(self.chat_server, 'alice')
+        self.bob = self.connect(self.chat_server, 'bob')
+        # Threads that did the work under test
+        self.threads = []
+
+    def record_thread(self, func):
+        def recorded(*args, **kwargs):
+            self.threads.append(threading.current_thread())
+            return func(*args, **kwargs)
+        return recorded
+
+    def assert_off_the_event_loop(self):
+        if self.engine == 'asyncio':
+            self.assertTrue(self.threads)
+            # The event loop runs on the thread that called start()
+            self.assertNotIn('server-main', [thread.name for thread in self.threads])
+
+    def test_history_page(self):
+        for i in range(3):
+            self.alice.say(f"message {i}")
+        self.assertTrue(wait_for(lambda: len(self.bob.find(EVENT_CHAT)) == 3))
+        with mock.patch.object(HistoryStore, 'page', self.record_thread(HistoryStore.page)):
+            self.bob.send(MSG_HISTORY_REQUEST, encode_json({'limit': 2}))
+            self.assertTrue(wait_for(lambda: self.bob.received(MSG_HISTORY)))
+        page, = self.bob.received(MSG_HISTORY)
+        self.assertEqual([message['text'] for message in page['messages']],
+                         ['alice: message 1', 'alice: message 2'])
+        self.assertTrue(page['more'])
+        self.assert_off_the_event_loop()
+
+    def upload(self, data, digest, offset=0, corrupt_at=None):
+        self.alice.send(MSG_TRANSFER_BEGIN, encode_json(
+            {'id': 1, 'name': 'a.bin', 'size': len(data), 'hash': digest, 'offset': offset}))
+        for start in range(offset, len(data), 16384):
+            chunk = encode_chunk(1, data[start:start + 16384], start)
+            if start == corrupt_at:
+                chunk = chunk[:-1] + bytes([chunk[-1] ^ 1])
+            self.alice.sock.sendall(chunk)
+
+    def test_upload_is_stored_and_shared(self):
+        data = os.urandom(200000)
+        digest = hashlib.sha256(data).hexdigest()
+        with mock.patch.object(BlobWriter, 'write', self.record_thread(BlobWriter.write)):
+            self.upload(data, digest)
+            self.assertTrue(wait_for(lambda: self.bob.received(MSG_FILE_META)))
+        meta, = self.bob.received(MSG_FILE_META)
+        self.assertEqual((meta['hash'], meta['size']), (digest, len(data)))
+        self.assertEqual(self.chat_server.blob_store.size_of(digest), len(data))
+        self.assert_off_the_event_loop()
+
+    def test_interrupted_upload_resumes(self):
+        data = os.urandom(100000)
+        digest = hashlib.sha256(data).hexdigest()
+        self.upload(data, digest, corrupt_at=32768)
+        self.assertTrue(wait_for(lambda: self.alice.received(MSG_TRANSFER_ABORT)))
+        abort, = self.alice.received(MSG_TRANSFER_ABORT)
+        self.assertEqual(abort['offset'], 32768)
+
+        self.upload(data, digest, offset=abort['offset'])
+        self.assertTrue(wait_for(lambda: self.bob.received(MSG_FILE_META)))
+        self.assertEqual(self.chat_server.blob_store.size_of(digest), len(data))
+
+
+class AsyncStorageTest(StorageTest):
+    engine = 'asyncio'
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,126 @@
+# tests/test_workers.py
+"""`server.py --workers 2`: clients of different workers see each
+other's messages. Linux only, as it finds each client's worker in /proc."""
+import os
+import signal
+import socket
+import subprocess
+import sys
+import unittest
+
+from support import ChatClient, ServerTestCase, wait_for
+from protocol import EVENT_CHAT, EVENT_DM, EVENT_JOIN
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def socket_inodes(pid):
+    inodes = set()
+    for fd in os.listdir(f"/proc/{pid}/fd"):
+        try:
+            target = os.readlink(f"/proc/{pid}/fd/{fd}")
+        except OSError:
+            continue
+        if target.startswith('socket:['):
+            inodes.add(target[8:-1])
+    return inodes
+
+
+def tcp_sockets():
+    """(local port, remote port, state, inode) of the IPv4 TCP sockets."""
+    with open('/proc/net/tcp') as table:
+        for line in list(table)[1:]:
+            fields = line.split()
+            yield (int(fields[1].split(':')[1], 16), int(fields[2].split(':')[1], 16),
+                   fields[3], fields[9])
+
+
+def listening_sockets(port):
+    return [inode for local, _, state, inode in tcp_sockets() if local == port and state == '0A']
+
+
+def server_side_inode(client):
+    """Inode of the server's socket for `client`'s connection."""
+    client_port = client.sock.getsockname()[1]
+    for _, remote, _, inode in tcp_sockets():
+        if remote == client_port:
+            return inode
+    return None
+
+
+@unittest.skipUnless(sys.platform.startswith('linux') and hasattr(socket, 'SO_REUSEPORT'),
+                     "needs fork(), SO_REUSEPORT and /proc")
+class WorkersTest(ServerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.port = free_port()
+        self.supervisor = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, 'server.py'), '--host', '127.0.0.1',
+             '--port', str(self.port), '--workers', '2',
+             '--log-dir', 'logs', '--blob-store', 'blobs', '--history-dir', 'history'],
+            cwd=self.directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.addCleanup(self.stop_supervisor)
+        # Each worker listens on the port with a socket of its own
+        self.assertTrue(wait_for(lambda: len(listening_sockets(self.port)) == 2, timeout=10))
+
+    def stop_supervisor(self):
+        # Like Ctrl+C: the supervisor stops its workers
+        self.supervisor.send_signal(signal.SIGINT)
+        try:
+            self.supervisor.wait(10)
+        except subprocess.TimeoutExpired:
+            self.supervisor.kill()
+            self.supervisor.wait()
+
+    def workers(self):
+        pid = self.supervisor.pid
+        try:
+            with open(f"/proc/{pid}/task/{pid}/children") as children:
+                return [int(child) for child in children.read().split()]
+        except OSError:
+            return []
+
+    def worker_of(self, client):
+        inode = server_side_inode(client)
+        for pid in self.workers():
+            if inode in socket_inodes(pid):
+                return pid
+        return None
+
+    def connect_on_each_worker(self):
+        """One client on each worker; the kernel picks the worker, so
+        connect until both are used."""
+        clients = {}
+        for attempt in range(50):
+            client = ChatClient(self.port, f"user{attempt}")
+            self.addCleanup(client.close)
+            self.assertTrue(wait_for(lambda: self.worker_of(client) is not None))
+            clients.setdefault(self.worker_of(client), client)
+            if len(clients) == 2:
+                return list(clients.values())
+        self.fail("All connections went to the same worker")
+
+    def test_broadcast_and_direct_message_across_workers(self):
+        alice, bob = self.connect_on_each_worker()
+        bob_name = bob.nickname
+        # Bob's join came over the bus, so alice's worker knows him
+        self.assertTrue(wait_for(lambda: [event for event in alice.find(EVENT_JOIN)
+                                          if event.get('sender') == bob_name]))
+
+        alice.say('hello from the other worker')
+        self.assertTrue(wait_for(lambda: bob.find(EVENT_CHAT, 'hello from the other worker')))
+
+        alice.say(f"/msg {bob_name} just for you")
+        self.assertTrue(wait_for(lambda: bob.find(EVENT_DM, 'just for you')))
+        self.assertEqual(bob.find(EVENT_DM)[0]['sender'], alice.nickname)
+
+
+if __name__ == "__main__":
+    unittest.main()
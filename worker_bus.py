@@ -0,0 +1,201 @@
+# worker_bus.py
+"""Message bus between the worker processes of one server.
+
+With ``server.py --workers N`` the server forks N worker processes that
+all accept connections on the same port (SO_REUSEPORT lets the kernel
+spread new connections over them). A worker only knows its own clients,
+so everything the other workers' clients must see -- room messages, joins
+and leaves, direct messages -- is published as an event on this bus.
+
+The parent process is the hub: each worker is connected to it by a Unix
+domain socket pair, and the hub forwards every event it reads from one
+worker to all the others. Events are JSON objects sent as frames (see
+protocol.py), stamped with the id of the ``node`` (here: the worker) that
+published them. When a worker's socket closes the hub tells the others
+with a ``node_down`` event.
+
+cluster.py builds the TCP backend for clustering several servers on the
+same BusClient and BusHub.
+"""
+import collections
+import logging
+import selectors
+import socket
+import threading
+
+from protocol import FrameDecoder, decode_json, encode_frame, encode_json
+
+logger = logging.getLogger(__name__)
+
+# Frame type of bus events
+BUS_EVENT = 1
+
+
+class BusClient:
+    """Worker end of the bus.
+
+    publish() only queues the event: a sender thread writes whatever has
+    queued up to the hub in one go, and a receiver thread hands the events
+    of the other workers to the callback given to start().
+    """
+
+    def __init__(self, sock, node_id):
+        self.sock = sock
+        self.node_id = node_id
+        self.on_event = None
+        self.outbox = collections.deque()
+        self.cond = threading.Condition()
+        self.closed = False
+
+        # Counters
+        self.published_events = 0
+        self.received_events = 0
+
+    def start(self, on_event):
+        """Start exchanging events; `on_event` is called from the receiver thread."""
+        self.on_event = on_event
+        threading.Thread(target=self._sender_loop, daemon=True).start()
+        threading.Thread(target=self._receiver_loop, daemon=True).start()
+
+    def publish(self, event):
+        """Queue an event for every other node."""
+        data = encode_frame(BUS_EVENT, encode_json(dict(event, node=self.node_id)))
+        with self.cond:
+            if self.closed:
+                return
+            self.outbox.append(data)
+            self.published_events += 1
+            self.cond.notify()
+
+    def close(self):
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.cond.notify()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+    def _sender_loop(self):
+        while True:
+            with self.cond:
+                while not self.outbox and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    return
+                batch = b''.join(self.outbox)
+                self.outbox.clear()
+            try:
+                self.sock.sendall(batch)
+            except OSError as e:
+                if not self.closed:
+                    logger.error(f"Error publishing to worker bus: {e}")
+                return
+
+    def _receiver_loop(self):
+        decoder = FrameDecoder()
+        while True:
+            try:
+                data = self.sock.recv(64 * 1024)
+            except OSError:
+                data = b''
+            if not data:
+                if not self.closed:
+                    logger.error(f"Node {self.node_id} lost its connection to the bus")
+                return
+            for _, payload in decoder.feed(data):
+                self.received_events += 1
+                try:
+                    self.on_event(decode_json(payload))
+                except Exception as e:
+                    logger.error(f"Error handling bus event: {e}")
+
+
+class BusHub:
+    """Parent end of the bus: relays each worker's events to the others."""
+
+    def __init__(self):
+        self.selector = None
+        # Worker id -> hub end of its socket pair
+        self.workers = {}
+        self.decoders = {}
+
+    def add_worker(self, worker_id):
+        """Connect a new worker and return the socket it should use."""
+        hub_sock, worker_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.workers[worker_id] = hub_sock
+        self.decoders[worker_id] = FrameDecoder()
+        return worker_sock
+
+    def serve(self):
+        """Relay events until every worker has gone."""
+        # Created only now: an epoll selector inherited by forked workers
+        # would share its registrations with them
+        self.selector = selectors.DefaultSelector()
+        for worker_id, sock in self.workers.items():
+            self.selector.register(sock, selectors.EVENT_READ, worker_id)
+        while self.workers:
+            for key, _ in self.selector.select():
+                self._ready(key)
+
+    def _ready(self, key):
+        worker_id = key.data
+        if worker_id not in self.workers:
+            # Dropped while relaying an earlier event
+            return
+        try:
+            data = key.fileobj.recv(64 * 1024)
+        except OSError:
+            data = b''
+        if not data:
+            self._drop(worker_id)
+            return
+        frames = self.decoders[worker_id].feed(data)
+        if frames:
+            self._relay(worker_id, frames)
+
+    def _relay(self, worker_id, frames):
+        # Forward whole frames only, so events from different workers
+        # never interleave mid-frame
+        self._send(b''.join(encode_frame(t, p) for t, p in frames), worker_id)
+
+    def _node_id(self, worker_id):
+        """Node id the events of a connection are stamped with."""
+        return worker_id
+
+    def close(self):
+        """Close the hub's sockets (also used by forked workers, which do
+        not need them)."""
+        for sock in self.workers.values():
+            if self.selector is not None:
+                self.selector.unregister(sock)
+            sock.close()
+        self.workers.clear()
+        if self.selector is not None:
+            self.selector.close()
+            self.selector = None
+
+    def _drop(self, worker_id):
+        sock = self.workers.pop(worker_id, None)
+        if sock is None:
+            return
+        del self.decoders[worker_id]
+        self.selector.unregister(sock)
+        sock.close()
+        node_id = self._node_id(worker_id)
+        logger.info(f"Node {node_id} left the bus")
+        event = {'type': 'node_down', 'node': node_id}
+        self._send(encode_frame(BUS_EVENT, encode_json(event)), worker_id)
+
+    def _send(self, data, sender_id):
+        for worker_id, sock in list(self.workers.items()):
+            if worker_id == sender_id or worker_id not in self.workers:
+                continue
+            try:
+                sock.sendall(data)
+            except OSError as e:
+                logger.error(f"Error relaying to worker {worker_id}: {e}")
+                self._drop(worker_id)